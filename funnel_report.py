@@ -0,0 +1,181 @@
+"""Per-package funnel report over the event log written by script.py (EVENT_LOG_DIR).
+
+Reads the ``events-*.jsonl`` segments one line at a time, so memory stays flat however big
+the log gets (apart from the distinct-user sets).
+
+    python funnel_report.py                          # data/events
+    python funnel_report.py data/events --since 2026-10-01 --until 2026-10-08
+    python funnel_report.py --json
+    python funnel_report.py --bot ana                # one bot of a multi-bot process
+"""
+
+import argparse
+import collections
+import datetime as dt
+import glob
+import json
+import os
+import sys
+
+
+def _parse_time(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return dt.datetime.fromisoformat(value).timestamp()
+
+
+def _segments(directory: str, since=None):
+    """Segment paths in order. A segment covers [its own start, the next segment's start),
+    so segments that end before ``since`` are skipped without being opened."""
+    paths = sorted(glob.glob(os.path.join(directory, "events-*.jsonl")))
+    starts = []
+    for path in paths:
+        try:
+            starts.append(int(os.path.basename(path)[7:-6]) / 1000)
+        except ValueError:
+            starts.append(None)
+    for i, path in enumerate(paths):
+        following = starts[i + 1] if i + 1 < len(starts) else None
+        if since is not None and following is not None and following <= since:
+            continue
+        yield path
+
+
+def read_events(directory: str, since=None, until=None, stats=None, bot=None):
+    for path in _segments(directory, since):
+        with open(path, encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                    ts = record["ts"]
+                except (ValueError, KeyError, TypeError):
+                    if stats is not None:
+                        stats["malformed"] += 1
+                    continue
+                if since is not None and ts < since:
+                    continue
+                if until is not None and ts >= until:
+                    continue
+                if bot is not None and record.get("bot") != bot:
+                    continue
+                yield record
+
+
+def aggregate(records) -> dict:
+    events = collections.Counter()
+    opens = collections.Counter()  # pkg -> webapp_open
+    paid = collections.Counter()  # pkg -> paid
+    paid_by_source = collections.Counter()  # (pkg, source) -> paid
+    revenue = collections.defaultdict(float)  # (pkg, currency) -> amount
+    failures = collections.Counter()  # (step, error) -> send_failed
+    sequence = collections.Counter()  # remarketing sequence step -> remarketing_sent
+    started_users, paid_users = set(), set()
+    first_ts = last_ts = None
+
+    for record in records:
+        event = record.get("event")
+        ts = record["ts"]
+        first_ts = ts if first_ts is None else min(first_ts, ts)
+        last_ts = ts if last_ts is None else max(last_ts, ts)
+        events[event] += 1
+        pkg = record.get("pkg") or "none"
+        if event == "start":
+            started_users.add(record.get("user_id"))
+        elif event == "webapp_open":
+            opens[pkg] += 1
+        elif event == "paid":
+            paid[pkg] += 1
+            paid_by_source[(pkg, record.get("source", "direct"))] += 1
+            paid_users.add(record.get("user_id"))
+            try:
+                amount = float(record.get("amount"))
+            except (TypeError, ValueError):
+                continue
+            revenue[(pkg, record.get("currency") or "")] += amount
+        elif event == "send_failed":
+            failures[(record.get("step"), record.get("error"))] += 1
+        elif event == "remarketing_sent":
+            sequence[record.get("seq_step", 0)] += 1
+
+    packages = []
+    for pkg in sorted(set(opens) | set(paid)):
+        packages.append(
+            {
+                "pkg": pkg,
+                "webapp_open": opens[pkg],
+                "paid": paid[pkg],
+                "paid_direct": paid_by_source[(pkg, "direct")],
+                "paid_remarketing": paid_by_source[(pkg, "remarketing")],
+                "conversion": paid[pkg] / opens[pkg] if opens[pkg] else None,
+                "revenue": {cur: round(v, 2) for (p, cur), v in revenue.items() if p == pkg},
+            }
+        )
+    remarketing_paid = sum(n for (_, source), n in paid_by_source.items() if source == "remarketing")
+    return {
+        "from": first_ts,
+        "to": last_ts,
+        "events": dict(events),
+        "users_started": len(started_users),
+        "users_paid": len(paid_users),
+        "conversion": len(paid_users) / len(started_users) if started_users else None,
+        "remarketing_conversion": remarketing_paid / events["remarketing_sent"] if events["remarketing_sent"] else None,
+        "packages": packages,
+        "send_failed": {f"{step}:{error}": n for (step, error), n in failures.items()},
+        "remarketing_steps": {str(step): n for step, n in sorted(sequence.items())},
+    }
+
+
+def _pct(value) -> str:
+    return "-" if value is None else f"{value * 100:.1f}%"
+
+
+def _print(report: dict, malformed: int) -> None:
+    def when(ts):
+        return "-" if ts is None else dt.datetime.fromtimestamp(ts).isoformat(timespec="seconds")
+
+    print(f"events {sum(report['events'].values())} from {when(report['from'])} to {when(report['to'])}")
+    print("  " + "  ".join(f"{k}={v}" for k, v in sorted(report["events"].items())))
+    print(
+        f"users started {report['users_started']}  paid {report['users_paid']}"
+        f"  conversion {_pct(report['conversion'])}"
+        f"  remarketing conversion {_pct(report['remarketing_conversion'])}"
+    )
+    print(f"\n{'pkg':<8} {'opens':>8} {'paid':>7} {'direct':>7} {'remkt':>7} {'conv':>7}  revenue")
+    for row in report["packages"]:
+        revenue = " ".join(f"{v:.2f} {cur}".strip() for cur, v in sorted(row["revenue"].items()))
+        print(
+            f"{row['pkg']:<8} {row['webapp_open']:>8} {row['paid']:>7} {row['paid_direct']:>7}"
+            f" {row['paid_remarketing']:>7} {_pct(row['conversion']):>7}  {revenue}"
+        )
+    if len(report["remarketing_steps"]) > 1:
+        print("\nremarketing sent per sequence step  " + "  ".join(f"{k}={v}" for k, v in report["remarketing_steps"].items()))
+    if report["send_failed"]:
+        print("\nsend_failed  " + "  ".join(f"{k}={v}" for k, v in sorted(report["send_failed"].items())))
+    if malformed:
+        print(f"\n{malformed} malformed line(s) skipped", file=sys.stderr)
+
+
+def main() -> None:
+    default_dir = os.getenv("EVENT_LOG_DIR", os.path.join(os.getenv("STATE_DIR", "data"), "events"))
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", nargs="?", default=default_dir, help=f"segment directory (default {default_dir})")
+    parser.add_argument("--since", help="ISO date/time or unix timestamp (inclusive)")
+    parser.add_argument("--until", help="ISO date/time or unix timestamp (exclusive)")
+    parser.add_argument("--bot", help="only this bot's events (BOT_NAME / catalog name)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    stats = collections.Counter()
+    events = read_events(args.directory, _parse_time(args.since), _parse_time(args.until), stats, args.bot)
+    report = aggregate(events)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print(report, stats["malformed"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1152 @@
+"""Local Bot API simulator + end-to-end load test for script.py.
+
+Starts a stand-in Telegram Bot API server, runs ``script.py`` against it in a subprocess
+(``BOT_API_BASE_URL``), and replays synthetic sessions:
+/start -> /webapp -> /pagamento-aprovado -> web_app_data (for the converted share).
+
+    python loadtest.py --users 2000 --rate 200 --api-latency 30
+    python loadtest.py --users 2000 --sweep CONCURRENT_UPDATES=1,8,64,256
+    python loadtest.py --users 500 --env SEND_GLOBAL_RATE=1000 --rate-429 0.01 --blocked 0.05
+    python loadtest.py --users 1000 --replicas 3 --kill-after 5 --remarketing-delay 10 --linger 30 --timeout 15
+    python loadtest.py --users 1000 --rate 0 --api-latency 100 --env SEND_GLOBAL_RATE=5000 \
+        --env CONCURRENT_UPDATES=256 --sweep BOT_API_POOL_SIZE=1,4,16,64
+    python loadtest.py --users 2000 --bots 10 --remarketing-delay 5 --linger 20
+    python loadtest.py --users 1000 --rate 0 --bots 5 --assets
+    python loadtest.py --users 2000 --rate 400 --restart-after 2 --remarketing-delay 5 --linger 15
+    python loadtest.py --startup 5 --max-import-ms 800 --max-ready-ms 2500
+    python loadtest.py --users 1000 --start-repeats 5 --remarketing-delay 5 --linger 15
+    python loadtest.py --soak 10000000 --soak-ttl 30 --max-rss-growth-mb 32
+    python loadtest.py --users 2000 --block-after-start 0.3 --linger 10 --broadcast 200 --broadcast-restart-after 3
+    python loadtest.py --users 1000 --sequence-steps 3 --remarketing-delay 3 --linger 15
+    python loadtest.py --markup-bench 20000
+
+Reports updates/s, end-to-end p50/p99 per step, send throughput and connections used,
+Bot API calls per converted user and the bot's RSS over time.
+"""
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import glob
+import hashlib
+import itertools
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import zlib
+from email.parser import BytesParser
+from email.policy import HTTP
+from typing import Optional
+from urllib.parse import parse_qs
+
+import httpx
+import uvicorn
+
+BOT_TOKEN = "123456:LOADTEST"
+BROADCAST_TOKEN = "loadtest-broadcast"
+BROADCAST_TEXT = "Loadtest broadcast"
+START_CMD = "/start"
+FINAL_BUTTON_URL = "https://t.me/m/WRcFptmbMjUx"  # botão da mensagem final (script.FINAL_BUTTON_URL)
+# SIGKILL: /starts respondidos tão perto da queda podem ainda estar no buffer de escrita do bot
+# (STATE_FLUSH_INTERVAL, 0.05 s, mais o atraso de uma máquina carregada); não são cobrados
+CRASH_WINDOW = 0.5
+
+
+def _webhook_secret(token: str) -> str:
+    return hashlib.sha256(f"webhook:{token}".encode()).hexdigest()  # script.py's default
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+# ----------------------
+# Bot API simulator
+# ----------------------
+class BotApiSimulator:
+    """Minimal Telegram Bot API: getUpdates long-polling fed by the load generator, and
+    send* methods answered after ``latency`` seconds, with optional 429/403 injection.
+    Serves any number of bot tokens; user ``i`` talks to ``bots[i % len(bots)]``."""
+
+    def __init__(self, latency: float = 0.0, rate_429: float = 0.0, blocked: float = 0.0, seed: int = 1, block_after_start: float = 0.0):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.blocked_ratio = blocked
+        self.block_after_start = block_after_start
+        self.random = random.Random(seed)
+        self.bots = [("", BOT_TOKEN)]  # (script.py route prefix, token)
+        self.updates = collections.defaultdict(list)  # token -> updates not yet confirmed
+        self.next_update_id = 1
+        self.handed_out = {}  # token -> highest update_id returned by getUpdates
+        self.new_updates = collections.defaultdict(asyncio.Event)  # token -> wake up getUpdates
+        self.message_id = 0
+        self.calls = collections.Counter()  # method -> count
+        self.calls_by_chat = collections.Counter()
+        self.errors = collections.Counter()  # 429 / 403
+        self.pending = collections.defaultdict(collections.deque)  # chat -> (t0, step, future)
+        self.answered_at = {}  # chat -> when its /start was answered
+        self.repeated_starts = collections.Counter()  # chat -> extra /starts sent (no reply awaited)
+        self.repeat_replies = 0  # offers sent back for those
+        self.latencies = collections.defaultdict(list)  # step -> seconds
+        self.delivered = 0
+        self.blocked = set()
+        self.send_times = []  # perf_counter of every answered send
+        self.send_connections = set()  # client (host, port) used for sends
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.remarketing_by_chat = collections.defaultdict(collections.Counter)  # chat -> text -> count
+        self.remarketing_times = collections.defaultdict(list)  # chat -> perf_counter of each one
+        self.broadcast_by_chat = collections.Counter()  # chat -> broadcast messages delivered
+        self.broadcast_blocked = 0  # broadcast sends answered 403
+        self.uploads = collections.Counter()  # token -> photos uploaded as bytes
+        self.file_ids = set()  # file_ids issued for uploads (the only ones getFile accepts)
+        self.webhooks = []  # replicas' base URLs (cluster mode); empty = getUpdates
+        self.dead = set()  # base URLs of killed replicas
+        self._next_webhook = 0
+        self.http = None
+
+    # -- load generator side --
+    def bot_of(self, user_id: int):
+        return self.bots[user_id % len(self.bots)]
+
+    def push(self, update: dict, chat_id: int, step: Optional[str]) -> Optional[asyncio.Future]:
+        update["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        fut = None
+        if step is not None:
+            fut = asyncio.get_running_loop().create_future()
+            self.pending[chat_id].append((time.perf_counter(), step, fut))
+        prefix, token = self.bot_of(chat_id)
+        if self.webhooks:
+            asyncio.create_task(self._deliver(update, prefix, token))
+        else:
+            self.updates[token].append(update)
+            self.new_updates[token].set()
+        return fut
+
+    async def _deliver(self, update: dict, prefix: str, token: str) -> None:
+        # Webhook (modo cluster): como um balanceador, round-robin entre as réplicas vivas
+        headers = {"X-Telegram-Bot-Api-Secret-Token": _webhook_secret(token)}
+        for _ in range(len(self.webhooks)):
+            base = self.webhooks[self._next_webhook % len(self.webhooks)]
+            self._next_webhook += 1
+            if base in self.dead:
+                continue
+            try:
+                response = await self.http.post(f"{base}{prefix}/telegram", json=update, headers=headers)
+            except httpx.TransportError:
+                continue
+            if response.status_code == 200:
+                self.delivered += 1
+                return
+        self.errors["webhook"] += 1
+
+    def push_start(self, user_id: int, repeat: bool = False) -> Optional[asyncio.Future]:
+        if repeat:
+            # Toque repetido em Start: nenhuma resposta esperada (o bot pode descartar)
+            self.repeated_starts[user_id] += 1
+        elif self.random.random() < self.blocked_ratio:
+            self.blocked.add(user_id)
+        message = self._message(user_id, text=START_CMD)
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(START_CMD)}]
+        return self.push({"message": message}, user_id, None if repeat else "start")
+
+    def push_webapp_data(self, user_id: int, payload: dict) -> asyncio.Future:
+        message = self._message(user_id)
+        message["web_app_data"] = {"data": json.dumps(payload), "button_text": "Package"}
+        return self.push({"message": message}, user_id, "paid")
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Load"},
+            **extra,
+        }
+
+    # -- Bot API side --
+    async def _get_updates(self, token: str, params: dict) -> list:
+        offset = int(params.get("offset", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        timeout = float(params.get("timeout", 0) or 0)
+        updates = self.updates[token]
+        if offset:
+            # Updates confirmados (update_id < offset) podem ser descartados
+            drop = 0
+            while drop < len(updates) and updates[drop]["update_id"] < offset:
+                drop += 1
+            del updates[:drop]
+        if not updates and timeout:
+            self.new_updates[token].clear()
+            try:
+                await asyncio.wait_for(self.new_updates[token].wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = updates[:limit]
+        # Conta cada update uma vez (o mesmo lote volta se o bot não confirmar o offset)
+        seen = self.handed_out.get(token, 0)
+        self.delivered += sum(1 for u in batch if u["update_id"] > seen)
+        if batch:
+            self.handed_out[token] = max(seen, batch[-1]["update_id"])
+        return batch
+
+    def _observe_reply(self, chat_id: int, params: dict) -> None:
+        # Fim de um passo = primeira chamada com teclado do tipo certo depois do update (start:
+        # ofertas; paid: a mensagem final, com o botão FINAL_BUTTON_URL). Fora de um passo:
+        # uma oferta só = remarketing; várias = ofertas de novo para um /start repetido (ou
+        # reentregue depois de um crash); uma final repetida não conta.
+        if "reply_markup" not in params:
+            return
+        markup = str(params["reply_markup"])
+        final = FINAL_BUTTON_URL in markup
+        queue = self.pending.get(chat_id)
+        if not queue or (queue[0][1] == "paid") != final:
+            if final:
+                return
+            if markup.count('"text"') > 1:
+                self.repeat_replies += bool(self.repeated_starts[chat_id])
+                return
+            self.latencies["remarketing_sent"].append(0.0)
+            self.remarketing_by_chat[chat_id][params.get("caption") or params.get("text")] += 1
+            self.remarketing_times[chat_id].append(time.perf_counter())
+            return
+        t0, step, fut = queue.popleft()
+        self.latencies[step].append(time.perf_counter() - t0)
+        if step == "start":
+            self.answered_at[chat_id] = time.perf_counter()
+        if step == "start" and self.random.random() < self.block_after_start:
+            self.blocked.add(chat_id)  # viu as ofertas e bloqueou o bot
+        if not fut.done():
+            fut.set_result(None)
+
+    async def call(self, token: str, method: str, params: dict):
+        self.calls[method] += 1
+        bot_id = int(token.split(":")[0])
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": await self._get_updates(token, params)}
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": bot_id, "is_bot": True, "first_name": "Stub", "username": f"stub{bot_id}_bot"}}
+        if method == "getFile":
+            file_id = params.get("file_id")
+            if file_id not in self.file_ids:
+                return 400, {"ok": False, "error_code": 400, "description": "Bad Request: wrong file identifier/HTTP URL specified"}
+            return 200, {"ok": True, "result": {"file_id": file_id, "file_unique_id": file_id, "file_size": 1, "file_path": f"photos/{file_id}.jpg"}}
+        chat_id = params.get("chat_id")
+        if chat_id is None:
+            return 200, {"ok": True, "result": True}
+        chat_id = int(chat_id)
+        self.calls_by_chat[chat_id] += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        self.send_times.append(time.perf_counter())
+        if self.rate_429 and self.random.random() < self.rate_429:
+            self.errors["429"] += 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }
+        broadcast = BROADCAST_TEXT in str(params.get("caption") or params.get("text") or "")
+        if chat_id in self.blocked:
+            self.errors["403"] += 1
+            self.broadcast_blocked += broadcast
+            queue = self.pending.get(chat_id)
+            while queue:
+                _, _, fut = queue.popleft()
+                if not fut.done():
+                    fut.set_result(None)
+            return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        if broadcast:
+            self.broadcast_by_chat[chat_id] += 1
+        else:
+            self._observe_reply(chat_id, params)
+        message = self._message(chat_id)
+        message["from"] = {"id": bot_id, "is_bot": True, "first_name": "Stub"}
+        if method == "sendPhoto":
+            file_id = params.get("photo", "")
+            if file_id.startswith("attach://"):
+                self.uploads[token] += 1
+                file_id = f"sim-{bot_id}-{len(self.file_ids)}"
+                self.file_ids.add(file_id)
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}]
+        if "caption" in params:
+            message["caption"] = params["caption"]
+        if "text" in params:
+            message["text"] = params["text"]
+        return 200, {"ok": True, "result": message}
+
+    async def asgi(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        bot_path, method = scope["path"].rsplit("/", 2)[-2:]  # /bot<token>/<method>
+        content_type = dict(scope["headers"]).get(b"content-type", b"")
+        if content_type.startswith(b"application/json"):
+            params = json.loads(body or b"{}")
+        elif content_type.startswith(b"multipart/form-data"):
+            # Upload de arquivo: o conteúdo é descartado, o campo vira "attach://<campo>"
+            form = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type + b"\r\n\r\n" + body)
+            params = {}
+            for part in form.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                params[name] = part.get_content() if part.get_filename() is None else f"attach://{name}"
+        else:
+            params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        if "chat_id" in params and scope.get("client"):
+            self.send_connections.add(tuple(scope["client"]))
+        status, payload = await self.call(bot_path[3:], method, params)
+        raw = json.dumps(payload).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(raw)).encode())],
+            }
+        )
+        await send({"type": "http.response.body", "body": raw})
+
+
+# ----------------------
+# Bot process
+# ----------------------
+def _rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+async def _wait_ready(http: httpx.AsyncClient, proc: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"script.py exited with code {proc.returncode}")
+        try:
+            if (await http.get("/health")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit("script.py did not become ready")
+
+
+def _write_catalog(directory: str, bots: int) -> list:
+    """One catalog file per bot (default texts, own token); returns the simulator's bots."""
+    os.makedirs(directory, exist_ok=True)
+    out = []
+    for i in range(bots):
+        name, token = f"bot{i:03d}", f"{200000 + i}:LOADTEST"
+        with open(os.path.join(directory, f"{name}.json"), "w") as fh:
+            json.dump({"token": token}, fh)
+        out.append((f"/{name}", token))
+    return out
+
+
+def _write_sequence(path: str, steps: int, delay: int) -> None:
+    """REMARKETING_SEQUENCE_FILE with ``steps`` follow-ups ``delay`` seconds apart (told apart by the text)."""
+    with open(path, "w") as fh:
+        json.dump([{"delay_seconds": delay, "text": f"Loadtest follow-up {k + 1}"} for k in range(steps)], fh)
+
+
+def _png(rgb: tuple) -> bytes:
+    """A valid 1x1 PNG of one color (enough for the simulator; real assets are photos)."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return len(data).to_bytes(4, "big") + kind + data + zlib.crc32(kind + data).to_bytes(4, "big")
+
+    ihdr = (1).to_bytes(4, "big") * 2 + bytes((8, 2, 0, 0, 0))
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(bytes((0, *rgb)))) + chunk(b"IEND", b"")
+
+
+def _write_assets(directory: str) -> None:
+    os.makedirs(directory, exist_ok=True)
+    for name, rgb in (("start", (200, 30, 90)), ("remarketing", (30, 90, 200))):
+        with open(os.path.join(directory, f"{name}.png"), "wb") as fh:
+            fh.write(_png(rgb))
+
+
+def _bot_env(args, api_port: int, bot_port: int, state_dir: str, extra_env: dict, replica: Optional[int] = None) -> dict:
+    env = dict(os.environ)
+    env.update(
+        {
+            "BOT_TOKEN": BOT_TOKEN,
+            "BOT_API_BASE_URL": f"http://127.0.0.1:{api_port}",
+            "PORT": str(bot_port),
+            "WEBAPP_BASE_URL": f"http://127.0.0.1:{bot_port}",
+            "STATE_DIR": state_dir,
+            "USE_WEBHOOK": "false",
+            "USE_NGROK": "false",
+            "REMARKETING_DELAY_SECONDS": str(args.remarketing_delay),
+            "BROADCAST_TOKEN": BROADCAST_TOKEN,
+        }
+    )
+    if args.bots > 1:
+        env["BOT_CATALOG_DIR"] = os.path.join(state_dir, "catalog")
+    if args.assets:
+        env["ASSETS_DIR"] = os.path.join(state_dir, "assets")
+    if args.sequence_steps:
+        env["REMARKETING_SEQUENCE_FILE"] = os.path.join(state_dir, "sequence.json")
+    if replica is not None:
+        # Réplicas em modo cluster: webhook (só uma instância poderia fazer polling)
+        env.update(
+            {
+                "USE_WEBHOOK": "true",
+                "WEBHOOK_BASE_URL": "https://loadtest.invalid",
+                "CLUSTER": "true",
+                "CLUSTER_INSTANCE_ID": f"replica-{replica}",
+                "CLUSTER_LEASE_SECONDS": "3",
+                "CLUSTER_RESYNC_SECONDS": "1",
+            }
+        )
+    env.update(extra_env)
+    return env
+
+
+def _start_bot(args, api_port: int, bot_port: int, state_dir: str, extra_env: dict, replica: Optional[int] = None) -> subprocess.Popen:
+    env = _bot_env(args, api_port, bot_port, state_dir, extra_env, replica)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "script.py")
+    return subprocess.Popen([sys.executable, script], env=env, stdout=subprocess.DEVNULL if not args.verbose else None, stderr=None if args.verbose else subprocess.DEVNULL)
+
+
+# ----------------------
+# Load generator
+# ----------------------
+async def _repeat_start(sim: BotApiSimulator, user_id: int, repeats: int, interval: float) -> None:
+    for _ in range(repeats):
+        await asyncio.sleep(interval)
+        sim.push_start(user_id, repeat=True)
+
+
+async def _session(
+    sim: BotApiSimulator, pick_http, user_id: int, convert: bool, stats: dict, timeout: float, repeats: int = 0, interval: float = 0.3
+) -> None:
+    first = sim.push_start(user_id)
+    if repeats:
+        # Usuário impaciente (ou bot): mais /starts enquanto o resto da sessão segue
+        stats["repeaters"].append(asyncio.create_task(_repeat_start(sim, user_id, repeats, interval)))
+    try:
+        await asyncio.wait_for(first, timeout)
+    except asyncio.TimeoutError:
+        stats["timeouts"] += 1
+        return
+    stats["started_ids"].add(user_id)
+    if not convert or user_id in sim.blocked:
+        return
+    pkg = random.choice(("pkg1", "pkg2", "pkg3"))
+    prefix, _ = sim.bot_of(user_id)
+    for path in (f"/webapp?target=https%3A%2F%2Fcheckout.example%2F{pkg}&pkg={pkg}&src=direct", f"/pagamento-aprovado?order_id=o{user_id}"):
+        t0 = time.perf_counter()
+        for attempt in itertools.count():
+            try:
+                response = await pick_http().get(prefix + path)
+                break
+            except httpx.TransportError:
+                # Réplica derrubada / bot reiniciando: o balanceador tentaria outra, ou de novo
+                stats["http_errors"] += 1
+                if attempt >= 100:
+                    raise
+                await asyncio.sleep(0.1)
+        sim.latencies["http " + path.split("?")[0]].append(time.perf_counter() - t0)
+        if response.status_code != 200:
+            stats["http_errors"] += 1
+    payload = {"source": "webapp", "type": "payment", "status": "approved", "pkg": pkg, "order_id": f"o{user_id}", "tg_user_id": user_id}
+    stats["paying_ids"].add(user_id)
+    try:
+        await asyncio.wait_for(sim.push_webapp_data(user_id, payload), timeout)
+        stats["converted"] += 1
+        stats["converted_ids"].append(user_id)
+        stats["paid_at"][user_id] = time.perf_counter()
+    except asyncio.TimeoutError:
+        stats["timeouts"] += 1
+
+
+async def run_once(args, extra_env: dict) -> dict:
+    sim = BotApiSimulator(args.api_latency / 1000, args.rate_429, args.blocked, args.seed, args.block_after_start)
+    api_port = _free_port()
+    api_server = uvicorn.Server(uvicorn.Config(sim.asgi, host="127.0.0.1", port=api_port, log_level="warning", lifespan="off", interface="asgi3"))
+    api_task = asyncio.create_task(api_server.serve())
+    while not api_server.started:
+        await asyncio.sleep(0.05)
+
+    stats = {
+        "converted": 0, "timeouts": 0, "http_errors": 0, "converted_ids": [], "started_ids": set(), "repeaters": [], "paid_at": {}, "paying_ids": set(),
+    }
+    rss = []
+    restart = {}
+    crashes = []  # perf_counter de cada SIGKILL (reinício ou réplica derrubada)
+    broadcast = {}
+    completed = None
+    cluster = args.replicas > 1
+    bot_ports = [_free_port() for _ in range(args.replicas)]
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as state_dir:
+        if args.bots > 1:
+            sim.bots = _write_catalog(os.path.join(state_dir, "catalog"), args.bots)
+        if args.assets:
+            _write_assets(os.path.join(state_dir, "assets"))
+        if args.sequence_steps:
+            _write_sequence(os.path.join(state_dir, "sequence.json"), args.sequence_steps, args.remarketing_delay)
+        procs = [
+            _start_bot(args, api_port, port, state_dir, extra_env, i if cluster else None)
+            for i, port in enumerate(bot_ports)
+        ]
+        limits = httpx.Limits(max_connections=args.http_connections)
+        clients = [
+            httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=30) for port in bot_ports
+        ]
+        sim.http = httpx.AsyncClient(timeout=30)
+        alive = list(range(len(procs)))
+        turn = itertools.count()
+
+        def pick_http():
+            return clients[alive[next(turn) % len(alive)]]
+
+        async def kill_replica() -> None:
+            await asyncio.sleep(args.kill_after)
+            victim = alive.pop(0)
+            crashes.append(time.perf_counter())
+            procs[victim].kill()
+            sim.dead.add(f"http://127.0.0.1:{bot_ports[victim]}")
+            print(f"  killed replica-{victim} (SIGKILL) at {args.kill_after:.1f}s", flush=True)
+
+        async def restart_bot(after: float) -> None:
+            # Reinício no meio da rajada, mesmo PORT e STATE_DIR: SIGTERM (dreno) ou SIGKILL (queda)
+            await asyncio.sleep(after)
+            sig = signal.SIGKILL if args.restart_signal == "KILL" else signal.SIGTERM
+            stopping = time.perf_counter()
+            if sig == signal.SIGKILL:
+                crashes.append(stopping)
+            procs[0].send_signal(sig)
+            await asyncio.to_thread(procs[0].wait, 60)
+            exited = time.perf_counter() - stopping
+            procs[0] = _start_bot(args, api_port, bot_ports[0], state_dir, extra_env)
+            await _wait_ready(clients[0], procs[0])
+            restart.update(signal=sig.name, exit_s=exited, back_s=time.perf_counter() - stopping)
+            print(f"  {sig.name} at {after:.1f}s: exited in {exited:.2f}s, ready again after {restart['back_s']:.2f}s", flush=True)
+
+        async def run_broadcast() -> None:
+            # Depois das sessões: um broadcast para a base (e, opcionalmente, um reinício no meio)
+            headers = {"Authorization": f"Bearer {BROADCAST_TOKEN}"}
+            spec = {"id": "loadtest", "text": BROADCAST_TEXT, "rate": args.broadcast}
+            t0 = time.perf_counter()
+            response = await clients[0].post("/broadcast", json=spec, headers=headers)
+            if response.status_code != 202:
+                raise RuntimeError(f"POST /broadcast: {response.status_code} {response.text}")
+            audience = response.json()["audience"] or 0
+            restarter = asyncio.create_task(restart_bot(args.broadcast_restart_after)) if args.broadcast_restart_after else None
+            deadline = t0 + args.timeout + 3 * audience / args.broadcast
+            status = {}
+            while time.perf_counter() < deadline:
+                await asyncio.sleep(0.25)
+                try:
+                    response = await clients[0].get("/broadcast", headers=headers)
+                except httpx.TransportError:
+                    continue  # reiniciando
+                if response.status_code == 200:
+                    status = response.json()
+                    if status["state"] == "done":
+                        break
+            if restarter is not None:
+                await restarter
+            broadcast.update(status=status, elapsed=time.perf_counter() - t0)
+
+        try:
+            for client, proc in zip(clients, procs):
+                await _wait_ready(client, proc)
+            if cluster:
+                sim.webhooks = [f"http://127.0.0.1:{port}" for port in bot_ports]
+            sampler = asyncio.create_task(_sample_rss(procs[-1].pid, rss))
+            prober = (
+                asyncio.create_task(_probe_health(pick_http, sim.latencies["http /health"], args.health_interval))
+                if args.health_interval
+                else None
+            )
+            killer = asyncio.create_task(kill_replica()) if cluster and args.kill_after else None
+            restarter = asyncio.create_task(restart_bot(args.restart_after)) if args.restart_after else None
+            rng = random.Random(args.seed)
+            started = time.perf_counter()
+            sessions = []
+            for i in range(args.users):
+                user_id = 10_000_000 + i
+                sessions.append(
+                    asyncio.create_task(
+                        _session(
+                            sim, pick_http, user_id, rng.random() < args.conversion, stats, args.timeout,
+                            args.start_repeats, args.start_repeat_interval,
+                        )
+                    )
+                )
+                if args.rate:
+                    # Chegadas em ritmo constante
+                    delay = started + (i + 1) / args.rate - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+            await asyncio.gather(*sessions, *stats["repeaters"])
+            elapsed = time.perf_counter() - started
+            if restarter is not None:
+                await restarter
+            if args.linger:
+                await asyncio.sleep(args.linger)
+            if args.broadcast:
+                await run_broadcast()
+            sampler.cancel()
+            if prober is not None:
+                prober.cancel()
+            if killer is not None:
+                killer.cancel()
+            # Estado persistido: usuários pagos segundo o bot (sobrevive a reinícios)
+            scraped = (await pick_http().get("/metrics")).text
+            completed = sum(int(float(line.split()[-1])) for line in scraped.splitlines() if line.startswith("bot_completed_users{"))
+            avoided = sum(
+                int(float(line.split()[-1])) for line in scraped.splitlines() if line.startswith("bot_unreachable_calls_avoided_total{")
+            )
+            suppressed = collections.Counter()
+            for line in scraped.splitlines():
+                if line.startswith("bot_start_suppressed_total{"):
+                    suppressed[line.split('reason="')[1].split('"')[0]] += int(float(line.split()[-1]))
+        finally:
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.send_signal(signal.SIGINT)
+            for proc in procs:
+                try:
+                    # Em thread: o simulador (neste loop) precisa seguir respondendo ao desligamento
+                    await asyncio.to_thread(proc.wait, 20)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+            for client in clients:
+                await client.aclose()
+            await sim.http.aclose()
+    api_server.should_exit = True
+    await api_task
+
+    converted_calls = sum(sim.calls_by_chat[u] for u in stats["converted_ids"])
+    send_window = sim.send_times[-1] - sim.send_times[0] if len(sim.send_times) > 1 else 0.0
+    per_second = collections.Counter(int(t - sim.send_times[0]) for t in sim.send_times)
+    # Cada usuário que recebeu o /start e não pagou deve receber exatamente um remarketing
+    # (um update aceito por uma réplica morta antes de ser processado nunca teve /start)
+    converted = set(stats["converted_ids"])
+    steps = args.sequence_steps or 1
+    # Quem mandou o pagamento fica de fora mesmo sem a mensagem final (perdida numa queda):
+    # o bot pode já tê-lo gravado como pago
+    expected = [u for u in stats["started_ids"] if u not in stats["paying_ids"] and u not in sim.blocked]
+    missing = [u for u in expected if len(sim.remarketing_by_chat.get(u, ())) < steps]
+    crash_window = [u for u in missing if any(abs(sim.answered_at.get(u, 0.0) - t) < CRASH_WINDOW for t in crashes)]
+    if broadcast:
+        # Público do broadcast: quem não pagou e não bloqueou; cada um recebe exatamente uma vez
+        broadcast.update(
+            expected=len(expected),
+            delivered=sum(sim.broadcast_by_chat.values()),
+            missing=sum(1 for u in expected if not sim.broadcast_by_chat[u]),
+            duplicated=sum(1 for n in sim.broadcast_by_chat.values() if n > 1),
+            to_paid=sum(1 for u in converted if sim.broadcast_by_chat[u]),
+            to_blocked=sim.broadcast_blocked,
+        )
+    return {
+        "env": extra_env,
+        "replicas": args.replicas,
+        "bots": args.bots,
+        "linger": args.linger,
+        "elapsed": elapsed,
+        "updates": sim.delivered,
+        "updates_per_s": sim.delivered / elapsed if elapsed else 0.0,
+        "latencies": dict(sim.latencies),
+        "calls": dict(sim.calls),
+        "sends_per_s": len(sim.send_times) / send_window if send_window else 0.0,
+        "peak_sends_per_s": max(per_second.values(), default=0),
+        "send_connections": len(sim.send_connections),
+        "peak_in_flight": sim.peak_in_flight,
+        "errors": dict(sim.errors),
+        "converted": stats["converted"],
+        "calls_per_converted": converted_calls / stats["converted"] if stats["converted"] else 0.0,
+        "timeouts": stats["timeouts"],
+        "http_errors": stats["http_errors"],
+        "uploads": dict(sim.uploads),
+        "completed_users": completed,
+        "sends_to_blocked": sim.errors.get("403", 0),
+        "sends_avoided": avoided,
+        "start_repeats": sum(sim.repeated_starts.values()),
+        "start_repeat_replies": sim.repeat_replies,
+        "start_suppressed": dict(suppressed),
+        "restart": restart,
+        "broadcast": broadcast,
+        "remarketing_duplicates": sum(1 for texts in sim.remarketing_by_chat.values() if max(texts.values()) > 1),
+        "remarketing_missing": len(missing),
+        "remarketing_crash_window": len(crash_window),
+        "remarketing_expected": len(expected),
+        "remarketing_steps": steps,
+        "remarketing_per_step": [sum(1 for t in sim.remarketing_by_chat.values() if len(t) > k) for k in range(steps)],
+        # Pagamento encerra a sequência: nada depois do pagamento (1 s de folga para um envio já em voo)
+        "remarketing_after_paid": sum(
+            1 for u, t in stats["paid_at"].items() for sent in sim.remarketing_times.get(u, ()) if sent > t + 1
+        ),
+        "rss_kb": rss,
+    }
+
+
+# ----------------------
+# Cold start
+# ----------------------
+def _import_profile(env: dict) -> tuple:
+    """``python -X importtime -c "import script"``: total ms and script's direct imports as
+    [(cumulative ms, module)], heaviest first."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import script"], cwd=here, env=env, capture_output=True, text=True, timeout=120
+    )
+    if out.returncode:
+        raise SystemExit(f"import script failed:\n{out.stderr[-2000:]}")
+    rows = []  # (depth, cumulative us, module), children before their parent
+    for line in out.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        indent = len(fields[2]) - len(fields[2].lstrip())
+        rows.append(((indent - 1) // 2, int(fields[1]), fields[2].strip()))
+    at = max(i for i, (depth, _, module) in enumerate(rows) if depth == 0 and module == "script")
+    direct = []
+    for depth, cumulative, module in reversed(rows[:at]):
+        if depth == 0:
+            break
+        if depth == 1:
+            direct.append((cumulative / 1000, module))
+    return rows[at][1] / 1000, sorted(direct, reverse=True)
+
+
+async def _cold_start(http: httpx.AsyncClient, proc: subprocess.Popen, launched: float, timeout: float = 60) -> dict:
+    """Poll /livez and /health every 10 ms from launch; then SIGINT and time the exit."""
+    out = {}
+    deadline = launched + timeout
+    while "ready" not in out:
+        if proc.poll() is not None:
+            raise SystemExit(f"script.py exited with code {proc.returncode}")
+        if time.perf_counter() > deadline:
+            raise SystemExit("script.py did not become ready")
+        try:
+            if "live" not in out and (await http.get("/livez")).status_code == 200:
+                out["live"] = time.perf_counter() - launched
+            response = await http.get("/health")
+            if response.status_code == 200:
+                out["ready"] = time.perf_counter() - launched
+                out["phases"] = response.json().get("startup", {})
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.01)
+    stopping = time.perf_counter()
+    proc.send_signal(signal.SIGINT)
+    await asyncio.to_thread(proc.wait, 30)
+    out["shutdown"] = time.perf_counter() - stopping
+    return out
+
+
+async def startup_once(args, extra_env: dict) -> dict:
+    """``--startup N``: N cold starts of script.py against the simulator (same state dir, so
+    runs after the first restore state and reuse the asset cache) plus N import profiles."""
+    sim = BotApiSimulator(args.api_latency / 1000)
+    api_port = _free_port()
+    api_server = uvicorn.Server(uvicorn.Config(sim.asgi, host="127.0.0.1", port=api_port, log_level="warning", lifespan="off", interface="asgi3"))
+    api_task = asyncio.create_task(api_server.serve())
+    while not api_server.started:
+        await asyncio.sleep(0.05)
+    runs, imports = [], []
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as state_dir:
+        if args.bots > 1:
+            sim.bots = _write_catalog(os.path.join(state_dir, "catalog"), args.bots)
+        if args.assets:
+            _write_assets(os.path.join(state_dir, "assets"))
+        for _ in range(args.startup):
+            port = _free_port()
+            env = _bot_env(args, api_port, port, state_dir, extra_env)
+            total, direct = await asyncio.to_thread(_import_profile, env)
+            imports.append(total)
+            launched = time.perf_counter()
+            proc = _start_bot(args, api_port, port, state_dir, extra_env)
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=5) as http:
+                try:
+                    runs.append(await _cold_start(http, proc, launched))
+                finally:
+                    if proc.poll() is None:
+                        proc.kill()
+    api_server.should_exit = True
+    await api_task
+    phases = collections.defaultdict(list)
+    for run in runs:
+        for name, seconds in run["phases"].items():
+            phases[name].append(seconds)
+    return {
+        "env": extra_env,
+        "bots": args.bots,
+        "runs": len(runs),
+        "import_ms": imports,
+        "heaviest_imports": direct[:8],
+        "live_ms": [r["live"] * 1000 for r in runs],
+        "ready_ms": [r["ready"] * 1000 for r in runs],
+        "shutdown_ms": [r["shutdown"] * 1000 for r in runs],
+        "phases_ms": {name: [v * 1000 for v in values] for name, values in phases.items()},
+    }
+
+
+def _report_startup(result: dict) -> list:
+    """Print the cold start report; returns the budgets it exceeded."""
+    env = " ".join(f"{k}={v}" for k, v in result["env"].items()) or "(defaults)"
+    print(f"\n== cold start x{result['runs']}  {env}" + (f"  bots={result['bots']}" if result["bots"] > 1 else ""))
+    for label, key in (("import script", "import_ms"), ("live (/livez)", "live_ms"), ("ready (/health)", "ready_ms"), ("shutdown", "shutdown_ms")):
+        values = result[key]
+        print(f"  {label:<16} p50={_percentile(values, 0.5):7.0f}ms  max={max(values):7.0f}ms")
+    print("  heaviest imports " + "  ".join(f"{module}={ms:.0f}ms" for ms, module in result["heaviest_imports"]))
+    print("  phases p50 " + "  ".join(f"{name}={_percentile(v, 0.5):.0f}ms" for name, v in result["phases_ms"].items()))
+    exceeded = []
+    for budget, key in ((result["max_import_ms"], "import_ms"), (result["max_ready_ms"], "ready_ms")):
+        if budget and _percentile(result[key], 0.5) > budget:
+            exceeded.append(f"{key} p50 {_percentile(result[key], 0.5):.0f} > {budget:.0f}")
+    return exceeded
+
+
+# ----------------------
+# Soak (state memory)
+# ----------------------
+def soak(args, extra_env: dict) -> dict:
+    """``--soak N``: N synthetic /start events straight into script.py's state layer, in
+    this process: the store (LRU, paid ids, write-behind to SQLite), the remarketing heap and
+    its claims, and the TTL expiry every ``--soak-ttl / 2`` seconds. No Bot API and no
+    handlers, so millions of events take minutes; RSS is sampled 50 times."""
+    samples = []
+    with tempfile.TemporaryDirectory(prefix="soak-") as state_dir:
+        os.environ.update({"BOT_TOKEN": "1:soak", "STATE_DIR": state_dir, **extra_env})
+        import script  # configured by the environment above
+
+        store, scheduler = script.tenants[0].store, script.remarketing_scheduler
+        rng = random.Random(args.seed)
+        started = last_expiry = time.perf_counter()
+        expired = paid = remarketed = 0
+        every = max(1, args.soak // 50)
+        for i in range(1, args.soak + 1):
+            user_id = 10**9 + rng.randrange(args.soak_users or 2 * args.soak)
+            if not store.is_completed(user_id):
+                # /start: agenda o remarketing (substitui o anterior); parte paga na hora
+                scheduler.schedule(0, user_id, user_id, int(time.time()) + args.remarketing_delay)
+                if rng.random() < args.soak_conversion:
+                    store.mark_completed(user_id, user_id)
+                    scheduler.cancel(0, user_id)
+                    paid += 1
+            if i % 1000 == 0:
+                due = scheduler.pop_due(time.time(), 10**9)
+                if due:
+                    remarketed += len(store.claim_remarketings([(u, d, 0, None) for _, u, d in due]))
+                if time.perf_counter() - last_expiry > args.soak_ttl / 2:
+                    expired += store.expire(args.soak_ttl)
+                    last_expiry = time.perf_counter()
+            if i % every == 0:
+                samples.append((i, _rss_kb(os.getpid()), store.memory_bytes, len(scheduler)))
+        elapsed = time.perf_counter() - started
+        store.flush()
+        disk = sum(os.path.getsize(path) for path in glob.glob(os.path.join(state_dir, "users-*.db*")))
+        store.close()
+    return {
+        "env": extra_env,
+        "events": args.soak,
+        "elapsed": elapsed,
+        "paid": paid,
+        "remarketed": remarketed,
+        "expired": expired,
+        "disk_mb": disk / 2**20,
+        "samples": samples,
+    }
+
+
+def _report_soak(result: dict, max_growth_mb: float) -> list:
+    """Print the soak report; returns the budgets it exceeded. Growth is measured from the
+    10% mark, once the cache and the heap have filled up."""
+    env = " ".join(f"{k}={v}" for k, v in result["env"].items()) or "(defaults)"
+    print(f"\n== soak {result['events']} /start events  {env}")
+    print(
+        f"  elapsed {result['elapsed']:.0f}s ({result['events'] / result['elapsed']:.0f} events/s)"
+        f"  paid {result['paid']}  remarketed {result['remarketed']}  expired {result['expired']}"
+        f"  state on disk {result['disk_mb']:.0f}MB"
+    )
+    print(f"  {'events':>10} {'rss MB':>8} {'state MB':>9} {'pending':>8}")
+    samples = result["samples"]
+    for events, rss, state, pending in samples[:: max(1, len(samples) // 10)] + samples[-1:]:
+        print(f"  {events:>10} {rss / 1024:>8.1f} {state / 2**20:>9.1f} {pending:>8}")
+    base = samples[len(samples) // 10][1]
+    growth = (max(rss for _, rss, _, _ in samples) - base) / 1024
+    print(f"  rss growth after warm-up {growth:.1f}MB")
+    return [f"rss growth {growth:.1f}MB > {max_growth_mb:.0f}MB"] if max_growth_mb and growth > max_growth_mb else []
+
+
+# ----------------------
+# Markup micro-benchmark
+# ----------------------
+def markup_bench(args, extra_env: dict) -> list:
+    """``--markup-bench N``: per-send cost of the keyboards in this process, building and
+    serializing them on every send (as before the cache) vs reading the cached JSON and
+    filling in the recipient's id. Returns (label, µs per send) rows."""
+    with tempfile.TemporaryDirectory(prefix="markup-") as state_dir:
+        os.environ.update(
+            {"BOT_TOKEN": "1:bench", "STATE_DIR": state_dir, "WEBAPP_BASE_URL": "https://bench.example", **extra_env}
+        )
+        import script  # configured by the environment above
+
+        tenant = script.tenants[0]
+        base_url = script.WEBAPP_BASE_URL + tenant.prefix
+        step = tenant.sequence[0]
+
+        def build_start():
+            reply_kb, inline_kb = script._build_markups_for_start(tenant.catalog, base_url)
+            return script._for_user(script._serialize_markup(reply_kb or inline_kb), 1234567)
+
+        def build_remarketing():
+            reply_kb, inline_kb = script._remarketing_reply_markup(step, base_url)
+            return script._for_user(script._serialize_markup(reply_kb or inline_kb), 1234567)
+
+        def cached_start():
+            return script._for_user(tenant.markups().start, 1234567)
+
+        def cached_remarketing():
+            return script._for_user(tenant.markups().remarketing[0], 1234567)
+
+        assert build_start() == cached_start() and build_remarketing() == cached_remarketing()
+        rows = []
+        for label, fn in (
+            ("start: build + serialize", build_start),
+            ("start: cached JSON", cached_start),
+            ("remarketing: build + serialize", build_remarketing),
+            ("remarketing: cached JSON", cached_remarketing),
+        ):
+            best = min(timeit.repeat(fn, number=args.markup_bench, repeat=5))
+            rows.append((label, best / args.markup_bench * 1e6))
+        tenant.store.close()
+    return rows
+
+
+def _report_markup_bench(rows: list, iterations: int) -> None:
+    print(f"\n== markup micro-benchmark  {iterations} sends, best of 5")
+    for label, us in rows:
+        print(f"  {label:<32} {us:>9.2f} µs/send")
+    for before, after in zip(rows[::2], rows[1::2]):
+        print(f"  {before[0].split(':')[0]:<32} {before[1] / after[1]:>9.0f}x faster cached")
+
+
+async def _probe_health(pick_http, out: list, interval: float) -> None:
+    # Readiness sob carga: o balanceador/orquestrador chama /health o tempo todo
+    while True:
+        t0 = time.perf_counter()
+        with contextlib.suppress(httpx.TransportError):
+            await pick_http().get("/health")
+            out.append(time.perf_counter() - t0)
+        await asyncio.sleep(interval)
+
+
+async def _sample_rss(pid: int, out: list, interval: float = 1.0) -> None:
+    started = time.perf_counter()
+    while True:
+        out.append((round(time.perf_counter() - started, 1), _rss_kb(pid)))
+        await asyncio.sleep(interval)
+
+
+def _report(result: dict) -> None:
+    env = " ".join(f"{k}={v}" for k, v in result["env"].items()) or "(defaults)"
+    print(f"\n== {env}" + (f"  bots={result['bots']}" if result["bots"] > 1 else ""))
+    print(f"elapsed {result['elapsed']:.1f}s  updates {result['updates']}  updates/s {result['updates_per_s']:.1f}")
+    for step, values in sorted(result["latencies"].items()):
+        if step == "remarketing_sent":
+            print(f"  {step:<28} n={len(values)}")
+            continue
+        print(
+            f"  {step:<28} n={len(values):<6} p50={_percentile(values, 0.50) * 1000:8.1f}ms"
+            f"  p99={_percentile(values, 0.99) * 1000:8.1f}ms"
+        )
+    api_calls = sum(n for method, n in result["calls"].items() if method != "getUpdates")
+    print(f"  bot api calls {api_calls} {result['calls']}  injected errors {result['errors']}")
+    print(
+        f"  sends/s {result['sends_per_s']:.1f} (best second {result['peak_sends_per_s']})"
+        f"  peak in flight {result['peak_in_flight']}"
+        f"  connections {result['send_connections']}"
+    )
+    print(f"  converted {result['converted']}  calls/converted user {result['calls_per_converted']:.2f}  paid users in the bot's state {result['completed_users']}")
+    print(f"  timeouts {result['timeouts']}  http errors {result['http_errors']}")
+    if result["sends_to_blocked"] or result["sends_avoided"]:
+        print(f"  sends to blocked chats {result['sends_to_blocked']} (403)  avoided by the bot {result['sends_avoided']}")
+    if result["start_repeats"]:
+        print(
+            f"  repeated /starts {result['start_repeats']}  answered {result['start_repeat_replies']}"
+            "  suppressed by the bot " + (" ".join(f"{k}={v}" for k, v in sorted(result["start_suppressed"].items())) or "0")
+        )
+    if result["uploads"]:
+        uploads = result["uploads"]
+        print(f"  photo uploads {sum(uploads.values())} over {len(uploads)} bot(s) (max {max(uploads.values())} per bot)")
+    if result["linger"]:
+        print(
+            f"  remarketing expected {result['remarketing_expected']}  missing {result['remarketing_missing']}"
+            f"  duplicated {result['remarketing_duplicates']}  (replicas {result['replicas']})"
+            + (f"  in the crash window {result['remarketing_crash_window']}" if result["remarketing_crash_window"] else "")
+        )
+        if result["remarketing_steps"] > 1:
+            print(
+                "  sequence users reached per step " + " ".join(map(str, result["remarketing_per_step"]))
+                + f"  sent after payment {result['remarketing_after_paid']}"
+            )
+    if result["broadcast"]:
+        b = result["broadcast"]
+        status = b["status"]
+        print(
+            f"  broadcast {status.get('state')} in {b['elapsed']:.1f}s  audience {status.get('audience')}"
+            f"  bot: scanned={status.get('scanned')} sent={status.get('sent')} skipped={status.get('skipped')} blocked={status.get('blocked')} failed={status.get('failed')}"
+            f"  sends/s {status.get('sent', 0) / b['elapsed']:.1f}"
+        )
+        print(
+            f"  broadcast expected {b['expected']}  delivered {b['delivered']}  missing {b['missing']}"
+            f"  duplicated {b['duplicated']}  to paid users {b['to_paid']}  to blocked chats {b['to_blocked']} (403)"
+        )
+    if result["rss_kb"]:
+        series = result["rss_kb"]
+        print(
+            f"  rss MB start={series[0][1] / 1024:.1f} max={max(kb for _, kb in series) / 1024:.1f}"
+            f" end={series[-1][1] / 1024:.1f}  samples={len(series)}"
+        )
+
+
+def _check_run(result: dict) -> list:
+    """Invariants of a --restart-after or --replicas run; returns the ones violated. Every
+    conversion must survive as a paid user in the bot's state and, with --linger, every
+    unpaid user must get each remarketing step exactly once (after a SIGKILL, except those
+    answered within CRASH_WINDOW of it); a broadcast must reach each of them once."""
+    if not result["restart"] and result["replicas"] < 2:
+        return []
+    failed = []
+    if result["completed_users"] < result["converted"]:
+        failed.append(f"paid users lost {result['converted'] - result['completed_users']}")
+    # SIGKILL: /starts respondidos na janela da queda podem não ter chegado ao disco
+    missing = result["remarketing_missing"] - result["remarketing_crash_window"]
+    if result["linger"] and missing:
+        failed.append(f"remarketing missing {missing}")
+    if result["linger"] and result["remarketing_duplicates"]:
+        failed.append(f"remarketing duplicated {result['remarketing_duplicates']}")
+    broadcast = result["broadcast"]
+    if broadcast and (broadcast["missing"] or broadcast["duplicated"]):
+        failed.append(f"broadcast missing {broadcast['missing']} duplicated {broadcast['duplicated']}")
+    return failed
+
+
+def _parse_env(pairs) -> dict:
+    env = {}
+    for pair in pairs or ():
+        key, _, value = pair.partition("=")
+        env[key] = value
+    return env
+
+
+async def main_async(args) -> None:
+    base_env = _parse_env(args.env)
+    runs = [base_env]
+    if args.sweep:
+        key, _, values = args.sweep.partition("=")
+        runs = [{**base_env, key: value} for value in values.split(",")]
+    exceeded, failed = [], []
+    for env in runs:
+        if args.startup:
+            result = await startup_once(args, env)
+            result.update(max_import_ms=args.max_import_ms, max_ready_ms=args.max_ready_ms)
+            exceeded += _report_startup(result)
+            if args.json:
+                with open(args.json, "a") as fh:
+                    fh.write(json.dumps(result) + "\n")
+            continue
+        result = await run_once(args, env)
+        _report(result)
+        failed += _check_run(result)
+        if args.json:
+            with open(args.json, "a") as fh:
+                fh.write(json.dumps({k: v for k, v in result.items() if k != "latencies"}) + "\n")
+    if exceeded:
+        raise SystemExit("startup budget exceeded: " + "; ".join(exceeded))
+    if failed:
+        raise SystemExit("check failed: " + "; ".join(failed))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="synthetic sessions to run")
+    parser.add_argument("--rate", type=float, default=100.0, help="new sessions per second (0 = all at once)")
+    parser.add_argument("--conversion", type=float, default=0.3, help="share of sessions that pay")
+    parser.add_argument("--api-latency", type=float, default=20.0, help="simulated Bot API latency (ms)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="probability of a 429 RetryAfter per send")
+    parser.add_argument("--block-after-start", type=float, default=0.0, help="share of users that block the bot after seeing the offers")
+    parser.add_argument("--blocked", type=float, default=0.0, help="share of users that blocked the bot (403)")
+    parser.add_argument("--remarketing-delay", type=int, default=5, help="REMARKETING_DELAY_SECONDS for the bot")
+    parser.add_argument("--linger", type=float, default=0.0, help="seconds to keep running after the last session")
+    parser.add_argument("--timeout", type=float, default=60.0, help="per-step timeout (s)")
+    parser.add_argument("--health-interval", type=float, default=0.1, help="poll /health every N s during the run, for its p50/p99 (0 = off)")
+    parser.add_argument("--http-connections", type=int, default=50)
+    parser.add_argument("--replicas", type=int, default=1, help="run N bots in CLUSTER mode (webhook) on one state dir; exit 1 if remarketings are missing or duplicated")
+    parser.add_argument("--bots", type=int, default=1, help="serve N bots from one process (BOT_CATALOG_DIR)")
+    parser.add_argument("--assets", action="store_true", help="serve the images from ASSETS_DIR (uploaded by the bot)")
+    parser.add_argument("--startup", type=int, default=0, help="instead of sessions: N cold starts (import time, /livez, /health)")
+    parser.add_argument("--max-import-ms", type=float, default=0.0, help="--startup: exit 1 if the import p50 is above this")
+    parser.add_argument("--max-ready-ms", type=float, default=0.0, help="--startup: exit 1 if the ready p50 is above this")
+    parser.add_argument("--restart-after", type=float, default=0.0, help="stop script.py after N seconds and start it again; exit 1 if paid users or remarketings are lost")
+    parser.add_argument("--restart-signal", choices=("TERM", "KILL"), default="TERM", help="--restart-after: graceful drain or crash")
+    parser.add_argument("--soak", type=int, default=0, help="instead of sessions: N /start events into the state layer (memory)")
+    parser.add_argument("--soak-users", type=int, default=0, help="--soak: distinct user ids (default 2N, so some return)")
+    parser.add_argument("--soak-conversion", type=float, default=0.03, help="--soak: share of /starts that pay")
+    parser.add_argument("--soak-ttl", type=float, default=30.0, help="--soak: state TTL in seconds for the expiry passes")
+    parser.add_argument("--max-rss-growth-mb", type=float, default=0.0, help="--soak: exit 1 if RSS grows more after warm-up")
+    parser.add_argument("--markup-bench", type=int, default=0, help="instead of sessions: time N keyboard builds vs cached markups")
+    parser.add_argument("--start-repeats", type=int, default=0, help="extra /starts per user (impatient taps / spam)")
+    parser.add_argument("--start-repeat-interval", type=float, default=0.3, help="--start-repeats: seconds between them")
+    parser.add_argument("--broadcast", type=float, default=0.0, help="after the sessions: broadcast to the user base at N sends/s")
+    parser.add_argument("--broadcast-restart-after", type=float, default=0.0, help="--broadcast: restart script.py N seconds into it (--restart-signal)")
+    parser.add_argument("--sequence-steps", type=int, default=0, help="remarketing sequence of N steps, --remarketing-delay apart")
+    parser.add_argument("--kill-after", type=float, default=0.0, help="SIGKILL the first replica after N seconds")
+    parser.add_argument("--env", action="append", help="extra KEY=VALUE for script.py (repeatable)")
+    parser.add_argument("--sweep", help="KEY=v1,v2,... run once per value, e.g. CONCURRENT_UPDATES=1,8,64,256")
+    parser.add_argument("--json", help="append one JSON line per run to this file")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="show script.py output")
+    args = parser.parse_args()
+    if args.soak:
+        # Importa o script.py neste processo: uma execução só (sem --sweep)
+        exceeded = _report_soak(soak(args, _parse_env(args.env)), args.max_rss_growth_mb)
+        if exceeded:
+            raise SystemExit("soak budget exceeded: " + "; ".join(exceeded))
+        return
+    if args.markup_bench:
+        _report_markup_bench(markup_bench(args, _parse_env(args.env)), args.markup_bench)
+        return
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
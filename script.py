@@ -1,35 +1,71 @@
+import time
+
+_PROCESS_STARTED = time.perf_counter()  # startup report: the imports are timed from here
+
+import array
+import asyncio
+import atexit
+import bisect
+import contextlib
+import datetime as dt
+import functools
+import glob
+import gzip
+import hashlib
+import heapq
+import hmac
+import itertools
 import logging
+import logging.handlers
 import os
+import queue
+import random
+import re
+import signal
+import socket
+import sqlite3
+import sys
 import threading
-from urllib.parse import quote
+import zlib
+from collections import OrderedDict, deque
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit, urlunsplit
 import json
 
 from dotenv import load_dotenv
-from flask import Flask, request, render_template_string, jsonify
+from flask import Flask, Response, abort, request, jsonify
+from markupsafe import escape
 from telegram import (
     Update,
+    InputFile,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     WebAppInfo,
     KeyboardButton,
     ReplyKeyboardMarkup,
-    ReplyKeyboardRemove,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     ContextTypes,
     MessageHandler,
     filters,
     JobQueue,
 )
-from typing import Optional
+from telegram.request import BaseRequest, HTTPXRequest
+from typing import NamedTuple, Optional
+
+import httpx
 
 try:
-    # Optional dependency, only used if USE_NGROK=true
-    from pyngrok import ngrok
+    # Optional dependency: adds a brotli variant of the static pages
+    import brotli
 except Exception:  # pragma: no cover
-    ngrok = None  # type: ignore
+    brotli = None  # type: ignore
+
+_IMPORTS_DONE = time.perf_counter()
 
 
 # ----------------------
@@ -37,23 +73,145 @@ except Exception:  # pragma: no cover
 # ----------------------
 load_dotenv()
 
+
+def _env_flag(name: str, default: str = "false") -> bool:
+    return os.getenv(name, default).lower() in {"1", "true", "yes", "on"}
+
+
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
+BOT_NAME = os.getenv("BOT_NAME", "default").strip()  # label of the BOT_TOKEN bot in metrics/events
+# Multi-bot: one JSON catalog per bot (token + persona texts/links) served by this process
+BOT_CATALOG_DIR = os.getenv("BOT_CATALOG_DIR", "").strip()
 WEBAPP_BASE_URL = os.getenv("WEBAPP_BASE_URL", "http://localhost:8080").rstrip("/")
 PORT = int(os.getenv("PORT", "8080"))
-USE_NGROK = os.getenv("USE_NGROK", "false").lower() in {"1", "true", "yes", "on"}
+USE_NGROK = _env_flag("USE_NGROK")
 NGROK_AUTHTOKEN = os.getenv("NGROK_AUTHTOKEN", "").strip()
-
-if not BOT_TOKEN:
-    raise SystemExit("BOT_TOKEN is not set. Add it to .env")
+# Alternative Bot API server (self-hosted Bot API, or the local simulator in loadtest.py)
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "").rstrip("/")
+
+# Webhook mode: Telegram pushes updates to WEBHOOK_PATH on the same server/PORT as the mini app
+USE_WEBHOOK = _env_flag("USE_WEBHOOK")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")  # default: WEBAPP_BASE_URL
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "").strip()  # default: derived per bot token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_MAX_BODY_BYTES = 1024 * 1024
+# Mini app HTTP server: asgi (uvicorn on the bot's event loop) | waitress (threaded WSGI) | dev
+HTTP_SERVER = os.getenv("HTTP_SERVER", "asgi").lower()
+HTTP_THREADS = max(1, int(os.getenv("HTTP_THREADS", "16")))  # worker threads for the Flask routes
+HTTP_KEEPALIVE_SECONDS = int(os.getenv("HTTP_KEEPALIVE_SECONDS", "5"))
+HTTP_CONNECTION_LIMIT = int(os.getenv("HTTP_CONNECTION_LIMIT", "1000"))
+HTTP_BACKLOG = int(os.getenv("HTTP_BACKLOG", "2048"))
+HTTP_SHUTDOWN_TIMEOUT = float(os.getenv("HTTP_SHUTDOWN_TIMEOUT", "10"))
+# Payment provider postbacks (POST /pagamento/postback), signed with HMAC-SHA256 of the body
+PAYMENT_WEBHOOK_SECRET = os.getenv("PAYMENT_WEBHOOK_SECRET", "").strip()
+PAYMENT_SIGNATURE_HEADER = os.getenv("PAYMENT_SIGNATURE_HEADER", "X-Signature")
+# How many updates are processed at once (1 = sequential, PTB default). Above 1, updates are
+# partitioned by user over this many workers: one user's updates stay in order
+CONCURRENT_UPDATES = max(1, int(os.getenv("CONCURRENT_UPDATES", "1")))
+
+# User state (who paid / who has a pending remarketing), persisted across restarts
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite").lower()  # sqlite | redis
+STATE_DIR = os.getenv("STATE_DIR", "data")
+STATE_SHARDS = max(1, int(os.getenv("STATE_SHARDS", "8")))
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "100000"))
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "0.05"))
+# Memory budget per bot for user state: the LRU cache (~250 bytes a user, at most
+# STATE_CACHE_SIZE users) plus the ids of paid users (~4 bytes each); the cache shrinks first
+STATE_MEMORY_MB = float(os.getenv("STATE_MEMORY_MB", "64"))
+# Users who never paid and have nothing pending are forgotten after this many days without
+# activity (0 = keep forever); a later /start treats them as new visitors. They are also the
+# broadcast audience (and remarketed users who may /start again), hence off by default
+STATE_TTL_DAYS = float(os.getenv("STATE_TTL_DAYS", "0"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "bot")
+# Shutdown (SIGTERM): stop taking updates, let handlers/sends finish, drain HTTP, checkpoint.
+# Keep it below the platform's grace period before SIGKILL
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "15"))
+# Pending remarketings written at shutdown, loaded (once) at the next start instead of a store scan
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", os.path.join(STATE_DIR, "remarketing.snapshot"))
+
+# Clustered mode: several replicas (webhook mode) share the state backend. Remarketing
+# partitions (= state shards) are owned by one replica at a time through expiring leases
+CLUSTER = _env_flag("CLUSTER")
+CLUSTER_INSTANCE_ID = os.getenv("CLUSTER_INSTANCE_ID", "").strip() or f"{socket.gethostname()}-{os.getpid()}"
+CLUSTER_LEASE_SECONDS = float(os.getenv("CLUSTER_LEASE_SECONDS", "15"))
+CLUSTER_RESYNC_SECONDS = float(os.getenv("CLUSTER_RESYNC_SECONDS", "5"))
+# Media assets: images in ASSETS_DIR (<name>.jpg/.png/.webp) are uploaded once per bot token and
+# their file_ids cached by content hash; catalogs refer to them by name
+ASSETS_DIR = os.getenv("ASSETS_DIR", "assets")
+ASSET_CACHE_FILE = os.getenv("ASSET_CACHE_FILE", os.path.join(STATE_DIR, "assets.json"))
+ASSET_CHECK_CONCURRENCY = max(1, int(os.getenv("ASSET_CHECK_CONCURRENCY", "4")))  # getFile at startup
+# Cache-Control max-age (seconds) of the precomputed static pages
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "600"))
+
+# Funnel event stream: JSONL segments written by a background thread (see funnel_report.py)
+EVENT_LOG_DIR = os.getenv("EVENT_LOG_DIR", os.path.join(STATE_DIR, "events"))
+EVENT_LOG_BUFFER = max(1, int(os.getenv("EVENT_LOG_BUFFER", "100000")))  # ring buffer size (events)
+EVENT_LOG_SEGMENT_BYTES = int(os.getenv("EVENT_LOG_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+EVENT_LOG_FLUSH_INTERVAL = float(os.getenv("EVENT_LOG_FLUSH_INTERVAL", "0.2"))
+# Retention, applied on every rollover: keep at most this many segments (0 = no limit) and
+# delete the ones older than this many days (0 = keep)
+EVENT_LOG_MAX_SEGMENTS = int(os.getenv("EVENT_LOG_MAX_SEGMENTS", "64"))
+EVENT_LOG_MAX_AGE_DAYS = float(os.getenv("EVENT_LOG_MAX_AGE_DAYS", "0"))
+# Remarketing scheduler: one shared timer wakes up every tick and fires due users in batches
+REMARKETING_TICK_SECONDS = float(os.getenv("REMARKETING_TICK_SECONDS", "1.0"))
+REMARKETING_BATCH_SIZE = max(1, int(os.getenv("REMARKETING_BATCH_SIZE", "500")))
+# Each batch is sent as a wave: spread with jitter over the window, N sends in flight at most
+REMARKETING_CONCURRENCY = max(1, int(os.getenv("REMARKETING_CONCURRENCY", "20")))
+REMARKETING_WAVE_SECONDS = float(os.getenv("REMARKETING_WAVE_SECONDS", "10"))
+# Outbound sends (Telegram: ~30 msg/s per bot, ~1 msg/s per chat)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_PER_CHAT_RATE = float(os.getenv("SEND_PER_CHAT_RATE", "1"))
+SEND_PER_CHAT_BURST = float(os.getenv("SEND_PER_CHAT_BURST", "3"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+# Broadcasts (POST /broadcast with "Authorization: Bearer BROADCAST_TOKEN"; empty = disabled):
+# lowest send lane, paced at BROADCAST_RATE sends/s per bot, progress checkpointed in BROADCAST_DIR
+BROADCAST_TOKEN = os.getenv("BROADCAST_TOKEN", "")
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_CONCURRENCY = max(1, int(os.getenv("BROADCAST_CONCURRENCY", "20")))
+BROADCAST_PAGE_SIZE = max(1, int(os.getenv("BROADCAST_PAGE_SIZE", "500")))
+BROADCAST_DIR = os.getenv("BROADCAST_DIR", os.path.join(STATE_DIR, "broadcasts"))
+# /start admission (per bot and user): a repeat inside the debounce window sends nothing; above
+# START_ABUSE_LIMIT /starts in START_ABUSE_WINDOW seconds the user is shed (0 = off)
+START_DEBOUNCE_SECONDS = float(os.getenv("START_DEBOUNCE_SECONDS", "10"))
+START_ABUSE_LIMIT = int(os.getenv("START_ABUSE_LIMIT", "20"))
+START_ABUSE_WINDOW = float(os.getenv("START_ABUSE_WINDOW", "60"))
+
+# Bot API transport (httpx): sends share one keep-alive pool, getUpdates has its own connection.
+# HTTP/2 is negotiated over TLS (ALPN) and falls back to 1.1 (e.g. a plain-http local Bot API)
+# (self-hosted Bot API servers only speak HTTP/1.1)
+BOT_API_HTTP_VERSION = os.getenv("BOT_API_HTTP_VERSION", "1.1" if BOT_API_BASE_URL else "2")  # 2 | 1.1
+BOT_API_POOL_SIZE = max(1, int(os.getenv("BOT_API_POOL_SIZE", "64")))  # max requests in flight
+BOT_API_POOL_TIMEOUT = float(os.getenv("BOT_API_POOL_TIMEOUT", "5"))
+BOT_API_KEEPALIVE_EXPIRY = float(os.getenv("BOT_API_KEEPALIVE_EXPIRY", "60"))
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", "5"))
+BOT_API_READ_TIMEOUT = float(os.getenv("BOT_API_READ_TIMEOUT", "5"))
+BOT_API_WRITE_TIMEOUT = float(os.getenv("BOT_API_WRITE_TIMEOUT", "5"))
+
+if not BOT_TOKEN and not BOT_CATALOG_DIR:
+    raise SystemExit("BOT_TOKEN is not set. Add it to .env (or set BOT_CATALOG_DIR)")
+
+if CLUSTER and not USE_WEBHOOK:
+    raise SystemExit("CLUSTER=true needs USE_WEBHOOK=true (only one instance can poll getUpdates)")
 
 
 # ----------------------
 # Logging
 # ----------------------
+# Quem loga (handlers, threads do HTTP) só enfileira; a escrita no stdout fica numa thread própria
+_log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_output, respect_handler_level=True)
+_log_enqueue = logging.handlers.QueueHandler(_log_queue)
+_log_enqueue.setFormatter(logging.Formatter("%(message)s"))  # formatação final fica no listener
 logging.basicConfig(
     level=logging.INFO,  # Root em INFO para exibir nossos logs de início/fluxo
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+    handlers=[_log_enqueue],
 )
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger("bot")
 logger.setLevel(logging.INFO)
 
@@ -74,6 +232,344 @@ for name in (
         pass
 
 
+# ----------------------
+# Metrics (Prometheus)
+# ----------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metrics:
+    """Counters and histograms in Prometheus text format.
+
+    Every thread writes only to its own shard (plain dicts, no lock on the hot path);
+    ``render()`` merges the shards when /metrics is scraped. Gauges are callbacks
+    evaluated at scrape time.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (type, help)
+        self._gauges = {}  # name -> callable returning a number or {labels: number}
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        self._meta[name] = (kind, help_text)
+
+    def gauge(self, name: str, help_text: str, fn) -> None:
+        self.describe(name, "gauge", help_text)
+        self._gauges[name] = fn
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = ({}, {})  # (counters, histograms)
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: tuple = ()) -> None:
+        hists = self._shard()[1]
+        key = (name, labels)
+        h = hists.get(key)
+        if h is None:
+            # contagem por bucket (não cumulativa) + sum + count
+            h = hists[key] = [0] * (len(LATENCY_BUCKETS) + 3)
+        h[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        h[-2] += value
+        h[-1] += 1
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        body = ",".join(
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs
+        )
+        return "{" + body + "}"
+
+    def render(self) -> str:
+        counters, hists = {}, {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard_counters, shard_hists in shards:
+            for key, value in shard_counters.copy().items():
+                counters[key] = counters.get(key, 0) + value
+            for key, h in shard_hists.copy().items():
+                merged = hists.setdefault(key, [0] * len(h))
+                for i, v in enumerate(list(h)):
+                    merged[i] += v
+
+        lines = []
+        by_name = {}
+        for (name, labels), value in counters.items():
+            by_name.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), h in hists.items():
+            out = by_name.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), h):
+                cumulative += count
+                out.append(f"{name}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+            out.append(f"{name}_sum{self._labels(labels)} {h[-2]}")
+            out.append(f"{name}_count{self._labels(labels)} {h[-1]}")
+        for name, fn in self._gauges.items():
+            try:
+                value = fn()
+            except Exception:
+                continue
+            items = value.items() if isinstance(value, dict) else [((), value)]
+            by_name[name] = [f"{name}{self._labels(labels)} {v}" for labels, v in items]
+        for name in sorted(by_name):
+            kind, help_text = self._meta.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(by_name[name])
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "histogram", "Handler latency by handler.")
+metrics.describe("bot_api_request_seconds", "histogram", "Bot API call latency by bot and method.")
+metrics.describe("bot_api_errors_total", "counter", "Bot API errors by bot, method and code (429, 403, 400, network, other).")
+metrics.describe("bot_funnel_total", "counter", "Funnel events: start, webapp_open, paid (by bot, pkg and source).")
+
+
+def _timed(handler: str):
+    """Decorator: record the coroutine's latency in bot_handler_seconds{handler=...}."""
+    labels = (("handler", handler),)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                metrics.observe("bot_handler_seconds", time.perf_counter() - started, labels)
+
+        return wrapper
+
+    return decorator
+
+
+_FUNNEL_PKGS = {"pkg1", "pkg2", "pkg3", "combo"}
+
+
+def _funnel(bot: str, step: str, pkg=None, source: str = "direct", **fields) -> None:
+    """Count a funnel step of ``bot`` and append it to the event log (``fields`` go only to the log)."""
+    events.emit(step, bot=bot, pkg=pkg, source=source, **fields)
+    pkg = pkg if pkg in _FUNNEL_PKGS else ("none" if not pkg else "other")
+    metrics.inc("bot_funnel_total", (("bot", bot), ("step", step), ("pkg", pkg), ("source", source)))
+
+
+# ----------------------
+# Startup (phases / readiness)
+# ----------------------
+class Startup:
+    """Wall-clock duration of each startup phase, and whether the instance is ready.
+
+    /livez answers as soon as the HTTP server does; /health (readiness) only once ``ready``
+    is set, i.e. every bot is polling or has its webhook, and stops again at shutdown.
+    Independent phases run at the same time, so their durations overlap.
+    """
+
+    def __init__(self, started: float):
+        self.started = started
+        self.phases = {}  # name -> seconds, in the order they finished
+        self.failed = {}  # name -> error of a phase the instance cannot be ready without
+        self.warnings = {}  # name -> error of an optional phase (reported, readiness unaffected)
+        self.ready = False
+        self.stopping = False
+
+    def record(self, name: str, since: float) -> None:
+        self.phases[name] = round(time.perf_counter() - since, 4)
+
+    async def timed(self, name: str, awaitable):
+        since = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.record(name, since)
+
+    def report(self) -> str:
+        return " ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in self.phases.items())
+
+    def status(self) -> str:
+        if self.stopping:
+            return "stopping"
+        if self.failed:
+            return "degraded"
+        return "ok" if self.ready else "starting"
+
+
+startup = Startup(_PROCESS_STARTED)
+startup.phases["imports"] = round(_IMPORTS_DONE - _PROCESS_STARTED, 4)
+metrics.gauge(
+    "bot_startup_seconds",
+    "Duration of each startup phase (phases run in parallel; total = until ready).",
+    lambda: {(("phase", name),): seconds for name, seconds in startup.phases.items()},
+)
+metrics.gauge("bot_ready", "1 once every bot is serving updates (readiness, as /health).", lambda: int(startup.status() == "ok"))
+_draining = asyncio.Event()  # shutdown (_drain): webhooks 503, no new remarketing waves or broadcast pages
+
+
+# ----------------------
+# Event Log
+# ----------------------
+# Linhas legíveis que continuam saindo no log, agora escritas pela thread do EventLog
+_EVENT_LOG_LINES = {
+    "start": "START user_id={user_id} username={username} chat_id={chat_id} bot={bot}",
+    "paid": "PAID user_id={user_id} username={username} order_id={order_id} pkg={pkg} "
+    "amount={amount} currency={currency} via={via} bot={bot}",
+}
+
+
+class EventLog:
+    """Append-only funnel event stream.
+
+    ``emit()`` only appends a tuple to an in-memory ring buffer (no I/O, no serialization;
+    when the buffer is full the oldest event is dropped and counted). A background thread
+    drains it every ``flush_interval`` seconds: one JSON line per event into the current
+    segment (``events-<unix ms>.jsonl``, rolled over at ``segment_bytes``) and the START/PAID
+    lines into the logging pipeline. Each rollover prunes the oldest segments beyond
+    ``max_segments`` and those older than ``max_age`` seconds (0 = no limit).
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        capacity: int,
+        segment_bytes: int,
+        flush_interval: float,
+        max_segments: int = 0,
+        max_age: float = 0,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.max_age = max_age
+        self.flush_interval = flush_interval
+        self.capacity = capacity
+        self._buffer = deque(maxlen=capacity)
+        self.dropped = 0
+        self.written = 0
+        self.segments = 0
+        self.pruned = 0
+        self._file = None
+        self._file_size = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def emit(self, event: str, **fields) -> None:
+        # deque.append é atômico: serve ao loop do bot e às threads do HTTP sem lock
+        if len(self._buffer) == self.capacity:
+            self.dropped += 1
+        self._buffer.append((time.time(), event, fields))
+
+    def start(self) -> None:
+        if self._thread is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._thread = threading.Thread(target=self._run, name="event-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def _open_segment(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        path = os.path.join(self.directory, f"events-{int(time.time() * 1000):013d}.jsonl")
+        self._file = open(path, "a", encoding="utf-8")
+        self._file_size = self._file.tell()
+        self.segments += 1
+        self._prune(path)
+
+    def _prune(self, current: str) -> None:
+        # O nome leva o instante de criação: ordem do nome = ordem de idade
+        paths = [p for p in sorted(glob.glob(os.path.join(self.directory, "events-*.jsonl"))) if p != current]
+        excess = len(paths) + 1 - self.max_segments if self.max_segments else 0
+        now, removed = time.time(), 0
+        for i, path in enumerate(paths):
+            try:
+                age = now - os.path.getmtime(path)
+                # Escrito há menos de 1 min: segmento aberto de outra réplica no mesmo diretório
+                if (i < excess or (self.max_age and age > self.max_age)) and age > 60:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                continue  # já removido por outra réplica
+        if removed:
+            self.pruned += removed
+            logger.info("Event log: pruned %s old segment(s)", removed)
+
+    def flush(self) -> None:
+        batch = []
+        buffer = self._buffer
+        try:
+            while True:
+                batch.append(buffer.popleft())
+        except IndexError:
+            pass
+        if not batch:
+            return
+        lines = []
+        for ts, event, fields in batch:
+            record = {"ts": round(ts, 3), "event": event}
+            record.update((k, v) for k, v in fields.items() if v is not None)
+            lines.append(json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str))
+            template = _EVENT_LOG_LINES.get(event)
+            if template:
+                logger.info(template.format_map(_MissingAsNone(fields)))
+        chunk = "\n".join(lines) + "\n"
+        try:
+            if self._file is None or self._file_size >= self.segment_bytes:
+                self._open_segment()
+            self._file.write(chunk)
+            self._file.flush()
+            self._file_size += len(chunk)
+        except OSError as e:
+            logger.warning("Event log write failed (%s events lost): %s", len(batch), e)
+            return
+        self.written += len(batch)
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        else:
+            self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _MissingAsNone(dict):
+    def __missing__(self, key):
+        return None
+
+
+events = EventLog(
+    EVENT_LOG_DIR,
+    EVENT_LOG_BUFFER,
+    EVENT_LOG_SEGMENT_BYTES,
+    EVENT_LOG_FLUSH_INTERVAL,
+    EVENT_LOG_MAX_SEGMENTS,
+    EVENT_LOG_MAX_AGE_DAYS * 86400,
+)
+metrics.gauge("bot_events_written", "Funnel events written to the event log.", lambda: events.written)
+metrics.gauge("bot_events_dropped", "Funnel events dropped because the ring buffer was full.", lambda: events.dropped)
+
+
 # ----------------------
 # Flask Mini App
 # ----------------------
@@ -114,8 +610,20 @@ WEBAPP_HTML = """
           try { localStorage.setItem('selected_pkg', pkg); } catch(e) {}
         }
         if (target) {
+          // O target já traz utm_content=tg<id> (inserido no botão pelo bot): link e redirect
+          // usam a mesma URL. Botões antigos, sem ele, ainda pegam o id do initData
+          let dest = target;
+          try {
+            const u = new URL(target);
+            const uid = window.Telegram?.WebApp?.initDataUnsafe?.user?.id;
+            if (!u.searchParams.get('utm_content') && uid) {
+              u.searchParams.set('utm_content', 'tg' + uid);
+              dest = u.toString();
+              document.getElementById('openBtn').href = dest;
+            }
+          } catch(e) {}
           // Navega dentro do próprio webview para manter a experiência de mini app
-          try { window.location.replace(target); } catch(e) { window.location.href = target; }
+          try { window.location.replace(dest); } catch(e) { window.location.href = dest; }
         }
       })();
     </script>
@@ -124,15 +632,60 @@ WEBAPP_HTML = """
 """
 
 
+# Template "compilado" uma vez: só o target (escapado) é inserido entre as duas partes
+_WEBAPP_HEAD, _WEBAPP_TAIL = WEBAPP_HTML.split("{{ target }}")
+
+
+def _route_tenant(bot: Optional[str]) -> "Tenant":
+    """Bot of a mini app route: ``/<bot>/…`` for catalog bots, unprefixed for BOT_TOKEN's."""
+    tenant = _tenant_routes.get(bot)
+    if tenant is None:
+        abort(404)
+    return tenant
+
+
+_WEBAPP_SOURCES = frozenset(("direct", "remarketing", "broadcast"))
+
+
 @app.get("/webapp")
-def webapp_page():
+@app.get("/<bot>/webapp")
+def webapp_page(bot: Optional[str] = None):
+    tenant = _route_tenant(bot)
     target = request.args.get("target", "")
-    return render_template_string(WEBAPP_HTML, target=target)
+    pkg = request.args.get("pkg")
+    # ?src= vem do botão que abriu o mini app (início, remarketing ou broadcast)
+    source = request.args.get("src")
+    _funnel(tenant.name, "webapp_open", pkg, source if source in _WEBAPP_SOURCES else "direct")
+    return Response(_WEBAPP_HEAD + str(escape(target)) + _WEBAPP_TAIL, mimetype="text/html")
+
+
+@app.get("/livez")
+def livez():
+    # Liveness: o processo responde HTTP (mesmo antes dos bots estarem prontos)
+    return jsonify(status="ok"), 200
 
 
 @app.get("/health")
 def health():
-    return jsonify(status="ok"), 200
+    # Readiness: 503 until every bot serves updates, and again once shutdown begins
+    status = startup.status()
+    body = {"status": status, "startup": startup.phases}
+    if startup.failed:
+        body["failed"] = startup.failed
+    if startup.warnings:
+        body["warnings"] = startup.warnings
+    if BOT_CATALOG_DIR:
+        body["bots"] = {t.name: {"sends": t.limiter.stats()} for t in tenants}
+    else:
+        body["sends"] = tenants[0].limiter.stats()
+    if cluster is not None:
+        body["cluster"] = {"instance": cluster.instance_id, "members": cluster.members, "partitions": sorted(cluster.owned)}
+    return jsonify(body), 200 if status == "ok" else 503
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 WEBAPP_SUCCESS_HTML = """
@@ -205,16 +758,1721 @@ WEBAPP_SUCCESS_HTML = """
 """
 
 
+class _StaticPage(NamedTuple):
+    etag: str  # hash of the body, without quotes; each encoding gets its own strong ETag
+    identity: bytes
+    gzip: bytes
+    br: Optional[bytes]
+
+
+def _precompute_page(html: str) -> _StaticPage:
+    body = html.encode("utf-8")
+    return _StaticPage(
+        etag=hashlib.sha256(body).hexdigest()[:32],
+        identity=body,
+        gzip=gzip.compress(body, compresslevel=9, mtime=0),
+        br=brotli.compress(body) if brotli is not None else None,
+    )
+
+
+def _static_response(page: _StaticPage) -> Response:
+    """Serve precomputed bytes in the best encoding, or 304 on a matching If-None-Match.
+    The ETag is ``<hash>``, ``<hash>-gz`` or ``<hash>-br``: byte-different representations
+    must not share a strong ETag."""
+    encodings = request.accept_encodings
+    if page.br is not None and encodings["br"]:
+        body, encoding, etag = page.br, "br", f"{page.etag}-br"
+    elif encodings["gzip"]:
+        body, encoding, etag = page.gzip, "gzip", f"{page.etag}-gz"
+    else:
+        body, encoding, etag = page.identity, None, page.etag
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={STATIC_MAX_AGE}",
+        "Vary": "Accept-Encoding",
+    }
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(body, mimetype="text/html", headers=headers)
+
+
+# Sem variáveis de template: a página é servida a partir de bytes pré-calculados
+_SUCCESS_PAGE = _precompute_page(WEBAPP_SUCCESS_HTML)
+
+
 @app.get("/pagamento-aprovado")
-def pagamento_aprovado():
-    return render_template_string(WEBAPP_SUCCESS_HTML)
+@app.get("/<bot>/pagamento-aprovado")
+def pagamento_aprovado(bot: Optional[str] = None):
+    # A página só chama sendData: o web_app_data chega ao bot que abriu o mini app
+    _route_tenant(bot)
+    return _static_response(_SUCCESS_PAGE)
+
+
+_APPROVED_STATUSES = {"approved", "paid", "aprovado", "pago"}
+_TG_USER_RE = re.compile(r"^(?:tg)?(\d+)$")
+
+
+def _postback_user_id(payload: dict) -> Optional[int]:
+    """Telegram user id from the postback: tg_user_id/metadata, or the utm_content=tg<id>
+    that /webapp adds to the checkout URL. Raises ValueError when metadata/tracking is not
+    an object."""
+    nested = {}
+    for key in ("metadata", "tracking"):
+        value = payload.get(key)
+        if value is not None and not isinstance(value, dict):
+            raise ValueError(f"{key} must be an object")
+        nested[key] = value or {}
+    candidates = [
+        payload.get("tg_user_id"),
+        nested["metadata"].get("tg_user_id"),
+        nested["tracking"].get("utm_content"),
+        payload.get("utm_content"),
+    ]
+    for value in candidates:
+        if not isinstance(value, (str, int)):
+            continue
+        match = _TG_USER_RE.match(str(value).strip())
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def _record_payment(tenant: "Tenant", user_id, chat_id, order_id) -> tuple:
+    """Persist a confirmed payment; blocking, call it off the event loop. The user is
+    written as paid straight to the backend first and only then ``order_id`` is claimed,
+    so a crash in between costs a (idempotent) retry from the provider, never the payment.
+    Returns ``(claimed, state before the payment)``."""
+    prior = tenant.store.complete(user_id, chat_id) if user_id else None
+    claimed = not order_id or tenant.store.claim_order(str(order_id), user_id)
+    return claimed, prior
+
+
+@app.post("/pagamento/postback")
+@app.post("/<bot>/pagamento/postback")
+def pagamento_postback(bot: Optional[str] = None):
+    """Server-side confirmation from the payment provider (TriboPay links)."""
+    tenant = _route_tenant(bot)
+    if not tenant.payment_secret:
+        return jsonify(error="postback disabled"), 404
+    raw = request.get_data(cache=True)
+    signature = request.headers.get(PAYMENT_SIGNATURE_HEADER, "").strip().removeprefix("sha256=")
+    expected = hmac.new(tenant.payment_secret.encode(), raw, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(signature.lower(), expected):
+        return jsonify(error="invalid signature"), 401
+    payload = request.get_json(silent=True) or request.form.to_dict()
+    if not isinstance(payload, dict):
+        return jsonify(error="malformed payload"), 400
+    order_id = payload.get("order_id") or payload.get("transaction_id") or payload.get("id") or ""
+    status = payload.get("status", "")
+    if not isinstance(order_id, (str, int)) or not isinstance(status, str):
+        return jsonify(error="malformed payload"), 400
+    order_id = str(order_id).strip()
+    if not order_id:
+        return jsonify(error="missing order_id"), 400
+    if status.lower() not in _APPROVED_STATUSES:
+        return jsonify(status="ignored"), 200
+    try:
+        user_id = _postback_user_id(payload)
+    except ValueError as e:
+        return jsonify(error="malformed payload", reason=str(e)), 400
+    if user_id is None:
+        logger.warning("Postback order_id=%s without Telegram user id", order_id)
+        return jsonify(status="ignored", reason="unknown user"), 200
+    if _bot_loop is None or tenant.application is None or not tenant.application.running:
+        # Bot ainda não está rodando: o provedor vai reenviar
+        return jsonify(error="not ready"), 503
+    try:
+        claimed, prior = _record_payment(tenant, user_id, None, order_id)
+    except Exception:
+        logger.exception("Failed to record postback order_id=%s", order_id)
+        return jsonify(error="state unavailable"), 503
+    if not claimed:
+        return jsonify(status="duplicate"), 200
+    # Não bloqueia a resposta HTTP: o resto acontece no event loop do bot
+    pkg = payload.get("pkg")
+    asyncio.run_coroutine_threadsafe(
+        _complete_payment(
+            tenant, user_id, None, order_id, "postback", pkg if isinstance(pkg, str) else None, prior,
+            amount=payload.get("amount"), currency=payload.get("currency"),
+        ),
+        _bot_loop,
+    )
+    return jsonify(status="ok"), 200
+
+
+@app.route("/broadcast", methods=["GET", "POST", "DELETE"])
+@app.route("/<bot>/broadcast", methods=["GET", "POST", "DELETE"])
+def broadcast_endpoint(bot: Optional[str] = None):
+    """Broadcast of a bot: POST starts (or resumes, same id) one, GET shows progress, DELETE pauses."""
+    tenant = _route_tenant(bot)
+    if not BROADCAST_TOKEN:
+        return jsonify(error="broadcast disabled"), 404
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(token.encode(), BROADCAST_TOKEN.encode()):
+        return jsonify(error="unauthorized"), 401
+    current = tenant.broadcast
+    if request.method == "GET":
+        return (jsonify(current.status()), 200) if current is not None else (jsonify(error="no broadcast"), 404)
+    if request.method == "DELETE":
+        if current is None or not current.running:
+            return jsonify(error="no broadcast running"), 404
+        _bot_loop.call_soon_threadsafe(current.pause)
+        return jsonify(status="pausing", id=current.id), 202
+    spec = request.get_json(silent=True) or {}
+    spec.setdefault("id", time.strftime("%Y%m%d-%H%M%S"))
+    if not _BROADCAST_ID_RE.match(str(spec["id"])):
+        return jsonify(error="id must match [A-Za-z0-9_-]{1,64}"), 400
+    try:
+        for key, kind in (("rate", float), ("concurrency", int)):
+            if spec.get(key) is not None:
+                spec[key] = kind(spec[key])
+                if spec[key] <= 0:
+                    raise ValueError(key)
+    except (TypeError, ValueError):
+        return jsonify(error="rate and concurrency must be positive numbers"), 400
+    if _bot_loop is None or not startup.ready or _draining.is_set():
+        return jsonify(error="not ready"), 503
+    status, body = asyncio.run_coroutine_threadsafe(_start_broadcast(tenant, spec), _bot_loop).result(timeout=30)
+    return jsonify(body), status
 
 
 def run_flask():
-    # Development server (suitable for local testing). Use a proper WSGI server for production.
+    # Development server (HTTP_SERVER=dev, local testing only)
     app.run(host="0.0.0.0", port=PORT, debug=False)
 
 
+_waitress_server = None
+
+
+def run_waitress():
+    # HTTP_SERVER=waitress: servidor WSGI de produção, multi-thread, numa thread própria
+    global _waitress_server
+    from waitress.server import create_server
+
+    _waitress_server = create_server(
+        app,
+        host="0.0.0.0",
+        port=PORT,
+        threads=HTTP_THREADS,
+        connection_limit=HTTP_CONNECTION_LIMIT,
+        channel_timeout=max(HTTP_KEEPALIVE_SECONDS, 1),
+        backlog=HTTP_BACKLOG,
+    )
+    _waitress_server.run()
+
+
+def _drain_waitress(timeout: float) -> None:
+    """Close waitress' listening socket, then wait up to ``timeout`` for the requests it is
+    handling to be answered before stopping its threads. Blocking."""
+    server = _waitress_server
+    server.close()
+    dispatcher = server.task_dispatcher
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        channels = list(server.active_channels.values())
+        if not (dispatcher.active_count or dispatcher.queue or any(c.requests or c.total_outbufs_len for c in channels)):
+            break
+        time.sleep(0.05)
+    dispatcher.shutdown(cancel_pending=True, timeout=max(0.0, deadline - time.monotonic()))
+
+
+# ----------------------
+# User State Store
+# ----------------------
+USER_COMPLETED = 1  # flag bit: payment approved, never remarket again
+USER_REMARKETED = 2  # flag bit: remarketing already sent (funnel attribution)
+USER_UNREACHABLE = 4  # flag bit: blocked the bot / account deleted; nothing is sent until a new /start
+# Flags that never go away: a backend write keeps them even if the row written is older (in
+# clustered mode another replica's buffered /start can land after this replica's payment)
+_STICKY_FLAGS = USER_COMPLETED | USER_REMARKETED
+
+
+class UserState(NamedTuple):
+    chat_id: int
+    flags: int = 0
+    remarketing_at: Optional[int] = None  # epoch seconds of the pending remarketing, if any
+    step: int = 0  # remarketing sequence step due at remarketing_at (= steps already sent)
+
+
+def _shard_of(user_id: int, shards: int) -> int:
+    # Estável entre processos/réplicas (hash() de str muda por processo)
+    return zlib.crc32(str(user_id).encode()) % shards
+
+
+class SQLiteStateBackend:
+    """One SQLite file per shard, WAL mode, so writers of different shards never contend."""
+
+    def __init__(self, directory: str, shards: int):
+        os.makedirs(directory, exist_ok=True)
+        self.shards = shards
+        self._conns = [self._connect(os.path.join(directory, f"users-{i:02d}.db")) for i in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+
+    @staticmethod
+    def _connect(path: str) -> sqlite3.Connection:
+        # timeout: em modo cluster outras réplicas escrevem nos mesmos arquivos
+        conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " user_id INTEGER PRIMARY KEY,"
+            " chat_id INTEGER NOT NULL,"
+            " flags INTEGER NOT NULL DEFAULT 0,"
+            " remarketing_at INTEGER,"
+            " updated_at INTEGER NOT NULL,"
+            " step INTEGER NOT NULL DEFAULT 0)"
+        )
+        if "step" not in {row[1] for row in conn.execute("PRAGMA table_info(users)")}:
+            # Arquivo de antes das sequências; outra réplica pode ter acabado de migrar
+            with contextlib.suppress(sqlite3.OperationalError):
+                conn.execute("ALTER TABLE users ADD COLUMN step INTEGER NOT NULL DEFAULT 0")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS users_remarketing_at ON users(remarketing_at)"
+            " WHERE remarketing_at IS NOT NULL"
+        )
+        # Índice de idempotência dos pagamentos (um registro por order_id)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS payments ("
+            " order_id TEXT PRIMARY KEY,"
+            " user_id INTEGER,"
+            " created_at INTEGER NOT NULL)"
+        )
+        # Modo cluster (usadas só no shard 0): réplicas vivas e donos das partições
+        conn.execute("CREATE TABLE IF NOT EXISTS cluster_members (instance TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cluster_leases ("
+            " partition INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        return conn
+
+    def _write(self, shard: int, statements) -> list:
+        """Run ``(sql, params)`` pairs in one transaction; returns each rowcount."""
+        with self._locks[shard]:
+            conn = self._conns[shard]
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                counts = [conn.execute(sql, params).rowcount for sql, params in statements]
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return counts
+
+    def get(self, user_id: int) -> Optional[UserState]:
+        shard = _shard_of(user_id, self.shards)
+        with self._locks[shard]:
+            row = self._conns[shard].execute(
+                "SELECT chat_id, flags, remarketing_at, step FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return UserState(*row) if row else None
+
+    def iter_pending(self, shards=None, until: Optional[int] = None):
+        """Yield (user_id, remarketing_at) for every user with a pending remarketing
+        (only in ``shards`` and due at or before ``until``, when given)."""
+        for shard in range(self.shards) if shards is None else shards:
+            with self._locks[shard]:
+                rows = self._conns[shard].execute(
+                    "SELECT user_id, remarketing_at FROM users WHERE remarketing_at IS NOT NULL"
+                    " AND remarketing_at <= ?",
+                    (until if until is not None else 2**62,),
+                ).fetchall()
+            yield from rows
+
+    def claim_remarketings(self, items) -> list:
+        """Atomically take the due remarketings in ``items`` ((user_id, due_at, step, next_at)):
+        only rows still pending at that exact time and step and not paid are claimed. A
+        claimed row moves on to ``step + 1``, due at ``next_at`` (None = sequence over), with
+        USER_REMARKETED set. Returns the claimed user ids; any other replica loses."""
+        by_shard = {}
+        for item in items:
+            by_shard.setdefault(_shard_of(item[0], self.shards), []).append(item)
+        claimed = []
+        now = int(time.time())
+        for shard, batch in by_shard.items():
+            counts = self._write(
+                shard,
+                [
+                    (
+                        "UPDATE users SET remarketing_at = ?, step = step + 1, flags = flags | ?, updated_at = ?"
+                        " WHERE user_id = ? AND remarketing_at = ? AND step = ? AND flags & ? = 0",
+                        (next_at, USER_REMARKETED, now, user_id, due_at, step, USER_COMPLETED),
+                    )
+                    for user_id, due_at, step, next_at in batch
+                ],
+            )
+            claimed.extend(item[0] for item, n in zip(batch, counts) if n == 1)
+        return claimed
+
+    def heartbeat(self, instance: str, ttl: float) -> int:
+        """Register ``instance`` as alive for ``ttl`` seconds; returns the live member count."""
+        now = time.time()
+        self._write(
+            0,
+            [
+                ("DELETE FROM cluster_members WHERE expires_at < ?", (now,)),
+                ("INSERT OR REPLACE INTO cluster_members (instance, expires_at) VALUES (?, ?)", (instance, now + ttl)),
+            ],
+        )
+        with self._locks[0]:
+            return self._conns[0].execute("SELECT COUNT(*) FROM cluster_members").fetchone()[0]
+
+    def leave(self, instance: str) -> None:
+        self._write(0, [("DELETE FROM cluster_members WHERE instance = ?", (instance,))])
+
+    def acquire_lease(self, partition: int, owner: str, ttl: float) -> bool:
+        """Take or renew ``partition`` unless another owner holds an unexpired lease."""
+        now = time.time()
+        (count,) = self._write(
+            0,
+            [
+                (
+                    "INSERT INTO cluster_leases (partition, owner, expires_at) VALUES (?, ?, ?)"
+                    " ON CONFLICT(partition) DO UPDATE SET owner = excluded.owner,"
+                    " expires_at = excluded.expires_at"
+                    " WHERE cluster_leases.owner = excluded.owner OR cluster_leases.expires_at < ?",
+                    (partition, owner, now + ttl, now),
+                )
+            ],
+        )
+        return count == 1
+
+    def release_lease(self, partition: int, owner: str) -> None:
+        self._write(0, [("DELETE FROM cluster_leases WHERE partition = ? AND owner = ?", (partition, owner))])
+
+    def count_completed(self) -> int:
+        total = 0
+        for shard in range(self.shards):
+            with self._locks[shard]:
+                total += self._conns[shard].execute(
+                    "SELECT COUNT(*) FROM users WHERE flags & ?", (USER_COMPLETED,)
+                ).fetchone()[0]
+        return total
+
+    def claim_order(self, order_id: str, user_id: Optional[int]) -> bool:
+        """Record ``order_id``; False if it was already recorded (duplicate delivery)."""
+        shard = zlib.crc32(order_id.encode()) % self.shards
+        with self._locks[shard]:
+            cur = self._conns[shard].execute(
+                "INSERT OR IGNORE INTO payments (order_id, user_id, created_at) VALUES (?, ?, ?)",
+                (order_id, user_id, int(time.time())),
+            )
+        return cur.rowcount == 1
+
+    def put_many(self, items) -> None:
+        by_shard = {}
+        now = int(time.time())
+        for user_id, st in items:
+            by_shard.setdefault(_shard_of(user_id, self.shards), []).append(
+                (user_id, st.chat_id, st.flags, st.remarketing_at, now, st.step)
+            )
+        for shard, rows in by_shard.items():
+            with self._locks[shard]:
+                conn = self._conns[shard]
+                conn.execute("BEGIN")
+                try:
+                    conn.executemany(
+                        "INSERT INTO users (user_id, chat_id, flags, remarketing_at, updated_at, step)"
+                        " VALUES (?, ?, ?, ?, ?, ?)"
+                        " ON CONFLICT(user_id) DO UPDATE SET chat_id = excluded.chat_id,"
+                        f" flags = excluded.flags | (users.flags & {_STICKY_FLAGS}),"
+                        f" remarketing_at = CASE WHEN users.flags & {USER_COMPLETED} THEN NULL"
+                        " ELSE excluded.remarketing_at END,"
+                        " updated_at = excluded.updated_at, step = excluded.step",
+                        rows,
+                    )
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+
+    def audience_page(self, cursor, limit: int, exclude_flags: int) -> tuple:
+        """Up to ``limit`` (user_id, chat_id) of users with none of ``exclude_flags``, in
+        shard then user id order, after ``cursor`` ([shard, last user_id]; None = start).
+        Returns (rows, next cursor); the next cursor is None once every shard is read."""
+        shard, after = cursor or (0, 0)
+        rows = []
+        while shard < self.shards and len(rows) < limit:
+            with self._locks[shard]:
+                page = self._conns[shard].execute(
+                    "SELECT user_id, chat_id FROM users WHERE user_id > ? AND flags & ? = 0 ORDER BY user_id LIMIT ?",
+                    (after, exclude_flags, limit - len(rows)),
+                ).fetchall()
+            rows.extend(page)
+            if len(rows) < limit:
+                shard, after = shard + 1, 0
+            else:
+                after = page[-1][0]
+        return rows, [shard, after] if shard < self.shards else None
+
+    def count_audience(self, exclude_flags: int) -> Optional[int]:
+        total = 0
+        for shard in range(self.shards):
+            with self._locks[shard]:
+                total += self._conns[shard].execute(
+                    "SELECT COUNT(*) FROM users WHERE flags & ? = 0", (exclude_flags,)
+                ).fetchone()[0]
+        return total
+
+    def expire(self, before: int) -> int:
+        """Delete users who never paid, have nothing pending and were last written before
+        ``before``; returns how many. One statement per shard, so each file is locked only
+        for its own scan."""
+        return sum(
+            self._write(
+                shard,
+                [
+                    (
+                        "DELETE FROM users WHERE updated_at < ? AND flags & ? = 0 AND remarketing_at IS NULL",
+                        (before, USER_COMPLETED),
+                    )
+                ],
+            )[0]
+            for shard in range(self.shards)
+        )
+
+    def close(self) -> None:
+        for lock, conn in zip(self._locks, self._conns):
+            with lock:
+                conn.close()
+
+
+class RedisStateBackend:
+    """Redis-protocol backend: one compact string value per user, hash-tagged by shard.
+
+    Pending remarketings are also indexed in one sorted set per shard (score = due time).
+    Paid users are also kept in one set per shard, for counting. With ``ttl``, users who
+    never paid and have nothing pending are written with that expiry (Redis drops them).
+    ``client`` only needs ``get``, ``mget``, ``scan``, ``set(nx=True)``, ``scard``,
+    ``zscan_iter``, ``zrangebyscore``, ``eval``, ``zadd``, ``zrem``, ``zremrangebyscore``,
+    ``zcard``, ``pipeline().eval()/execute()`` and ``close`` so any
+    Redis-protocol server (or an in-process stand-in: the tests use fakeredis) can be
+    plugged in.
+    """
+
+    # Claim: só se ainda estiver pendente com o mesmo horário e passo (ARGV[4]) e o usuário
+    # não tiver pago; o valor passa a "chat:flags|REMARKETED:ARGV[5]:passo+1" na mesma
+    # operação. Com próximo passo (ARGV[5]) volta ao sorted set; sem, expira em ARGV[3]
+    # segundos, se houver TTL
+    _CLAIM = (
+        "local s = redis.call('ZSCORE', KEYS[1], ARGV[1]) "
+        "if (not s) or tonumber(s) ~= tonumber(ARGV[2]) then return 0 end "
+        "local v = redis.call('GET', KEYS[2]) "
+        "if not v then redis.call('ZREM', KEYS[1], ARGV[1]) return 0 end "
+        "local chat, flags, step = string.match(v, '^(-?%d+):(%d+):%d*:?(%d*)$') "
+        "flags, step = tonumber(flags), tonumber(step) or 0 "
+        "if step ~= tonumber(ARGV[4]) then return 0 end "
+        "redis.call('ZREM', KEYS[1], ARGV[1]) "
+        "if flags % 2 == 1 then return 0 end "
+        "if flags % 4 < 2 then flags = flags + 2 end "
+        "local value = chat .. ':' .. flags .. ':' .. ARGV[5] .. ':' .. (step + 1) "
+        "if ARGV[5] ~= '' then "
+        "redis.call('ZADD', KEYS[1], ARGV[5], ARGV[1]) redis.call('SET', KEYS[2], value) "
+        "elseif tonumber(ARGV[3]) > 0 then redis.call('SET', KEYS[2], value, 'EX', ARGV[3]) "
+        "else redis.call('SET', KEYS[2], value) end "
+        "return 1"
+    )
+    # Escrita de um usuário: COMPLETED/REMARKETED já gravados ficam (ver _STICKY_FLAGS); pago
+    # não tem pendência. Mantém o sorted set de pendentes, o set de pagos e o TTL (ARGV[6])
+    _PUT = (
+        "local flags, due = tonumber(ARGV[3]), ARGV[4] "
+        "local old = redis.call('GET', KEYS[1]) "
+        "if old then "
+        "local was = tonumber(string.match(old, '^-?%d+:(%d+):')) "
+        "if was % 2 == 1 and flags % 2 == 0 then flags = flags + 1 end "
+        "if was % 4 >= 2 and flags % 4 < 2 then flags = flags + 2 end "
+        "end "
+        "if flags % 2 == 1 then due = '' redis.call('SADD', KEYS[3], ARGV[1]) end "
+        "local value = ARGV[2] .. ':' .. flags .. ':' .. due .. ':' .. ARGV[5] "
+        "if due == '' then redis.call('ZREM', KEYS[2], ARGV[1]) else redis.call('ZADD', KEYS[2], due, ARGV[1]) end "
+        "if due == '' and flags % 2 == 0 and tonumber(ARGV[6]) > 0 then "
+        "redis.call('SET', KEYS[1], value, 'EX', ARGV[6]) "
+        "else redis.call('SET', KEYS[1], value) end "
+        "return 1"
+    )
+    _ACQUIRE = (
+        "local cur = redis.call('GET', KEYS[1]) "
+        "if (not cur) or cur == ARGV[1] then "
+        "redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2]) return 1 end "
+        "return 0"
+    )
+    _RELEASE = "if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end return 0"
+
+    def __init__(self, client, shards: int, prefix: str = "bot", ttl: int = 0):
+        self.shards = shards
+        self._client = client
+        self._prefix = prefix
+        self._ttl = ttl
+
+    def _key(self, user_id: int) -> str:
+        # {shard} = hash tag: todos os usuários de um shard no mesmo slot do Redis Cluster
+        return f"{self._prefix}:u:{{{_shard_of(user_id, self.shards)}}}:{user_id}"
+
+    def _pending_key(self, shard: int) -> str:
+        return f"{self._prefix}:r:{{{shard}}}"
+
+    @staticmethod
+    def _encode(st: UserState) -> str:
+        return f"{st.chat_id}:{st.flags}:{'' if st.remarketing_at is None else st.remarketing_at}:{st.step}"
+
+    @staticmethod
+    def _decode(raw) -> UserState:
+        # "chat:flags:remarketing_at[:step]" (valores de antes das sequências não têm o passo)
+        if isinstance(raw, bytes):
+            raw = raw.decode()
+        chat_id, flags, remarketing_at, *step = raw.split(":")
+        return UserState(
+            int(chat_id), int(flags), int(remarketing_at) if remarketing_at else None, int(step[0]) if step else 0
+        )
+
+    def get(self, user_id: int) -> Optional[UserState]:
+        raw = self._client.get(self._key(user_id))
+        return self._decode(raw) if raw is not None else None
+
+    def iter_pending(self, shards=None, until: Optional[int] = None):
+        for shard in range(self.shards) if shards is None else shards:
+            if until is None:
+                items = self._client.zscan_iter(self._pending_key(shard))
+            else:
+                items = self._client.zrangebyscore(self._pending_key(shard), "-inf", until, withscores=True)
+            for member, score in items:
+                yield int(member), int(score)
+
+    def claim_remarketings(self, items) -> list:
+        claimed = []
+        for user_id, due_at, step, next_at in items:
+            shard = _shard_of(user_id, self.shards)
+            if self._client.eval(
+                self._CLAIM, 2, self._pending_key(shard), self._key(user_id), user_id, due_at, self._ttl,
+                step, "" if next_at is None else next_at,
+            ):
+                claimed.append(user_id)
+        return claimed
+
+    def heartbeat(self, instance: str, ttl: float) -> int:
+        key, now = f"{self._prefix}:members", time.time()
+        self._client.zremrangebyscore(key, "-inf", now)
+        self._client.zadd(key, {instance: now + ttl})
+        return self._client.zcard(key)
+
+    def leave(self, instance: str) -> None:
+        self._client.zrem(f"{self._prefix}:members", instance)
+
+    def acquire_lease(self, partition: int, owner: str, ttl: float) -> bool:
+        key = f"{self._prefix}:lease:{partition}"
+        return bool(self._client.eval(self._ACQUIRE, 1, key, owner, int(ttl * 1000)))
+
+    def release_lease(self, partition: int, owner: str) -> None:
+        self._client.eval(self._RELEASE, 1, f"{self._prefix}:lease:{partition}", owner)
+
+    def count_completed(self) -> int:
+        return sum(self._client.scard(f"{self._prefix}:c:{{{shard}}}") for shard in range(self.shards))
+
+    def claim_order(self, order_id: str, user_id: Optional[int]) -> bool:
+        shard = zlib.crc32(order_id.encode()) % self.shards
+        return bool(self._client.set(f"{self._prefix}:p:{{{shard}}}:{order_id}", user_id or 0, nx=True))
+
+    def audience_page(self, cursor, limit: int, exclude_flags: int) -> tuple:
+        # Cursor = [shard, cursor do SCAN]: o SCAN garante cada chave presente do início ao fim
+        # pelo menos uma vez (repetições são raras, só durante um rehash)
+        shard, scan_cursor = cursor or (0, 0)
+        rows = []
+        while shard < self.shards and len(rows) < limit:
+            scan_cursor, keys = self._client.scan(
+                scan_cursor, match=f"{self._prefix}:u:{{{shard}}}:*", count=limit - len(rows)
+            )
+            values = self._client.mget(keys) if keys else []
+            for key, raw in zip(keys, values):
+                if raw is None:
+                    continue
+                st = self._decode(raw)
+                if not st.flags & exclude_flags:
+                    rows.append((int((key.decode() if isinstance(key, bytes) else key).rsplit(":", 1)[1]), st.chat_id))
+            if int(scan_cursor) == 0:
+                shard, scan_cursor = shard + 1, 0
+        return rows, [shard, int(scan_cursor)] if shard < self.shards else None
+
+    def count_audience(self, exclude_flags: int) -> Optional[int]:
+        return None  # exigiria varrer todas as chaves
+
+    def expire(self, before: int) -> int:
+        return 0  # as chaves já expiram sozinhas (SET ... EX em put_many)
+
+    def put_many(self, items) -> None:
+        pipe = self._client.pipeline()
+        for user_id, st in items:
+            shard = _shard_of(user_id, self.shards)
+            pipe.eval(
+                self._PUT, 3, self._key(user_id), self._pending_key(shard), f"{self._prefix}:c:{{{shard}}}",
+                user_id, st.chat_id, st.flags, "" if st.remarketing_at is None else st.remarketing_at, st.step,
+                self._ttl,
+            )
+        pipe.execute()
+
+    def close(self) -> None:
+        try:
+            self._client.close()
+        except Exception:
+            pass
+
+
+_MISSING = object()
+_CACHE_ENTRY_BYTES = 258  # one cached user: OrderedDict slot + UserState + ints (measured, CPython 3.11)
+
+
+class CompactIntSet:
+    """Set of non-negative ints in sorted ``array('I')`` buckets keyed by ``value >> 20``:
+    ~4 bytes per member instead of ~70 in a ``set``, no merge/rebuild ever (an insert is a
+    memmove inside one bucket). Not thread-safe; the owner locks."""
+
+    _SHIFT = 20
+    _BUCKET_BYTES = 170  # array header + dict slot per bucket
+
+    def __init__(self):
+        self._buckets = {}
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __contains__(self, value: int) -> bool:
+        bucket = self._buckets.get(value >> self._SHIFT)
+        if bucket is None:
+            return False
+        low = value & ((1 << self._SHIFT) - 1)
+        i = bisect.bisect_left(bucket, low)
+        return i < len(bucket) and bucket[i] == low
+
+    def discard(self, value: int) -> bool:
+        bucket = self._buckets.get(value >> self._SHIFT)
+        if bucket is None:
+            return False
+        low = value & ((1 << self._SHIFT) - 1)
+        i = bisect.bisect_left(bucket, low)
+        if i == len(bucket) or bucket[i] != low:
+            return False
+        del bucket[i]
+        self._len -= 1
+        if not bucket:
+            del self._buckets[value >> self._SHIFT]
+        return True
+
+    def add(self, value: int) -> None:
+        bucket = self._buckets.get(value >> self._SHIFT)
+        if bucket is None:
+            bucket = self._buckets[value >> self._SHIFT] = array.array("I")
+        low = value & ((1 << self._SHIFT) - 1)
+        i = bisect.bisect_left(bucket, low)
+        if i == len(bucket) or bucket[i] != low:
+            bucket.insert(i, low)
+            self._len += 1
+
+    @property
+    def nbytes(self) -> int:
+        return 4 * self._len + self._BUCKET_BYTES * len(self._buckets)
+
+
+class UserStateStore:
+    """Read-through LRU + write-behind buffer in front of a sharded backend.
+
+    Reads are served from memory after the first lookup (misses are cached too), and
+    writes are coalesced per user and flushed in batches by a background thread, so the
+    handlers never touch the disk/network on the hot path.
+
+    Paid users (the flag never goes away) are not kept in the LRU but in two generations
+    of ``CompactIntSet``, so ``is_completed`` stays in memory for millions of them. The LRU
+    gets what ``memory_budget`` leaves; when the paid ids alone reach half of it, the older
+    generation is dropped and those users are read from the backend again.
+    """
+
+    def __init__(
+        self, backend, cache_size: int = 100_000, flush_interval: float = 0.05, memory_budget: int = 64 << 20
+    ):
+        self._backend = backend
+        self._cache_size = cache_size
+        self._memory_budget = memory_budget
+        self._cache_limit = min(cache_size, memory_budget // _CACHE_ENTRY_BYTES)
+        self._cache = OrderedDict()
+        self._completed, self._completed_old = CompactIntSet(), CompactIntSet()
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._flush_interval = flush_interval
+        self._completed_count = (float("-inf"), 0)
+        self._writer = threading.Thread(target=self._flush_loop, name="state-writer", daemon=True)
+        self._writer.start()
+
+    def _remember(self, user_id: int, st: Optional[UserState]) -> None:
+        if st is not None and st.flags & USER_COMPLETED:
+            self._cache.pop(user_id, None)
+            if user_id not in self._completed:
+                self._completed.add(user_id)
+                if len(self._completed) % 4096 == 0:
+                    self._rebudget()
+            return
+        self._cache[user_id] = st
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self._cache_limit:
+            self._cache.popitem(last=False)
+
+    def _rebudget(self) -> None:
+        if self._completed.nbytes > self._memory_budget // 2:
+            self._completed_old, self._completed = self._completed, CompactIntSet()
+        ids = self._completed.nbytes + self._completed_old.nbytes
+        self._cache_limit = min(self._cache_size, max(1024, (self._memory_budget - ids) // _CACHE_ENTRY_BYTES))
+
+    @property
+    def memory_bytes(self) -> int:
+        """Estimated bytes held in memory: LRU entries plus paid-user ids."""
+        return len(self._cache) * _CACHE_ENTRY_BYTES + self._completed.nbytes + self._completed_old.nbytes
+
+    def get(self, user_id: int, fresh: bool = False) -> Optional[UserState]:
+        """Cached state of ``user_id``. ``fresh`` skips the LRU (buffered writes still win):
+        in clustered mode another replica may have advanced the user since it was cached."""
+        with self._lock:
+            st = _MISSING if fresh else self._cache.get(user_id, _MISSING)
+            if st is not _MISSING:
+                self._cache.move_to_end(user_id)
+                return st
+            st = self._pending.get(user_id, self._flushing.get(user_id, _MISSING))
+        if st is _MISSING:
+            st = self._backend.get(user_id)
+        with self._lock:
+            self._remember(user_id, st)
+        return st
+
+    def put(self, user_id: int, st: UserState) -> None:
+        with self._lock:
+            self._pending[user_id] = st
+            self._remember(user_id, st)
+
+    def is_completed(self, user_id: Optional[int]) -> bool:
+        if not user_id:
+            return False
+        with self._lock:
+            if user_id in self._completed or user_id in self._completed_old:
+                return True
+        st = self.get(user_id)
+        return bool(st and st.flags & USER_COMPLETED)
+
+    def in_memory(self, user_id: int) -> bool:
+        """True when ``get``/``is_completed`` answer without a backend read (absent users are
+        cached too, as None)."""
+        with self._lock:
+            return (
+                user_id in self._completed
+                or user_id in self._completed_old
+                or user_id in self._cache
+                or user_id in self._pending
+                or user_id in self._flushing
+            )
+
+    def completed_in_memory(self, user_id: int) -> bool:
+        """``is_completed`` without the backend read: paid ids, write buffer and LRU only.
+        Never blocks on I/O; for re-checks of users just read from the backend."""
+        with self._lock:
+            if user_id in self._completed or user_id in self._completed_old:
+                return True
+            st = self._pending.get(user_id) or self._flushing.get(user_id) or self._cache.get(user_id)
+        return bool(st and st.flags & USER_COMPLETED)
+
+    def mark_started(self, user_id: int, chat_id: int, remarketing_at: Optional[int]) -> None:
+        # (Re)começa a sequência de remarketing do primeiro passo
+        st = self.get(user_id) or UserState(chat_id)
+        self.put(user_id, st._replace(chat_id=chat_id, remarketing_at=remarketing_at, step=0))
+
+    def mark_completed(self, user_id: int, chat_id: Optional[int] = None) -> None:
+        st = self.get(user_id) or UserState(chat_id or user_id)
+        self.put(user_id, st._replace(flags=st.flags | USER_COMPLETED, remarketing_at=None))
+
+    def complete(self, user_id: int, chat_id: Optional[int] = None) -> Optional[UserState]:
+        """``mark_completed`` written through to the backend before returning (raises if the
+        write fails); blocking, call it off the event loop. Returns the state before it."""
+        with self._flush_lock:  # nenhum flush com o estado antigo pode chegar depois deste
+            st = self.get(user_id)
+            base = st or UserState(chat_id or user_id)
+            done = base._replace(flags=base.flags | USER_COMPLETED, remarketing_at=None)
+            self._backend.put_many([(user_id, done)])
+            with self._lock:
+                buffered = self._pending.get(user_id)
+                if buffered is not None:
+                    self._pending[user_id] = buffered._replace(
+                        flags=buffered.flags | USER_COMPLETED, remarketing_at=None
+                    )
+                self._remember(user_id, done)
+        return st
+
+    def mark_unreachable(self, user_id: int, fresh: bool = False) -> None:
+        # Sem remarketing pendente: a pessoa só volta a receber algo depois de um novo /start
+        st = self.get(user_id, fresh) or UserState(user_id)
+        self.put(user_id, st._replace(flags=st.flags | USER_UNREACHABLE, remarketing_at=None))
+
+    def readmit(self, user_id: int) -> bool:
+        st = self.get(user_id)
+        if st is None or not st.flags & USER_UNREACHABLE:
+            return False
+        self.put(user_id, st._replace(flags=st.flags & ~USER_UNREACHABLE))
+        return True
+
+    def clear_remarketing(self, user_id: int) -> None:
+        st = self.get(user_id)
+        if st and st.remarketing_at is not None:
+            self.put(user_id, st._replace(remarketing_at=None))
+
+    def count_completed(self) -> int:
+        # Varre o backend: chamado só pelo /metrics, com cache curto
+        now = time.monotonic()
+        if now - self._completed_count[0] > 30:
+            self.flush()
+            self._completed_count = (now, self._backend.count_completed())
+        return self._completed_count[1]
+
+    @property
+    def backend(self):
+        return self._backend
+
+    def iter_pending(self, shards=None, until: Optional[int] = None):
+        self.flush()
+        return self._backend.iter_pending(shards, until)
+
+    def audience_page(self, cursor, limit: int, exclude_flags: int) -> tuple:
+        """One page of users without ``exclude_flags`` (see the backends' ``audience_page``);
+        blocking, call it off the event loop."""
+        self.flush()
+        return self._backend.audience_page(cursor, limit, exclude_flags)
+
+    def count_audience(self, exclude_flags: int) -> Optional[int]:
+        self.flush()
+        return self._backend.count_audience(exclude_flags)
+
+    def expire(self, ttl_seconds: float) -> int:
+        """Forget users who never paid and have been idle for ``ttl_seconds`` (see the
+        backends' ``expire``); blocking, call it off the event loop. Cached copies are
+        harmless: the next write recreates the row."""
+        self.flush()
+        return self._backend.expire(int(time.time() - ttl_seconds))
+
+    def claim_remarketings(self, items) -> list:
+        """Claim due remarketings in the backend before sending (see the backends'
+        ``claim_remarketings``); blocking, call it off the event loop."""
+        with self._flush_lock:  # nenhum flush entre o do buffer e a reivindicação
+            self._flush_locked()  # um pagamento/cancelamento ainda no buffer precisa chegar antes
+            claimed = self._backend.claim_remarketings(items)
+            taken = set(claimed)
+            with self._lock:
+                for user_id, due_at, step, next_at in items:
+                    if user_id not in taken:
+                        continue
+                    # Um put feito depois do flush ainda não viu a reivindicação: se ele traz o
+                    # passo reivindicado, avança junto (senão o próximo flush o reenviaria)
+                    buffered = self._pending.get(user_id)
+                    if buffered is not None:
+                        if buffered.remarketing_at == due_at and buffered.step == step:
+                            buffered = buffered._replace(remarketing_at=next_at, step=step + 1)
+                        self._pending[user_id] = buffered._replace(flags=buffered.flags | USER_REMARKETED)
+                        self._remember(user_id, self._pending[user_id])
+                        continue
+                    st = self._cache.get(user_id)
+                    if st is not None:
+                        self._cache[user_id] = st._replace(
+                            flags=st.flags | USER_REMARKETED, remarketing_at=next_at, step=step + 1
+                        )
+        return claimed
+
+    def claim_order(self, order_id: str, user_id: Optional[int] = None) -> bool:
+        # Escrita síncrona (não passa pelo buffer): a deduplicação precisa ser atômica
+        return self._backend.claim_order(order_id, user_id)
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            self._flush_locked()
+
+    def _flush_locked(self) -> None:
+        with self._lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+        try:
+            self._backend.put_many(list(self._flushing.items()))
+        except Exception:
+            logger.exception("Failed to flush %s user states; will retry", len(self._flushing))
+            with self._lock:
+                for user_id, st in self._flushing.items():
+                    self._pending.setdefault(user_id, st)
+        finally:
+            with self._lock:
+                self._flushing = {}
+
+    def _flush_loop(self) -> None:
+        while not self._closed.wait(self._flush_interval):
+            self.flush()
+
+    def close(self) -> None:
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._writer.join()
+        self.flush()
+        self._backend.close()
+
+
+_redis_client = None
+
+
+def _open_state_backend(bot: Optional[str] = None):
+    """Backend at STATE_DIR / REDIS_PREFIX, or isolated under ``bots/<bot>`` / ``<prefix>:<bot>``."""
+    global _redis_client
+    if STATE_BACKEND == "redis":
+        import redis  # optional dependency, only for STATE_BACKEND=redis
+
+        if _redis_client is None:
+            _redis_client = redis.Redis.from_url(REDIS_URL)  # um pool de conexões para todos os bots
+        return RedisStateBackend(
+            _redis_client, STATE_SHARDS, REDIS_PREFIX if bot is None else f"{REDIS_PREFIX}:{bot}", int(STATE_TTL_DAYS * 86400)
+        )
+    return SQLiteStateBackend(STATE_DIR if bot is None else os.path.join(STATE_DIR, "bots", bot), STATE_SHARDS)
+
+
+# ----------------------
+# Remarketing Scheduler
+# ----------------------
+_USER_ID_BITS = 52  # Telegram user ids fit in 52 bits
+_TENANT_BITS = 8  # up to 256 bots per process
+_KEY_BITS = _USER_ID_BITS + _TENANT_BITS
+_USER_ID_MASK = (1 << _USER_ID_BITS) - 1
+_KEY_MASK = (1 << _KEY_BITS) - 1
+
+
+class RemarketingScheduler:
+    """Min-heap of pending remarketings of every bot, persisted through each bot's store.
+
+    Each pending user costs one packed int in the heap (``due_at << 60 | bot << 52 |
+    user_id``) plus one dict entry used for O(1) cancel; cancelled/rescheduled heap entries
+    are dropped lazily when they reach the top, or all at once when they outnumber the live
+    ones (so repeated /starts cannot grow the heap). A single repeating job pops due users
+    in batches, whichever bot they belong to.
+
+    In clustered mode the heap only holds the partitions (state shards) this replica owns;
+    users scheduled elsewhere are picked up from the stores by ``restore()``.
+    """
+
+    def __init__(self, stores: list, partitions: int):
+        self._stores = stores  # bot index -> UserStateStore
+        self._heap = []
+        self._due = {}  # bot << 52 | user_id -> due_at (the heap may hold stale entries)
+        self.pending = [0] * len(stores)  # per bot
+        self.partitions = partitions
+        self.owned = None  # set of owned partitions; None = all (single instance)
+        self.restored = False  # every pending entry loaded (restore() or snapshot): safe to snapshot
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def owns(self, user_id: int) -> bool:
+        return self.owned is None or _shard_of(user_id, self.partitions) in self.owned
+
+    def _push(self, key: int, due_at: int) -> None:
+        if key not in self._due:
+            self.pending[key >> _USER_ID_BITS] += 1
+        self._due[key] = due_at
+        heapq.heappush(self._heap, (due_at << _KEY_BITS) | key)
+        if len(self._heap) > 2 * len(self._due) + 4096:
+            self._heap = [(d << _KEY_BITS) | k for k, d in self._due.items()]
+            heapq.heapify(self._heap)
+
+    def schedule(self, bot: int, user_id: int, chat_id: int, due_at: int) -> None:
+        if self.owns(user_id):
+            self._push((bot << _USER_ID_BITS) | user_id, due_at)
+        self._stores[bot].mark_started(user_id, chat_id, due_at)
+
+    def cancel(self, bot: int, user_id: int) -> bool:
+        # O registro persistido é limpo por quem cancela (mark_completed / clear_remarketing)
+        if self._due.pop((bot << _USER_ID_BITS) | user_id, None) is None:
+            return False
+        self.pending[bot] -= 1
+        return True
+
+    def pop_due(self, now: float, limit: int) -> list:
+        """Remove and return up to ``limit`` (bot, user_id, due_at) triples that are due."""
+        due = []
+        while self._heap and len(due) < limit:
+            packed = self._heap[0]
+            due_at = packed >> _KEY_BITS
+            if due_at > now:
+                break
+            heapq.heappop(self._heap)
+            key = packed & _KEY_MASK
+            if self._due.get(key) == due_at:
+                del self._due[key]
+                bot = key >> _USER_ID_BITS
+                self.pending[bot] -= 1
+                due.append((bot, key & _USER_ID_MASK, due_at))
+        return due
+
+    def restore(self, partitions=None, until: Optional[int] = None) -> int:
+        """Load pending entries from the stores (only ``partitions`` / due by ``until`` when
+        given); overdue ones fire on the next tick. Blocking: reads the backends."""
+        count = 0
+        for bot, store in enumerate(self._stores):
+            for user_id, due_at in store.iter_pending(partitions, until):
+                key = (bot << _USER_ID_BITS) | user_id
+                if self._due.get(key) != due_at:
+                    self._push(key, due_at)
+                    count += 1
+        if partitions is None and until is None:
+            self.restored = True
+        return count
+
+    def drop(self, partitions) -> None:
+        """Forget the pending entries of partitions this replica no longer owns."""
+        partitions = set(partitions)
+        for key in [k for k in self._due if _shard_of(k & _USER_ID_MASK, self.partitions) in partitions]:
+            del self._due[key]
+            self.pending[key >> _USER_ID_BITS] -= 1
+        self._heap = [p for p in self._heap if (p & _KEY_MASK) in self._due]
+        heapq.heapify(self._heap)
+
+    def advance(self, bot: int, user_id: int, due_at: int) -> None:
+        """Queue the next sequence step of a user, already stored by the claim."""
+        if self.owns(user_id):
+            self._push((bot << _USER_ID_BITS) | user_id, due_at)
+
+    def defer(self, bot: int, user_id: int, due_at: int) -> None:
+        """Put back an entry taken by ``pop_due`` but not claimed (shutdown); it is still
+        pending in the store."""
+        self._push((bot << _USER_ID_BITS) | user_id, due_at)
+
+    def save_snapshot(self, path: str, bots: list) -> int:
+        """Write every pending entry to ``path`` (atomically): a JSON header line, then the
+        keys and due times as two int64 arrays ordered by due time. Blocking."""
+        items = sorted((due_at, key) for key, due_at in self._due.items())
+        payload = array.array("q", (key for _, key in items)).tobytes() + array.array("q", (d for d, _ in items)).tobytes()
+        header = {
+            "version": 1,
+            "bots": bots,
+            "count": len(items),
+            "byteorder": sys.byteorder,
+            "crc32": zlib.crc32(payload),
+            "written_at": int(time.time()),
+        }
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(json.dumps(header).encode() + b"\n")
+            fh.write(payload)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+        return len(items)
+
+    def load_snapshot(self, path: str, bots: list) -> Optional[int]:
+        """Load (into an empty scheduler) a snapshot written by ``save_snapshot`` for the same
+        ``bots``, and delete it: it is only valid until the stores change again. Returns None
+        when there is no usable snapshot; the caller then falls back to ``restore()``."""
+        try:
+            with open(path, "rb") as fh:
+                header = json.loads(fh.readline())
+                payload = fh.read()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable snapshot %s: %s", path, e)
+            header, payload = {}, b""
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        count = header.get("count", -1)
+        if (
+            header.get("version") != 1
+            or header.get("bots") != bots
+            or header.get("byteorder") != sys.byteorder
+            or len(payload) != 16 * count
+            or zlib.crc32(payload) != header.get("crc32")
+        ):
+            if header:
+                logger.warning("Ignoring snapshot %s (different bots, or damaged)", path)
+            return None
+        keys, dues = array.array("q"), array.array("q")
+        keys.frombytes(payload[: 8 * count])
+        dues.frombytes(payload[8 * count :])
+        self._due = dict(zip(keys, dues))
+        self._heap = [(due_at << _KEY_BITS) | key for key, due_at in zip(keys, dues)]
+        heapq.heapify(self._heap)  # já está em ordem de vencimento: O(n) e nada muda
+        self.pending = [0] * len(self._stores)
+        for key in keys:
+            self.pending[key >> _USER_ID_BITS] += 1
+        self.restored = True
+        return count
+
+
+# ----------------------
+# Cluster
+# ----------------------
+class PartitionLeases:
+    """Which remarketing partitions this replica owns (CLUSTER=true).
+
+    Every replica heartbeats into the shared backend and holds expiring leases on at most
+    ``ceil(partitions / live replicas)`` partitions, renewing them each ``refresh()``. When
+    a replica dies its leases expire and the survivors take them over; when one joins,
+    the others shed their extra partitions. Ownership only decides who scans a partition:
+    every send is claimed in the backend first, so a brief double owner never sends twice.
+    """
+
+    def __init__(self, backend, instance_id: str, partitions: int, ttl: float):
+        self._backend = backend
+        self.instance_id = instance_id
+        self.partitions = partitions
+        self.ttl = ttl
+        self.owned = set()
+        self.members = 0
+        # Cada réplica começa a procurar partições livres num ponto diferente
+        offset = zlib.crc32(instance_id.encode()) % partitions
+        self._order = [(offset + i) % partitions for i in range(partitions)]
+
+    def refresh(self):
+        """Heartbeat, renew, rebalance. Returns (gained, lost) partition sets. Blocking."""
+        self.members = max(1, self._backend.heartbeat(self.instance_id, self.ttl))
+        target = -(-self.partitions // self.members)
+        owned = {p for p in sorted(self.owned) if self._backend.acquire_lease(p, self.instance_id, self.ttl)}
+        while len(owned) > target:
+            partition = max(owned)
+            owned.discard(partition)
+            self._backend.release_lease(partition, self.instance_id)
+        for partition in self._order:
+            if len(owned) >= target:
+                break
+            if partition not in owned and self._backend.acquire_lease(partition, self.instance_id, self.ttl):
+                owned.add(partition)
+        gained, lost = owned - self.owned, self.owned - owned
+        self.owned = owned
+        return gained, lost
+
+    def leave(self) -> None:
+        """Release everything so the other replicas take over without waiting for expiry."""
+        for partition in sorted(self.owned):
+            self._backend.release_lease(partition, self.instance_id)
+        self.owned = set()
+        self._backend.leave(self.instance_id)
+
+
+
+# ----------------------
+# Outbound Send Pipeline
+# ----------------------
+# Priority lanes (lower goes first), passed as ``rate_limit_args`` on bot calls
+PRIORITY_TRANSACTIONAL = 0  # FINAL_APPROVED_TEXT
+PRIORITY_INTERACTIVE = 1  # replies to /start (default for calls without rate_limit_args)
+PRIORITY_REMARKETING = 2
+PRIORITY_BROADCAST = 3
+_LANE_NAMES = {
+    PRIORITY_TRANSACTIONAL: "transactional",
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_REMARKETING: "remarketing",
+    PRIORITY_BROADCAST: "broadcast",
+}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float, now: float = 0.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        """Take one token, possibly going into debt; return how long to wait for it."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+def _unreachable_reason(exc: TelegramError) -> Optional[str]:
+    """blocked | deactivated | chat_not_found when ``exc`` means the chat cannot receive
+    anything until the user comes back; None for any other error."""
+    text = str(exc.message).lower()
+    if isinstance(exc, Forbidden):
+        return "deactivated" if "deactivated" in text else "blocked"
+    if isinstance(exc, BadRequest) and "chat not found" in text:
+        return "chat_not_found"
+    return None
+
+
+metrics.describe("bot_unreachable_total", "counter", "Private chats found unreachable by a send, by bot and reason (blocked, deactivated, chat_not_found).")
+metrics.describe("bot_unreachable_calls_avoided_total", "counter", "Sends not made because the chat is unreachable, by bot and where (Bot API method, or remarketing).")
+metrics.describe("bot_unreachable_store_errors_total", "counter", "Unreachable flags that failed to reach the user state (logged), by bot.")
+metrics.describe("bot_unreachable_readmitted_total", "counter", "Unreachable users let back in by a new /start, by bot.")
+
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    """Rate limiter plugged into the bot: every Bot API call goes through it.
+
+    Calls that target a chat first wait for that chat's token bucket, then queue for the
+    global bucket; the global queue is served in priority order (see ``PRIORITY_*``).
+    A ``RetryAfter`` (429) pauses the whole pipeline for the requested time and the call
+    is retried up to ``max_retries`` times. Calls without ``chat_id`` (getMe, setWebhook…)
+    are not throttled.
+
+    A private chat whose send fails with blocked / deactivated / chat not found goes into
+    ``unreachable`` (a ``CompactIntSet``) and ``on_unreachable(chat_id, reason)`` is called;
+    later calls to it raise ``Forbidden`` at once, without touching the API, until
+    ``readmit``.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        per_chat_rate: float = 1.0,
+        per_chat_burst: float = 3.0,
+        max_retries: int = 3,
+        bot: str = "default",
+    ):
+        self._labels = (("bot", bot),)
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._per_chat_rate = per_chat_rate
+        self._per_chat_burst = per_chat_burst
+        self._max_retries = max_retries
+        self._chats = {}
+        self._waiting = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.unreachable = CompactIntSet()
+        self.on_unreachable = None
+        # metrics
+        self.queue_depth = dict.fromkeys(_LANE_NAMES, 0)
+        self.sent = 0
+        self.retry_after_count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    async def initialize(self) -> None:
+        if self._dispatcher is not None:
+            return  # o PTB chama de novo a cada bot.initialize() (Application e Updater)
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch(), name="send-dispatcher")
+
+    async def shutdown(self) -> None:
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": {_LANE_NAMES[p]: n for p, n in self.queue_depth.items()},
+            "sent": self.sent,
+            "retry_after": self.retry_after_count,
+            "latency_avg_ms": round(1000 * self.latency_sum / self.sent, 1) if self.sent else 0.0,
+            "latency_max_ms": round(1000 * self.latency_max, 1),
+        }
+
+    async def _dispatch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            pause = self._paused_until - loop.time()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            wait = self._global.reserve(loop.time())
+            if wait:
+                await asyncio.sleep(wait)
+            # Reavaliar o topo depois de esperar: uma prioridade maior pode ter chegado
+            _, _, fut = heapq.heappop(self._waiting)
+            if not fut.done():
+                fut.set_result(None)
+
+    async def _acquire_chat(self, chat_id) -> None:
+        now = asyncio.get_running_loop().time()
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 50_000:
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self._per_chat_rate, self._per_chat_burst, now)
+        wait = bucket.reserve(now)
+        if wait:
+            await asyncio.sleep(wait)
+
+    async def _acquire_global(self, priority: int) -> None:
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), fut))
+        self._wakeup.set()
+        await fut
+
+    async def _call(self, callback, args, kwargs, endpoint: str):
+        """Run the actual HTTP call, recording latency and error class per Bot API method."""
+        labels = self._labels + (("method", endpoint),)
+        started = time.perf_counter()
+        code = None
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter:
+            code = "429"
+            raise
+        except Forbidden:
+            code = "403"
+            raise
+        except BadRequest:
+            code = "400"
+            raise
+        except NetworkError:
+            code = "network"
+            raise
+        except Exception:
+            code = "other"
+            raise
+        finally:
+            metrics.observe("bot_api_request_seconds", time.perf_counter() - started, labels)
+            if code:
+                metrics.inc("bot_api_errors_total", labels + (("code", code),))
+
+    def readmit(self, chat_id: int) -> bool:
+        return self.unreachable.discard(chat_id) if chat_id > 0 else False
+
+    def _note_unreachable(self, chat_id, exc: TelegramError) -> None:
+        # Só chats privados (id > 0 = id do usuário); grupos/canais não entram no índice
+        reason = _unreachable_reason(exc)
+        if reason is None or not isinstance(chat_id, int) or chat_id <= 0 or chat_id in self.unreachable:
+            return
+        self.unreachable.add(chat_id)
+        metrics.inc("bot_unreachable_total", self._labels + (("reason", reason),))
+        if self.on_unreachable is not None:
+            self.on_unreachable(chat_id, reason)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await self._call(callback, args, kwargs, endpoint)
+        if isinstance(chat_id, int) and chat_id > 0 and chat_id in self.unreachable:
+            metrics.inc("bot_unreachable_calls_avoided_total", self._labels + (("via", endpoint),))
+            raise Forbidden(f"Chat {chat_id} is unreachable (suppressed until the user sends /start)")
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for attempt in itertools.count():
+            self.queue_depth[priority] += 1
+            try:
+                await self._acquire_chat(chat_id)
+                await self._acquire_global(priority)
+            finally:
+                self.queue_depth[priority] -= 1
+            try:
+                result = await self._call(callback, args, kwargs, endpoint)
+            except (Forbidden, BadRequest) as exc:
+                self._note_unreachable(chat_id, exc)
+                raise
+            except RetryAfter as exc:
+                self.retry_after_count += 1
+                retry_after = exc.retry_after
+                if isinstance(retry_after, dt.timedelta):
+                    retry_after = retry_after.total_seconds()
+                self._paused_until = max(self._paused_until, loop.time() + retry_after)
+                if attempt >= self._max_retries:
+                    raise
+                logger.warning("RetryAfter %ss on %s (attempt %s)", retry_after, endpoint, attempt + 1)
+                await asyncio.sleep(retry_after)
+                continue
+            latency = loop.time() - started
+            self.sent += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+            return result
+
+
+
+# ----------------------
+# Bot API Transport
+# ----------------------
+class PooledRequest(HTTPXRequest):
+    """HTTPXRequest with its in-flight limit enforced in front of the connection pool, so
+    the time a call waits for a free connection is measured instead of hidden in httpx."""
+
+    def __init__(self, pool: str, pool_size: int, pool_timeout: float, **kwargs):
+        super().__init__(connection_pool_size=pool_size, pool_timeout=pool_timeout, **kwargs)
+        self.pool = pool
+        self.pool_size = pool_size
+        self.in_flight = 0
+        self._pool_timeout = pool_timeout
+        self._slots = asyncio.Semaphore(pool_size)
+        self._labels = (("pool", pool),)
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data=None,
+        read_timeout=BaseRequest.DEFAULT_NONE,
+        write_timeout=BaseRequest.DEFAULT_NONE,
+        connect_timeout=BaseRequest.DEFAULT_NONE,
+        pool_timeout=BaseRequest.DEFAULT_NONE,
+    ):
+        if self._slots.locked():
+            started = time.perf_counter()
+            timeout = self._pool_timeout if pool_timeout is BaseRequest.DEFAULT_NONE else pool_timeout
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout)
+            except asyncio.TimeoutError:
+                metrics.inc("bot_api_pool_timeouts_total", self._labels)
+                raise TimedOut(f"Pool timeout: all {self.pool_size} {self.pool} connections are busy") from None
+            metrics.observe("bot_api_pool_wait_seconds", time.perf_counter() - started, self._labels)
+        else:
+            await self._slots.acquire()
+            metrics.observe("bot_api_pool_wait_seconds", 0.0, self._labels)
+        self.in_flight += 1
+        try:
+            return await super().do_request(
+                url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout
+            )
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+
+_bot_api_pools: dict = {}  # pool name -> PooledRequest
+
+
+def _bot_api_request(pool: str, pool_size: int, **kwargs) -> PooledRequest:
+    limits = httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=BOT_API_KEEPALIVE_EXPIRY,
+    )
+    http2 = BOT_API_HTTP_VERSION in ("2", "2.0")
+    options = dict(
+        pool=pool,
+        pool_size=pool_size,
+        pool_timeout=BOT_API_POOL_TIMEOUT,
+        connect_timeout=BOT_API_CONNECT_TIMEOUT,
+        write_timeout=BOT_API_WRITE_TIMEOUT,
+        http_version="2" if http2 else "1.1",
+        # http1 continua habilitado: HTTP/2 só quando o servidor aceita via ALPN
+        httpx_kwargs={"limits": limits, "http1": True},
+        **kwargs,
+    )
+    try:
+        request_obj = PooledRequest(**options)
+    except RuntimeError as e:  # h2 não instalado
+        if not http2:
+            raise
+        logger.warning("HTTP/2 unavailable (%s); using HTTP/1.1 for the Bot API", e)
+        options["http_version"] = "1.1"
+        request_obj = PooledRequest(**options)
+    _bot_api_pools[pool] = request_obj
+    return request_obj
+
+
+metrics.describe("bot_api_pool_wait_seconds", "histogram", "Time a Bot API call waited for a free connection, by pool.")
+metrics.describe("bot_api_pool_timeouts_total", "counter", "Bot API calls that gave up waiting for a connection, by pool.")
+metrics.gauge(
+    "bot_api_in_flight",
+    "Bot API requests in flight, by pool.",
+    lambda: {(("pool", name),): pool.in_flight for name, pool in _bot_api_pools.items()},
+)
+
+
+# ----------------------
+# Update Processing
+# ----------------------
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Fan updates out to ``workers`` async workers, partitioned by user/chat id.
+
+    Each worker drains its own FIFO queue, so updates from the same user run strictly in
+    order (a /start and the following web_app_data never race), while different users are
+    processed in parallel. Updates are enqueued synchronously, in the order the
+    Application hands them over.
+    """
+
+    def __init__(self, workers: int, max_pending_per_worker: int = 256):
+        super().__init__(max_concurrent_updates=workers * max_pending_per_worker)
+        self.workers = workers
+        self._queues = []
+        self._tasks = []
+
+    @staticmethod
+    def _partition_key(update: object) -> int:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+            return update.update_id
+        return 0
+
+    async def initialize(self) -> None:
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._tasks = [
+            asyncio.create_task(self._worker(queue), name=f"update-worker-{i}")
+            for i, queue in enumerate(self._queues)
+        ]
+
+    async def shutdown(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @staticmethod
+    async def _worker(queue: asyncio.Queue) -> None:
+        while True:
+            coroutine, done = await queue.get()
+            try:
+                await coroutine
+            except Exception:
+                logger.exception("Unhandled error while processing update")
+            finally:
+                if not done.done():
+                    done.set_result(None)
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        done = asyncio.get_running_loop().create_future()
+        self._queues[self._partition_key(update) % self.workers].put_nowait((coroutine, done))
+        await done
+
+
+# ----------------------
+# Media Assets
+# ----------------------
+_ASSET_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+class AssetRegistry:
+    """Local images by logical name (``ASSETS_DIR/<name>.<ext>``) and their file_ids.
+
+    A file_id only works for the bot that uploaded it, so ids are cached per bot id and
+    keyed by the SHA-256 of the file: an edited image is uploaded again, a renamed one is
+    not. The first send of an asset by a bot uploads the bytes; concurrent sends wait for
+    that upload and reuse its file_id (single flight), so bytes go up once per bot.
+    """
+
+    def __init__(self, directory: str, cache_path: str):
+        self.cache_path = cache_path
+        self._files = {}  # name -> (path, sha256, bytes): lidos uma vez, nada de I/O no event loop
+        if os.path.isdir(directory):
+            for entry in sorted(os.listdir(directory)):
+                name, ext = os.path.splitext(entry)
+                if ext.lower() in _ASSET_EXTENSIONS:
+                    path = os.path.join(directory, entry)
+                    with open(path, "rb") as fh:
+                        data = fh.read()
+                    self._files[name] = (path, hashlib.sha256(data).hexdigest(), data)
+        self._ids = {}  # str(bot id) -> {sha256: file_id}
+        try:
+            with open(cache_path, encoding="utf-8") as fh:
+                self._ids = json.load(fh)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable asset cache %s: %s", cache_path, e)
+        self._uploads = {}  # (bot id, sha256) -> Future resolved when the upload ends
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._files
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def cached(self, bot_id: int, name: str) -> Optional[str]:
+        return self._ids.get(str(bot_id), {}).get(self._files[name][1])
+
+    async def acquire(self, bot_id: int, name: str):
+        """Return ``(photo, uploading)``: the cached file_id, or the file's bytes when this
+        caller has to upload them (it must then call ``finish()``)."""
+        digest = self._files[name][1]
+        while True:
+            file_id = self._ids.get(str(bot_id), {}).get(digest)
+            if file_id:
+                return file_id, False
+            pending = self._uploads.get((bot_id, digest))
+            if pending is None:
+                break
+            await asyncio.shield(pending)  # falhou? o próximo da fila vira o uploader
+        self._uploads[(bot_id, digest)] = asyncio.get_running_loop().create_future()
+        path, _, data = self._files[name]
+        return InputFile(data, filename=os.path.basename(path)), True
+
+    async def finish(self, bot_id: int, name: str, file_id: Optional[str]) -> None:
+        """End an upload started by ``acquire()``; ``file_id`` is None if it failed."""
+        digest = self._files[name][1]
+        if file_id:
+            self._ids.setdefault(str(bot_id), {})[digest] = file_id
+            metrics.inc("bot_asset_uploads_total", (("asset", name),))
+            await self._save()
+        pending = self._uploads.pop((bot_id, digest), None)
+        if pending is not None and not pending.done():
+            pending.set_result(None)
+
+    async def forget(self, bot_id: int, name: str) -> None:
+        """Drop a cached file_id that Telegram rejected; the next send uploads again."""
+        if self._ids.get(str(bot_id), {}).pop(self._files[name][1], None) is not None:
+            await self._save()
+
+    async def _save(self) -> None:
+        data = json.dumps(self._ids, indent=1, sort_keys=True)
+
+        def write() -> None:
+            os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+            tmp = f"{self.cache_path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                fh.write(data)
+            os.replace(tmp, self.cache_path)
+
+        try:
+            await asyncio.to_thread(write)
+        except OSError as e:
+            logger.warning("Asset cache write failed: %s", e)
+
+    async def verify(self, checks, concurrency: int) -> dict:
+        """getFile every ``(bot, image)`` pair, ``concurrency`` at a time. Cached ids that no
+        longer resolve are forgotten (re-uploaded on the next send); plain file_ids that
+        fail are logged, since nothing here can replace them. Returns outcome counts."""
+        slots = asyncio.Semaphore(concurrency)
+        counts = dict.fromkeys(("ok", "stale", "broken", "unchecked"), 0)
+
+        async def check(bot, image: str) -> None:
+            registry = image in self
+            file_id = self.cached(bot.id, image) if registry else image
+            if not file_id:
+                return  # ainda não enviado por este bot: o primeiro envio faz o upload
+            async with slots:
+                try:
+                    await bot.get_file(file_id)
+                    counts["ok"] += 1
+                except BadRequest as e:
+                    if registry:
+                        counts["stale"] += 1
+                        logger.warning("Asset %s: cached file_id rejected for bot %s (%s); will re-upload", image, bot.id, e)
+                        await self.forget(bot.id, image)
+                    else:
+                        counts["broken"] += 1
+                        logger.error("Image file_id %s… does not resolve for bot %s: %s", image[:16], bot.id, e)
+                except TelegramError as e:
+                    counts["unchecked"] += 1
+                    logger.warning("Could not check image %s for bot %s: %s", image[:16], bot.id, e)
+
+        await asyncio.gather(*(check(bot, image) for bot, image in checks))
+        return counts
+
+
+assets = AssetRegistry(ASSETS_DIR, ASSET_CACHE_FILE)
+metrics.describe("bot_asset_uploads_total", "counter", "Images uploaded to Telegram (once per bot and content), by asset.")
+
+
 # ----------------------
 # Telegram Bot Handlers
 # ----------------------
@@ -253,7 +2511,7 @@ FINAL_BUTTON_URL = "https://t.me/m/WRcFptmbMjUx"
 # --------------
 # Remarketing (5 min)
 # --------------
-REMARKETING_DELAY_SECONDS = 300
+REMARKETING_DELAY_SECONDS = int(os.getenv("REMARKETING_DELAY_SECONDS", "300"))
 REMARKETING_IMAGE_FILE_ID = (
     "AgACAgEAAxkBAAMxaQ4i50grFk5EaqZmu5xzBFXlt00AAs0Laxv4E3FEm8zDU3lj9xcBAAMCAAN5AAM2BA"
 )
@@ -265,122 +2523,358 @@ REMARKETING_TEXT = (
 )
 REMARKETING_BUTTON_TEXT = "THE BEST PACK FOR $2.99 ​​🔥😈🥵"
 REMARKETING_URL = "https://global.tribopay.com.br/oq2ec"
-
-# Track users who completed payment (in-memory)
-completed_users = set()
-scheduled_jobs = {}
+# Follow-up sequence (JSON list of steps: delay_seconds, image, text, button_text, button_url,
+# pkg; missing fields repeat the remarketing above). Unset = one step, the remarketing above
+REMARKETING_SEQUENCE_FILE = os.getenv("REMARKETING_SEQUENCE_FILE", "")
 
 
 def _is_https(url: str) -> bool:
     return url.lower().startswith("https://")
 
 
-def _build_markups_for_start():
+# Catálogo de pacotes: (texto do botão, URL do checkout, código)
+PACKAGES = (
+    ("Package 1 🙈 • $2.99", PACKAGE_1_URL, "pkg1"),
+    ("Package 2 🔥😈 • $4.99", PACKAGE_2_URL, "pkg2"),
+    ("Package 3 🔥😈🥵 • $6.99", PACKAGE_3_URL, "pkg3"),
+)
+
+
+def _build_markups_for_start(catalog: "Catalog", base_url: str):
     """Return (reply_markup, inline_markup) where only one will be used.
     - If HTTPS: use ReplyKeyboardMarkup with KeyboardButton.web_app (required for sendData -> web_app_data)
     - Else: use InlineKeyboardMarkup with URL buttons (fallback)
+    ``base_url`` is the bot's mini app root (WEBAPP_BASE_URL plus its route prefix).
     """
-    # URLs dos pacotes
-    pkgs = [
-        ("Package 1 🙈 • $2.99", PACKAGE_1_URL, "pkg1"),
-        ("Package 2 🔥😈 • $4.99", PACKAGE_2_URL, "pkg2"),
-        ("Package 3 🔥😈🥵 • $6.99", PACKAGE_3_URL, "pkg3"),
-    ]
+    pkgs = catalog.packages
 
-    if _is_https(WEBAPP_BASE_URL):
+    if _is_https(base_url):
         # WebApp via Reply Keyboard (necessário para sendData -> web_app_data chegar ao bot)
         kb_rows = []
         for text, url, code in pkgs:
-            wrapped = f"{WEBAPP_BASE_URL}/webapp?target={quote(url, safe='')}&pkg={quote(code, safe='')}"
+            wrapped = _webapp_url(base_url, url, code, "direct")
             kb_rows.append([KeyboardButton(text=text, web_app=WebAppInfo(url=wrapped))])
         reply_kb = ReplyKeyboardMarkup(kb_rows, resize_keyboard=True, one_time_keyboard=True)
         return reply_kb, None
     else:
         # Sem HTTPS: usar inline com URLs normais
-        rows = [[InlineKeyboardButton(text=text, url=url)] for text, url, _ in pkgs]
+        rows = [[InlineKeyboardButton(text=text, url=_tracked_url(url))] for text, url, _ in pkgs]
         inline_kb = InlineKeyboardMarkup(rows)
         return None, inline_kb
 
 
-def _remarketing_reply_markup():
+def _remarketing_reply_markup(step: "SequenceStep", base_url: str):
     """Reply keyboard with single WebApp button when HTTPS; else inline URL button."""
-    if _is_https(WEBAPP_BASE_URL):
-        wrapped = f"{WEBAPP_BASE_URL}/webapp?target={quote(REMARKETING_URL, safe='')}"
+    return _offer_reply_markup(base_url, step.button_text, step.button_url, step.pkg, "remarketing")
+
+
+# Marcador do user id nos markups em cache; trocado pelo id de cada destinatário no envio
+_USER_ID_MARK = "__TG_USER_ID__"
+
+
+def _tracked_url(url: str) -> str:
+    """Checkout ``url`` with ``utm_content=tg<id>``, so the provider's postback maps to the
+    Telegram user (the id is filled in per send, see ``_for_user``)."""
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k != "utm_content"]
+    query.append(("utm_content", "tg" + _USER_ID_MARK))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def _for_user(markup, user_id: int):
+    # Markup serializado (str) com o id do destinatário no utm_content do checkout
+    return markup.replace(_USER_ID_MARK, str(user_id)) if isinstance(markup, str) else markup
+
+
+def _webapp_url(base_url: str, url: str, pkg: str, source: str) -> str:
+    # pkg e src vão para o evento webapp_open (atribuição do funil)
+    return f"{base_url}/webapp?target={quote(_tracked_url(url), safe='')}&pkg={quote(pkg, safe='')}&src={source}"
+
+
+def _offer_reply_markup(base_url: str, button_text: str, url: str, pkg: str, source: str):
+    # Uma oferta, um botão (remarketing e broadcasts)
+    if _is_https(base_url):
+        wrapped = _webapp_url(base_url, url, pkg, source)
         kb = ReplyKeyboardMarkup(
-            [[KeyboardButton(text=REMARKETING_BUTTON_TEXT, web_app=WebAppInfo(url=wrapped))]],
+            [[KeyboardButton(text=button_text, web_app=WebAppInfo(url=wrapped))]],
             resize_keyboard=True,
             one_time_keyboard=True,
         )
         return kb, None
     else:
-        kb = InlineKeyboardMarkup(
-            [[InlineKeyboardButton(text=REMARKETING_BUTTON_TEXT, url=REMARKETING_URL)]]
-        )
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton(text=button_text, url=_tracked_url(url))]])
         return None, kb
 
 
+class _Markups(NamedTuple):
+    base_url: str
+    start: str  # reply_markup already serialized to JSON (sent as-is by the bot)
+    remarketing: tuple  # one per remarketing sequence step
+    final: str
+
+
+def _serialize_markup(markup) -> str:
+    return json.dumps(markup.to_dict(), ensure_ascii=False, separators=(",", ":"))
+
+
+def _build_markups(catalog: "Catalog", sequence: tuple, prefix: str) -> _Markups:
+    base_url = WEBAPP_BASE_URL + prefix
+    reply_kb, inline_kb = _build_markups_for_start(catalog, base_url)
+    remarketing = []
+    for step in sequence:
+        rm_reply_kb, rm_inline_kb = _remarketing_reply_markup(step, base_url)
+        remarketing.append(_serialize_markup(rm_reply_kb if rm_reply_kb is not None else rm_inline_kb))
+    return _Markups(
+        base_url=WEBAPP_BASE_URL,
+        start=_serialize_markup(reply_kb if reply_kb is not None else inline_kb),
+        remarketing=tuple(remarketing),
+        final=_serialize_markup(
+            InlineKeyboardMarkup([[InlineKeyboardButton(text=catalog.final_button_text, url=catalog.final_button_url)]])
+        ),
+    )
+
+
+# Cada passo do funil (foto + texto + botões) vira o menor número possível de chamadas:
+# uma sendPhoto com legenda e reply_markup quando o texto cabe na legenda, senão foto + texto
+CAPTION_LIMIT = 1024  # Telegram counts caption length in UTF-16 code units
+
+
+def _utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+class _FunnelMessage(NamedTuple):
+    step: str
+    photo: str  # asset name (see AssetRegistry) or a file_id
+    text: str
+    single_call: bool  # text fits in the photo caption
+
+
+def _compose(step: str, photo: str, text: str) -> _FunnelMessage:
+    return _FunnelMessage(step, photo, text, _utf16_len(text) <= CAPTION_LIMIT)
+
+
+metrics.describe("bot_api_calls_saved_total", "counter", "Bot API calls saved by sending photo and text as one captioned photo.")
+
+
+# BadRequests that mean the cached file_id itself is unusable (other ones, like a bad
+# caption or markup, must not cost a re-upload)
+_FILE_ID_ERROR_RE = re.compile(
+    r"wrong (?:remote )?file identifier|file reference|wrong file_id|file_id_invalid|wrong remote file", re.IGNORECASE
+)
+
+
+async def _send_photo(bot, chat_id: int, image: str, **kwargs):
+    """send_photo by asset name or file_id. An asset is uploaded by the first send of each
+    bot and its file_id reused afterwards; a cached id Telegram rejects is forgotten."""
+    if image not in assets:
+        return await bot.send_photo(chat_id=chat_id, photo=image, **kwargs)
+    photo, uploading = await assets.acquire(bot.id, image)
+    file_id = None
+    try:
+        sent = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+        if uploading and sent.photo:
+            file_id = sent.photo[-1].file_id
+        return sent
+    except BadRequest as e:
+        if not uploading and _FILE_ID_ERROR_RE.search(e.message):
+            await assets.forget(bot.id, image)
+        raise
+    finally:
+        if uploading:
+            await assets.finish(bot.id, image, file_id)
+
+
+async def _send_funnel_message(bot, chat_id: int, message: _FunnelMessage, reply_markup, priority: int) -> None:
+    """Send one funnel step. If Telegram rejects the captioned photo (BadRequest) the text
+    and buttons are still delivered; any other error propagates."""
+    reply_markup = _for_user(reply_markup, chat_id)  # chat privado: chat_id == user_id
+    if message.single_call:
+        try:
+            await _send_photo(
+                bot,
+                chat_id,
+                message.photo,
+                caption=message.text,
+                reply_markup=reply_markup,
+                rate_limit_args=priority,
+            )
+            metrics.inc("bot_api_calls_saved_total", (("step", message.step),))
+            return
+        except BadRequest as e:
+            # Foto rejeitada (ex.: file_id inválido): a oferta segue só com texto. Timeouts não
+            # caem aqui: a foto pode ter sido entregue e o texto sairia em duplicidade
+            logger.warning("Captioned photo failed step=%s chat_id=%s: %s", message.step, chat_id, e)
+    else:
+        try:
+            await _send_photo(bot, chat_id, message.photo, rate_limit_args=priority)
+        except Forbidden:
+            raise
+        except Exception as e:
+            logger.warning("Photo failed step=%s chat_id=%s: %s", message.step, chat_id, e)
+
+    await bot.send_message(
+        chat_id=chat_id,
+        text=message.text,
+        reply_markup=reply_markup,
+        disable_web_page_preview=True,
+        rate_limit_args=priority,
+    )
+
+
+# ----------------------
+# /start admission
+# ----------------------
+metrics.describe("bot_start_suppressed_total", "counter", "/start updates dropped by admission, by bot and reason (debounced, shed).")
+
+
+class StartAdmission:
+    """Per-user gate in front of /start, O(1) per update (one bot; called on the event loop).
+
+    - debounce: a /start less than ``debounce`` seconds after the last admitted one is
+      dropped; the first one already sent the message and set the remarketing.
+    - shedding: /starts per user are counted over a sliding ``abuse_window`` (the current
+      fixed window plus the previous one weighted by how much of it still overlaps); above
+      ``abuse_limit`` they are dropped until the rate falls back, shed ones counting too.
+
+    Users are kept in recency order and the idle ones evicted from the front, so memory
+    follows the users seen in the last two windows (at most ``max_users``).
+    """
+
+    def __init__(self, debounce: float, abuse_limit: int, abuse_window: float, max_users: int = 100_000):
+        self._debounce = debounce
+        self._abuse_limit = abuse_limit
+        self._abuse_window = abuse_window
+        self._horizon = max(debounce, 2 * abuse_window)
+        self._max_users = max_users
+        self._users = OrderedDict()  # user_id -> [last seen, last admitted, window index, previous count, count]
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def admit(self, user_id: int, now: float) -> str:
+        """ok | debounced | shed"""
+        users = self._users
+        entry = users.get(user_id)
+        if entry is None:
+            while users and (len(users) >= self._max_users or next(iter(users.values()))[0] < now - self._horizon):
+                users.popitem(last=False)
+            entry = users[user_id] = [now, float("-inf"), 0, 0, 0]
+        else:
+            users.move_to_end(user_id)
+            entry[0] = now
+        if self._abuse_limit > 0:
+            index = int(now // self._abuse_window)
+            if index != entry[2]:
+                entry[3] = entry[4] if index == entry[2] + 1 else 0
+                entry[2], entry[4] = index, 0
+            entry[4] += 1
+            overlap = 1 - (now % self._abuse_window) / self._abuse_window
+            if entry[3] * overlap + entry[4] > self._abuse_limit:
+                return "shed"
+        if now - entry[1] < self._debounce:
+            return "debounced"
+        entry[1] = now
+        return "ok"
+
+
+@_timed("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    tenant: Tenant = context.bot_data["tenant"]
     try:
         user_id = update.effective_user.id if update.effective_user else None
         chat_id = update.effective_chat.id if update.effective_chat else None
         username = update.effective_user.username if update.effective_user else None
 
+        if user_id:
+            verdict = tenant.admission.admit(user_id, time.monotonic())
+            if verdict != "ok":
+                metrics.inc("bot_start_suppressed_total", (("bot", tenant.name), ("reason", verdict)))
+                return
+            if cluster is not None or not tenant.store.in_memory(user_id):
+                # Primeiro /start (ou fora do LRU): a leitura do backend vai para uma thread e
+                # deixa o estado no cache para as checagens abaixo. Em cluster sempre relê:
+                # outra réplica pode ter avançado a sequência (remarketing_at/step) desde o cache,
+                # e o readmit/agendamento abaixo regravaria o estado antigo
+                await asyncio.to_thread(tenant.store.get, user_id, cluster is not None)
+            # Quem manda /start voltou a aceitar mensagens: sai do índice de supressão
+            readmitted = tenant.limiter.readmit(user_id)
+            if tenant.store.readmit(user_id) or readmitted:
+                metrics.inc("bot_unreachable_readmitted_total", (("bot", tenant.name),))
+                events.emit("readmitted", bot=tenant.name, user_id=user_id)
+
         # If user already completed, just stop silently
-        if user_id in completed_users:
+        if tenant.store.is_completed(user_id):
             return
 
-        # 1) Send image by file_id
-        await update.message.reply_photo(START_IMAGE_FILE_ID)
-
-        # 2) Prepare buttons (ReplyKeyboard if HTTPS for WebApp sendData)
-        reply_kb, inline_kb = _build_markups_for_start()
-
-        # 3) Send message with appropriate keyboard
-        if reply_kb is not None:
-            await update.message.reply_text(
-                START_TEXT,
-                reply_markup=reply_kb,
-                disable_web_page_preview=True,
-            )
-        else:
-            await update.message.reply_text(
-                START_TEXT,
-                reply_markup=inline_kb,
-                disable_web_page_preview=True,
-            )
-
-        # 4) Schedule remarketing if not completed
-        if user_id and chat_id and context.application.job_queue:
-            logger.info("START user_id=%s username=%s chat_id=%s", user_id, username, chat_id)
-            # Cancel previous job if exists
-            old = scheduled_jobs.pop(user_id, None)
-            if old:
-                try:
-                    old.schedule_removal()
-                except Exception:
-                    pass
-            job = context.application.job_queue.run_once(
-                callback=remarketing_job,
-                when=REMARKETING_DELAY_SECONDS,
-                chat_id=chat_id,
-                name=f"remarketing-{user_id}",
-                data={"user_id": user_id, "chat_id": chat_id},
+        # 1) Send image + text with the cached keyboard (ReplyKeyboard if HTTPS for WebApp sendData)
+        try:
+            await _send_funnel_message(
+                context.bot, update.effective_chat.id, tenant.start_message, tenant.markups().start, PRIORITY_INTERACTIVE
             )
-            scheduled_jobs[user_id] = job
+        except Exception as e:
+            events.emit("send_failed", bot=tenant.name, step="start", user_id=user_id, error=type(e).__name__)
+            raise
+
+        # 2) Schedule remarketing if not completed; a pending one keeps its original deadline
+        if user_id and chat_id:
+            _funnel(tenant.name, "start", user_id=user_id, username=username, chat_id=chat_id)
+            st = tenant.store.get(user_id)
+            if st is None or st.remarketing_at is None or st.chat_id != chat_id:
+                due_at = int(time.time()) + tenant.sequence[0].delay_seconds
+                remarketing_scheduler.schedule(tenant.index, user_id, chat_id, due_at)
     except Exception as e:
         logger.exception("Error in /start handler: %s", e)
 
 
+async def _complete_payment(
+    tenant: "Tenant", user_id, chat_id, order_id, source: str, pkg=None, prior: Optional[UserState] = None, **details
+) -> None:
+    """Cancel the pending remarketing of a payment already persisted by ``_record_payment``
+    and send the bot's final text. ``source`` is the confirmation path (webapp | postback),
+    ``prior`` the user state before the payment; ``details`` go to the event log."""
+    chat_id = chat_id or user_id  # chat privado: chat_id == user_id
+    if user_id:
+        _funnel(
+            tenant.name,
+            "paid",
+            pkg,
+            "remarketing" if prior and prior.flags & USER_REMARKETED else "direct",
+            user_id=user_id,
+            order_id=order_id,
+            via=source,
+            **details,
+        )
+        remarketing_scheduler.cancel(tenant.index, user_id)
+    # Send final message with button (inline)
+    try:
+        await tenant.application.bot.send_message(
+            chat_id=chat_id,
+            text=tenant.catalog.final_text,
+            reply_markup=tenant.markups().final,
+            rate_limit_args=PRIORITY_TRANSACTIONAL,
+        )
+    except Exception as e:
+        events.emit(
+            "send_failed", bot=tenant.name, step="final", user_id=user_id, order_id=order_id, error=type(e).__name__
+        )
+        logger.warning("Final message failed user_id=%s order_id=%s: %s", user_id, order_id, e)
+
+
+@_timed("on_webapp_data")
 async def on_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     msg = update.message
     if not msg or not msg.web_app_data:
         return
+    tenant: Tenant = context.bot_data["tenant"]
     raw = msg.web_app_data.data
     try:
         data = json.loads(raw)
     except Exception:
         data = {"raw": raw}
 
+    if not isinstance(data, dict):
+        return
     status = str(data.get("status", "")).lower()
     pkg = data.get("pkg")
     order_id = data.get("order_id")
@@ -388,30 +2882,15 @@ async def on_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     currency = data.get("currency", "")
 
     if status == "approved":
-        # Mark as completed and cancel any scheduled remarketing
         user_id = update.effective_user.id if update.effective_user else None
         username = update.effective_user.username if update.effective_user else None
-        if user_id:
-            completed_users.add(user_id)
-            job = scheduled_jobs.pop(user_id, None)
-            if job:
-                try:
-                    job.schedule_removal()
-                except Exception:
-                    pass
-
-        # Send final message with button (inline)
-        final_markup = InlineKeyboardMarkup(
-            [[InlineKeyboardButton(text=FINAL_BUTTON_TEXT, url=FINAL_BUTTON_URL)]]
-        )
-        await msg.reply_text(FINAL_APPROVED_TEXT, reply_markup=final_markup)
-        logger.info(
-            "PAID user_id=%s username=%s order_id=%s amount=%s currency=%s",
-            user_id,
-            username,
-            order_id,
-            amount,
-            currency,
+        claimed, prior = await asyncio.to_thread(_record_payment, tenant, user_id, msg.chat_id, order_id)
+        if not claimed:
+            # O postback do provedor já confirmou este pedido
+            return
+        await _complete_payment(
+            tenant, user_id, msg.chat_id, order_id, "webapp", pkg, prior,
+            username=username, amount=amount, currency=currency,
         )
         # End of flow for this user
     else:
@@ -419,13 +2898,266 @@ async def on_webapp_data(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
 
+# ----------------------
+# Bots (multi-tenant)
+# ----------------------
+class Catalog(NamedTuple):
+    """What one bot (persona) sends. ``DEFAULT_CATALOG`` holds the constants above; a bot
+    catalog file overrides any of these fields."""
+
+    start_image: str  # asset name (ASSETS_DIR) or file_id
+    start_text: str
+    packages: tuple  # (button text, checkout URL, code)
+    final_text: str
+    final_button_text: str
+    final_button_url: str
+    remarketing_image: str  # asset name (ASSETS_DIR) or file_id
+    remarketing_text: str
+    remarketing_button_text: str
+    remarketing_url: str
+    remarketing_delay_seconds: int
+    remarketing_sequence: tuple = ()  # SequenceStep…; empty = one step from the remarketing_* fields
+
+
+class SequenceStep(NamedTuple):
+    """One follow-up of the remarketing sequence, due ``delay_seconds`` after the previous
+    one was sent (the first: after /start)."""
+
+    delay_seconds: int
+    image: str  # asset name (ASSETS_DIR) or file_id
+    text: str
+    button_text: str
+    button_url: str
+    pkg: str = "combo"  # ?pkg= of the mini app link (funnel attribution)
+
+
+def _parse_sequence(steps, catalog: Catalog, where: str) -> tuple:
+    """``SequenceStep``s from a JSON list; fields a step leaves out come from ``catalog``'s
+    remarketing_* fields."""
+    if not isinstance(steps, list) or not steps:
+        raise SystemExit(f"{where}: remarketing_sequence must be a non-empty list of steps")
+    parsed = []
+    for i, step in enumerate(steps):
+        unknown = sorted(set(step) - set(SequenceStep._fields)) if isinstance(step, dict) else None
+        if unknown is None or unknown or "delay_seconds" not in step:
+            raise SystemExit(f"{where}: step {i} needs delay_seconds and only {', '.join(SequenceStep._fields)}")
+        parsed.append(
+            SequenceStep(
+                max(0, int(step["delay_seconds"])),
+                step.get("image") or catalog.remarketing_image,
+                step.get("text") or catalog.remarketing_text,
+                step.get("button_text") or catalog.remarketing_button_text,
+                step.get("button_url") or catalog.remarketing_url,
+                step.get("pkg") or "combo",
+            )
+        )
+    return tuple(parsed)
+
+
+def _sequence_of(catalog: Catalog) -> tuple:
+    return catalog.remarketing_sequence or (
+        SequenceStep(
+            catalog.remarketing_delay_seconds,
+            catalog.remarketing_image,
+            catalog.remarketing_text,
+            catalog.remarketing_button_text,
+            catalog.remarketing_url,
+        ),
+    )
+
+
+DEFAULT_CATALOG = Catalog(
+    # assets/start.* e assets/remarketing.*, quando existem, substituem os file_ids fixos
+    start_image="start" if "start" in assets else START_IMAGE_FILE_ID,
+    start_text=START_TEXT,
+    packages=PACKAGES,
+    final_text=FINAL_APPROVED_TEXT,
+    final_button_text=FINAL_BUTTON_TEXT,
+    final_button_url=FINAL_BUTTON_URL,
+    remarketing_image="remarketing" if "remarketing" in assets else REMARKETING_IMAGE_FILE_ID,
+    remarketing_text=REMARKETING_TEXT,
+    remarketing_button_text=REMARKETING_BUTTON_TEXT,
+    remarketing_url=REMARKETING_URL,
+    remarketing_delay_seconds=REMARKETING_DELAY_SECONDS,
+)
+if REMARKETING_SEQUENCE_FILE:
+    with open(REMARKETING_SEQUENCE_FILE, encoding="utf-8") as _fh:
+        DEFAULT_CATALOG = DEFAULT_CATALOG._replace(
+            remarketing_sequence=_parse_sequence(json.load(_fh), DEFAULT_CATALOG, REMARKETING_SEQUENCE_FILE)
+        )
+
+
+class Tenant:
+    """One bot served by this process: token, catalog, and its own state store and rate
+    limiter (Telegram limits are per bot). ``prefix`` is "" for the BOT_TOKEN bot and
+    "/<name>" for catalog bots; it prefixes the mini app routes and the webhook path.
+    """
+
+    def __init__(
+        self,
+        index: int,
+        name: str,
+        token: str,
+        catalog: Catalog,
+        prefix: str = "",
+        webhook_secret: str = "",
+        payment_secret: str = "",
+    ):
+        self.index = index
+        self.name = name
+        self.token = token
+        self.catalog = catalog
+        self.prefix = prefix
+        # Determinístico por token (mesmo valor em todo restart/réplica); só [A-Za-z0-9_-] é aceito
+        self.webhook_secret = webhook_secret or hashlib.sha256(f"webhook:{token}".encode()).hexdigest()
+        self.payment_secret = payment_secret
+        self.store = UserStateStore(
+            _open_state_backend(name if prefix else None),
+            STATE_CACHE_SIZE,
+            STATE_FLUSH_INTERVAL,
+            int(STATE_MEMORY_MB * 2**20),
+        )
+        self.limiter = PriorityRateLimiter(
+            SEND_GLOBAL_RATE, SEND_PER_CHAT_RATE, SEND_PER_CHAT_BURST, SEND_MAX_RETRIES, bot=name
+        )
+        self.limiter.on_unreachable = self._on_unreachable
+        self.broadcast: Optional["Broadcast"] = None
+        self.admission = StartAdmission(START_DEBOUNCE_SECONDS, START_ABUSE_LIMIT, START_ABUSE_WINDOW)
+        self.start_message = _compose("start", catalog.start_image, catalog.start_text)
+        self.sequence = _sequence_of(catalog)
+        self.remarketing_messages = tuple(_compose("remarketing", step.image, step.text) for step in self.sequence)
+        self.application: Optional[Application] = None
+        self._markups: Optional[_Markups] = None
+
+    def _on_unreachable(self, chat_id: int, reason: str) -> None:
+        # Chat privado: chat_id == user_id. O flag persiste (remarketing/broadcast pulam o usuário)
+        remarketing_scheduler.cancel(self.index, chat_id)
+        # Numa thread: o usuário pode estar fora do LRU e, em cluster, é relido do backend
+        future = asyncio.get_running_loop().run_in_executor(
+            None, self.store.mark_unreachable, chat_id, cluster is not None
+        )
+        future.add_done_callback(functools.partial(self._unreachable_stored, chat_id))
+        events.emit("unreachable", bot=self.name, user_id=chat_id, reason=reason)
+
+    def _unreachable_stored(self, chat_id: int, future: asyncio.Future) -> None:
+        if future.cancelled() or future.exception() is None:
+            return
+        # Só o índice em memória do limiter segue pulando o chat (perdido num restart)
+        metrics.inc("bot_unreachable_store_errors_total", (("bot", self.name),))
+        logger.error(
+            "Failed to store unreachable flag bot=%s user_id=%s", self.name, chat_id, exc_info=future.exception()
+        )
+
+    def markups(self) -> _Markups:
+        """Cached markups; rebuilt only when WEBAPP_BASE_URL changes (e.g. after ngrok)."""
+        cached = self._markups
+        if cached is None or cached.base_url != WEBAPP_BASE_URL:
+            cached = self._markups = _build_markups(self.catalog, self.sequence, self.prefix)
+        return cached
+
+
+_BOT_NAME_RE = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+
+
+def _load_catalog(path: str, index: int) -> Tenant:
+    """One ``<name>.json``: ``token`` (or ``token_env``), optional ``name``,
+    ``webhook_secret`` and ``payment_webhook_secret``, plus any ``Catalog`` field."""
+    with open(path, encoding="utf-8") as fh:
+        spec = json.load(fh)
+    name = str(spec.pop("name", "") or os.path.splitext(os.path.basename(path))[0])
+    token_env = spec.pop("token_env", "")
+    token = str(spec.pop("token", "") or (os.getenv(token_env, "") if token_env else "")).strip()
+    webhook_secret = spec.pop("webhook_secret", "")
+    payment_secret = spec.pop("payment_webhook_secret", PAYMENT_WEBHOOK_SECRET)
+    if not _BOT_NAME_RE.match(name):
+        raise SystemExit(f"{path}: bot name {name!r} must match [A-Za-z0-9_-]{{1,32}}")
+    if not token:
+        raise SystemExit(f"{path}: no token (set \"token\" or \"token_env\")")
+    unknown = sorted(set(spec) - set(Catalog._fields))
+    if unknown:
+        raise SystemExit(f"{path}: unknown catalog field(s) {', '.join(unknown)}")
+    if "packages" in spec:
+        spec["packages"] = tuple((p["text"], p["url"], p["code"]) for p in spec["packages"])
+    if "remarketing_delay_seconds" in spec:
+        spec["remarketing_delay_seconds"] = int(spec["remarketing_delay_seconds"])
+    sequence = spec.pop("remarketing_sequence", None)
+    catalog = DEFAULT_CATALOG._replace(**spec)
+    if sequence is not None:
+        catalog = catalog._replace(remarketing_sequence=_parse_sequence(sequence, catalog, path))
+    return Tenant(index, name, token, catalog, f"/{name}", webhook_secret, payment_secret)
+
+
+def _load_tenants() -> list:
+    if not BOT_CATALOG_DIR:
+        return [Tenant(0, BOT_NAME, BOT_TOKEN, DEFAULT_CATALOG, "", WEBHOOK_SECRET_TOKEN, PAYMENT_WEBHOOK_SECRET)]
+    paths = sorted(glob.glob(os.path.join(BOT_CATALOG_DIR, "*.json")))
+    if not paths:
+        raise SystemExit(f"No bot catalogs (*.json) in BOT_CATALOG_DIR={BOT_CATALOG_DIR}")
+    if len(paths) > 1 << _TENANT_BITS:
+        raise SystemExit(f"At most {1 << _TENANT_BITS} bots per process, found {len(paths)}")
+    loaded = [_load_catalog(path, i) for i, path in enumerate(paths)]
+    names = [t.name for t in loaded]
+    duplicated = sorted({n for n in names if names.count(n) > 1})
+    if duplicated:
+        raise SystemExit(f"Duplicate bot name(s) in BOT_CATALOG_DIR: {', '.join(duplicated)}")
+    return loaded
+
+
+tenants = _load_tenants()
+_tenant_routes = {t.prefix[1:] or None: t for t in tenants}  # route prefix (None = unprefixed) -> bot
+_FUNNEL_PKGS.update(code for t in tenants for _, _, code in t.catalog.packages)
+remarketing_scheduler = RemarketingScheduler([t.store for t in tenants], STATE_SHARDS)
+
+
+def _cluster_backend():
+    # Leases no backend raiz (STATE_DIR / REDIS_PREFIX), não no de um bot do catálogo
+    return tenants[0].store.backend if not tenants[0].prefix else _open_state_backend()
+
+
+cluster = PartitionLeases(_cluster_backend(), CLUSTER_INSTANCE_ID, STATE_SHARDS, CLUSTER_LEASE_SECONDS) if CLUSTER else None
+
+
+def _per_bot(fn) -> dict:
+    return {(("bot", t.name),): fn(t) for t in tenants}
+
+
+metrics.gauge(
+    "bot_remarketing_pending",
+    "Users with a pending remarketing (in this replica's heap), by bot.",
+    lambda: _per_bot(lambda t: remarketing_scheduler.pending[t.index]),
+)
+metrics.gauge(
+    "bot_cluster_partitions_owned",
+    "Remarketing partitions owned by this replica (CLUSTER=true).",
+    lambda: len(cluster.owned) if cluster is not None else STATE_SHARDS,
+)
+metrics.gauge("bot_completed_users", "Users who completed payment, by bot.", lambda: _per_bot(lambda t: t.store.count_completed()))
+metrics.gauge(
+    "bot_unreachable_chats",
+    "Private chats in the send suppression index (blocked/deactivated/not found), by bot.",
+    lambda: _per_bot(lambda t: len(t.limiter.unreachable)),
+)
+metrics.gauge(
+    "bot_state_memory_bytes",
+    "Estimated memory of the user state cache and paid-user ids, by bot (STATE_MEMORY_MB).",
+    lambda: _per_bot(lambda t: t.store.memory_bytes),
+)
+metrics.gauge(
+    "bot_send_queue_depth",
+    "Sends waiting in the rate limiter, by bot and lane.",
+    lambda: {
+        (("bot", t.name), ("lane", _LANE_NAMES[p])): n for t in tenants for p, n in t.limiter.queue_depth.items()
+    },
+)
 
 
 def _maybe_enable_ngrok() -> Optional[str]:
     global WEBAPP_BASE_URL
     if not USE_NGROK:
         return None
-    if ngrok is None:
+    try:
+        from pyngrok import ngrok  # optional dependency, only for USE_NGROK=true (~0.1s to import)
+    except ImportError:
         logger.warning("USE_NGROK=true but pyngrok not installed; skipping ngrok setup.")
         return None
     try:
@@ -446,15 +3178,99 @@ def _maybe_enable_ngrok() -> Optional[str]:
         return None
 
 
-def main() -> None:
-    # Start Flask app (mini app) in background
-    threading.Thread(target=run_flask, name="flask-thread", daemon=True).start()
-    # Optionally start ngrok to get HTTPS for WebApp buttons
-    _maybe_enable_ngrok()
-    logger.info("Mini app running at %s (PORT=%s)", WEBAPP_BASE_URL, PORT)
+_bot_loop: Optional[asyncio.AbstractEventLoop] = None
+
 
-    # Start Telegram bot (polling)
-    application = Application.builder().token(BOT_TOKEN).build()
+async def _post_init(application: Application) -> None:
+    """Start the shared jobs (remarketing tick, cluster leases) on ``application``'s JobQueue;
+    they serve every bot."""
+    if cluster is not None:
+        # Sem partições até o primeiro refresh: as pendências entram conforme os leases
+        remarketing_scheduler.owned = set()
+        application.job_queue.run_repeating(
+            _cluster_tick, interval=CLUSTER_LEASE_SECONDS / 3, first=0, name="cluster-leases"
+        )
+        application.job_queue.run_repeating(
+            _cluster_resync, interval=CLUSTER_RESYNC_SECONDS, first=CLUSTER_RESYNC_SECONDS, name="cluster-resync"
+        )
+    application.job_queue.run_repeating(
+        _remarketing_tick,
+        interval=REMARKETING_TICK_SECONDS,
+        first=0,
+        name="remarketing-tick",
+    )
+    if STATE_TTL_DAYS > 0:
+        application.job_queue.run_repeating(_expire_states, interval=3600, first=60, name="state-expiry")
+
+
+async def _expire_states(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Idempotente: em modo cluster todas as réplicas podem rodar, o DELETE é o mesmo
+    for tenant in tenants:
+        if tenant.broadcast is not None and tenant.broadcast.state == "running":
+            continue  # não encolhe a audiência no meio da campanha; fica para a próxima hora
+        try:
+            expired = await asyncio.to_thread(tenant.store.expire, STATE_TTL_DAYS * 86400)
+        except Exception as e:
+            logger.warning("State expiry failed bot=%s: %s", tenant.name, e)
+            continue
+        if expired:
+            logger.info("Expired %s idle user state(s) bot=%s (STATE_TTL_DAYS=%s)", expired, tenant.name, STATE_TTL_DAYS)
+
+
+def _cluster_window() -> int:
+    # Só as pendências que vencem antes da próxima ressincronização ficam no heap
+    return int(time.time() + 2 * CLUSTER_RESYNC_SECONDS)
+
+
+async def _cluster_tick(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        gained, lost = await asyncio.to_thread(cluster.refresh)
+    except Exception as e:
+        logger.warning("Cluster lease refresh failed: %s", e)
+        return
+    if lost:
+        remarketing_scheduler.drop(lost)
+    remarketing_scheduler.owned = set(cluster.owned)
+    if gained:
+        restored = await asyncio.to_thread(remarketing_scheduler.restore, sorted(gained), _cluster_window())
+        logger.info(
+            "CLUSTER instance=%s members=%s partitions=%s gained=%s lost=%s restored=%s",
+            cluster.instance_id,
+            cluster.members,
+            sorted(cluster.owned),
+            sorted(gained),
+            sorted(lost),
+            restored,
+        )
+    elif lost:
+        logger.info("CLUSTER instance=%s lost partitions %s", cluster.instance_id, sorted(lost))
+
+
+async def _cluster_resync(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Remarketings agendados por outras réplicas nas partições desta
+    owned = sorted(cluster.owned)
+    if owned:
+        try:
+            await asyncio.to_thread(remarketing_scheduler.restore, owned, _cluster_window())
+        except Exception as e:
+            logger.warning("Cluster resync failed: %s", e)
+
+
+def _build_application(tenant: Tenant, sends: PooledRequest, updates: PooledRequest) -> Application:
+    builder = Application.builder().token(tenant.token)
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(f"{BOT_API_BASE_URL}/bot").base_file_url(f"{BOT_API_BASE_URL}/file/bot")
+    application = (
+        builder
+        .request(sends)
+        .get_updates_request(updates)
+        .concurrent_updates(
+            UserOrderedUpdateProcessor(CONCURRENT_UPDATES) if CONCURRENT_UPDATES > 1 else 1
+        )
+        .rate_limiter(tenant.limiter)
+        .build()
+    )
+    application.bot_data["tenant"] = tenant
     # Garantir JobQueue ativo mesmo se o extra não for detectado
     if application.job_queue is None:
         jq = JobQueue()
@@ -467,34 +3283,736 @@ def main() -> None:
     except Exception:
         # Fallback para capturar em qualquer mensagem
         application.add_handler(MessageHandler(filters.ALL, on_webapp_data))
-    logger.info("Bot is starting (polling mode)…")
-    application.run_polling()
+    return application
 
 
-async def remarketing_job(context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = context.job.data or {}
-    user_id = data.get("user_id")
-    chat_id = data.get("chat_id")
+def _build_applications() -> None:
+    """One Application per bot. All of them share the sends pool, and the getUpdates pool
+    holds one long-poll connection per bot, which never takes a slot from the sends."""
+    sends = _bot_api_request("sends", BOT_API_POOL_SIZE, read_timeout=BOT_API_READ_TIMEOUT)
+    updates = _bot_api_request("updates", len(tenants))
+    for tenant in tenants:
+        tenant.application = _build_application(tenant, sends, updates)
+
+
+# ----------------------
+# Remarketing waves
+# ----------------------
+metrics.describe("bot_remarketing_step_sent_total", "counter", "Remarketing sequence messages sent, by bot and step (0 = first).")
+_remarketing_slots = asyncio.Semaphore(REMARKETING_CONCURRENCY)
+_remarketing_batches = itertools.count(1)
+
 
+async def _remarketing_tick(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Um único job repetitivo para todos os usuários de todos os bots; junta os vencidos em lotes (ondas)
+    if _draining.is_set():
+        return
+    now = time.time()
+    while True:
+        due = remarketing_scheduler.pop_due(now, REMARKETING_BATCH_SIZE)
+        if due:
+            context.application.create_task(_dispatch_remarketing_batch(due))
+        if len(due) < REMARKETING_BATCH_SIZE:
+            return
+        await asyncio.sleep(0)
+
+
+async def _dispatch_remarketing_batch(due: list) -> dict:
+    """Send one wave: each user gets a random offset inside REMARKETING_WAVE_SECONDS and at
+    most REMARKETING_CONCURRENCY sends run at once. Logs the per-batch outcome counts."""
+    batch_no = next(_remarketing_batches)
+    started = time.monotonic()
+
+    async def one(bot: int, user_id: int, due_at: int) -> str:
+        tenant = tenants[bot]
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(_draining.wait(), random.uniform(0, REMARKETING_WAVE_SECONDS))
+        async with _remarketing_slots:
+            if _draining.is_set():
+                # Ainda não reivindicado: continua pendente no store e entra no snapshot
+                remarketing_scheduler.defer(bot, user_id, due_at)
+                return "deferred"
+            try:
+                st = await asyncio.to_thread(tenant.store.get, user_id)
+                if st is None or st.remarketing_at != due_at:
+                    return "skipped"
+                step = st.step
+                if step >= len(tenant.sequence):
+                    # Sequência encurtada desde o agendamento: não há mais o que enviar
+                    await asyncio.to_thread(tenant.store.clear_remarketing, user_id)
+                    return "skipped"
+                # O próximo passo conta a partir deste envio (um atraso não encavala os passos)
+                next_at = None
+                if step + 1 < len(tenant.sequence):
+                    next_at = int(time.time()) + tenant.sequence[step + 1].delay_seconds
+                # Claim no backend antes de enviar: pago/reagendado ou já levado por outra réplica;
+                # o mesmo claim já grava o próximo passo
+                if not await asyncio.to_thread(tenant.store.claim_remarketings, [(user_id, due_at, step, next_at)]):
+                    return "skipped"
+                if next_at is not None:
+                    remarketing_scheduler.advance(bot, user_id, next_at)
+                return await remarketing_job(tenant, user_id, step)
+            except Exception as e:
+                logger.warning("Remarketing failed bot=%s user_id=%s: %s", tenant.name, user_id, e)
+                return "failed"
+
+    outcomes = await asyncio.gather(*(one(*item) for item in due))
+    counts = dict.fromkeys(("sent", "failed", "blocked", "skipped", "deferred"), 0)
+    for outcome in outcomes:
+        counts[outcome] += 1
+    logger.info(
+        "REMARKETING batch=%s size=%s sent=%s failed=%s blocked=%s skipped=%s deferred=%s elapsed=%.1fs",
+        batch_no,
+        len(due),
+        counts["sent"],
+        counts["failed"],
+        counts["blocked"],
+        counts["skipped"],
+        counts["deferred"],
+        time.monotonic() - started,
+    )
+    return counts
+
+
+@_timed("remarketing_job")
+async def remarketing_job(tenant: "Tenant", user_id: int, step: int = 0) -> str:
+    """Send step ``step`` of the bot's remarketing sequence to one (already claimed) user;
+    returns sent | failed | blocked | skipped."""
+    st = tenant.store.get(user_id)
     # Skip if already completed
-    if user_id in completed_users:
+    if st is None or st.flags & USER_COMPLETED:
+        return "skipped"
+    if st.flags & USER_UNREACHABLE or user_id in tenant.limiter.unreachable:
+        metrics.inc("bot_unreachable_calls_avoided_total", (("bot", tenant.name), ("via", "remarketing")))
+        return "blocked"
+    chat_id = st.chat_id
+
+    # Send remarketing image + text + button (remarketing lane, below /start replies)
+    try:
+        await _send_funnel_message(
+            tenant.application.bot,
+            chat_id,
+            tenant.remarketing_messages[step],
+            tenant.markups().remarketing[step],
+            PRIORITY_REMARKETING,
+        )
+    except Forbidden:
+        events.emit(
+            "send_failed", bot=tenant.name, step="remarketing", user_id=user_id, error="Forbidden", seq_step=step
+        )
+        return "blocked"
+    except Exception as e:
+        events.emit(
+            "send_failed", bot=tenant.name, step="remarketing", user_id=user_id, error=type(e).__name__, seq_step=step
+        )
+        logger.warning("Remarketing failed bot=%s user_id=%s step=%s: %s", tenant.name, user_id, step, e)
+        return "failed"
+    metrics.inc("bot_remarketing_step_sent_total", (("bot", tenant.name), ("step", str(step))))
+    _funnel(tenant.name, "remarketing_sent", tenant.sequence[step].pkg, "remarketing", user_id=user_id, seq_step=step)
+    return "sent"
+
+
+# ----------------------
+# Broadcast
+# ----------------------
+_BROADCAST_EXCLUDE = USER_COMPLETED | USER_UNREACHABLE
+_BROADCAST_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+_BROADCAST_OUTCOMES = ("scanned", "sent", "skipped", "blocked", "failed")
+
+
+class _SentLog:
+    """Append-only log of broadcast recipients, written off the event loop. Ids appended in
+    the same loop iteration share one ``os.write`` in a thread; ``append`` returns once its
+    id is on disk, so each send still happens after its log entry."""
+
+    def __init__(self, fd: int):
+        self._fd = fd
+        self._batch = []
+        self._writing: Optional[asyncio.Future] = None
+
+    async def append(self, user_id: int) -> None:
+        self._batch.append(user_id.to_bytes(8, sys.byteorder, signed=True))
+        if self._writing is None:
+            self._writing = asyncio.ensure_future(self._write())
+        await asyncio.shield(self._writing)
+
+    async def _write(self) -> None:
+        await asyncio.sleep(0)  # junta os ids dos outros envios prontos nesta volta do loop
+        batch, self._batch, self._writing = b"".join(self._batch), [], None
+        await asyncio.to_thread(os.write, self._fd, batch)
+
+
+class Broadcast:
+    """One campaign to a bot's unpaid, reachable users, resumable after a crash or deploy.
+
+    Users are read from the store a page at a time (``audience_page`` cursor) and sent on the
+    broadcast lane, paced by a token bucket and at most ``concurrency`` at once. Progress is
+    ``<dir>/<id>.json`` (spec, cursor of the last finished page, counts), rewritten after
+    every page. Each user of the current page is appended to ``<id>.sent`` *before* the
+    send and the log is cut with the page's checkpoint; a resume re-reads the page and
+    skips the logged users, so nobody gets it twice (a crash loses at most the sends in
+    flight).
+    """
+
+    def __init__(self, tenant: "Tenant", directory: str, spec: dict, progress: Optional[dict] = None):
+        progress = progress or {}
+        catalog = tenant.catalog
+        self.tenant = tenant
+        self.id = spec["id"]
+        self.spec = spec
+        self.state = progress.get("state", "running")  # running | paused | done
+        self.cursor = progress.get("cursor")
+        self.counts = {**dict.fromkeys(_BROADCAST_OUTCOMES, 0), **progress.get("counts", {})}
+        self.audience = progress.get("audience")
+        self.created_at = progress.get("created_at", time.time())
+        self.finished_at = progress.get("finished_at")
+        self.message = _compose(
+            "broadcast", spec.get("image") or catalog.remarketing_image, spec.get("text") or catalog.remarketing_text
+        )
+        self._path = os.path.join(directory, f"{self.id}.json")
+        self._log_path = os.path.join(directory, f"{self.id}.sent")
+        self._resumed = (time.monotonic(), self.counts["sent"])
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def load(cls, tenant: "Tenant", directory: str, broadcast_id: str) -> Optional["Broadcast"]:
+        try:
+            with open(os.path.join(directory, f"{broadcast_id}.json"), encoding="utf-8") as fh:
+                saved = json.load(fh)
+        except FileNotFoundError:
+            return None
+        return cls(tenant, directory, saved["spec"], saved)
+
+    def start(self) -> None:
+        self.state = "running"
+        self._task = self.tenant.application.create_task(self._run(), name=f"broadcast-{self.id}")
+
+    def pause(self) -> None:
+        # Os envios em andamento terminam; o checkpoint fica no começo da página atual
+        if self.state == "running":
+            self.state = "paused"
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def status(self) -> dict:
+        elapsed = time.monotonic() - self._resumed[0]
+        rate = (self.counts["sent"] - self._resumed[1]) / elapsed if self.running and elapsed > 0 else 0.0
+        remaining = None if self.audience is None else max(0, self.audience - self.counts["scanned"])
+        return {
+            "id": self.id,
+            "state": self.state,
+            "audience": self.audience,
+            **self.counts,
+            "rate": round(rate, 1),
+            "eta_seconds": round(remaining / rate) if rate and remaining is not None else None,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+    def _read_log(self) -> set:
+        try:
+            with open(self._log_path, "rb") as fh:
+                raw = fh.read()
+        except FileNotFoundError:
+            return set()
+        logged = array.array("q")
+        logged.frombytes(raw[: len(raw) - len(raw) % 8])
+        return set(logged)
+
+    def _checkpoint(self, counts: dict, cut_log: bool) -> None:
+        body = {
+            "spec": self.spec,
+            "state": self.state,
+            "cursor": self.cursor,
+            "counts": counts,
+            "audience": self.audience,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+        tmp = self._path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(body, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self._path)
+        if cut_log:
+            # Depois do checkpoint: um crash entre os dois só deixa ids já cobertos pelo cursor
+            os.truncate(self._log_path, 0)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        store, limiter, bot = self.tenant.store, self.tenant.limiter, self.tenant.application.bot
+        markups = self.tenant.markups()
+        spec = self.spec
+        reply_kb, inline_kb = _offer_reply_markup(
+            markups.base_url + self.tenant.prefix,
+            spec.get("button_text") or self.tenant.catalog.remarketing_button_text,
+            spec.get("button_url") or self.tenant.catalog.remarketing_url,
+            spec.get("pkg") or "combo",
+            "broadcast",
+        )
+        markup = _serialize_markup(reply_kb if reply_kb is not None else inline_kb)
+        logged = await asyncio.to_thread(self._read_log)
+        if self.audience is None and self.cursor is None:
+            self.audience = await asyncio.to_thread(store.count_audience, _BROADCAST_EXCLUDE)
+        # Já no início: um crash na primeira página também retoma (com o log de enviados)
+        await asyncio.to_thread(self._checkpoint, dict(self.counts), False)
+        bucket = TokenBucket(spec.get("rate") or BROADCAST_RATE, 1.0, loop.time())
+        slots = asyncio.Semaphore(spec.get("concurrency") or BROADCAST_CONCURRENCY)
+        log_fd = os.open(self._log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        sent_log = _SentLog(log_fd)
+        self._resumed = (time.monotonic(), self.counts["sent"])
+
+        def stopped() -> bool:
+            return self.state != "running" or _draining.is_set()
+
+        async def one(user_id: int, chat_id: int) -> None:
+            async with slots:
+                if user_id in logged:
+                    # Enviado antes do crash (o log é gravado antes do envio)
+                    self.counts["scanned"] += 1
+                    self.counts["sent"] += 1
+                    return
+                wait = bucket.reserve(loop.time())
+                if wait:
+                    await asyncio.sleep(wait)
+                if stopped():
+                    return
+                self.counts["scanned"] += 1
+                # Pagou ou ficou inalcançável depois da leitura da página (ainda no buffer); só
+                # memória: a página acabou de vir do backend, nada de leitura bloqueante no loop
+                if store.completed_in_memory(user_id) or user_id in limiter.unreachable:
+                    self.counts["skipped"] += 1
+                    return
+                await sent_log.append(user_id)
+                try:
+                    await _send_funnel_message(bot, chat_id, self.message, markup, PRIORITY_BROADCAST)
+                    self.counts["sent"] += 1
+                except Forbidden:
+                    self.counts["blocked"] += 1
+                except Exception as e:
+                    self.counts["failed"] += 1
+                    events.emit("send_failed", bot=self.tenant.name, step="broadcast", user_id=user_id, error=type(e).__name__)
+
+        reporter = asyncio.create_task(self._report())
+        committed = dict(self.counts)
+        try:
+            while not stopped():
+                rows, next_cursor = await asyncio.to_thread(
+                    store.audience_page, self.cursor, BROADCAST_PAGE_SIZE, _BROADCAST_EXCLUDE
+                )
+                await asyncio.gather(*(one(user_id, chat_id) for user_id, chat_id in rows))
+                if stopped():
+                    break  # página incompleta: o resume relê a página e o log pula quem já recebeu
+                self.cursor = next_cursor
+                if next_cursor is None:
+                    self.state, self.finished_at = "done", time.time()
+                committed = dict(self.counts)
+                logged = set()
+                await asyncio.to_thread(self._checkpoint, committed, True)
+        except Exception:
+            logger.exception("Broadcast %s bot=%s stopped", self.id, self.tenant.name)
+            self.state = "paused"
+        finally:
+            reporter.cancel()
+            os.close(log_fd)
+            if self.state != "done":
+                # Pausado/drenando: contagens do último checkpoint (a página atual será relida)
+                await asyncio.to_thread(self._checkpoint, committed, False)
+        logger.info("BROADCAST %s bot=%s %s", self.id, self.tenant.name, self._summary())
+
+    def _summary(self) -> str:
+        status = self.status()
+        return " ".join(f"{k}={status[k]}" for k in ("state", "audience", *_BROADCAST_OUTCOMES, "rate", "eta_seconds"))
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(10)
+            logger.info("BROADCAST %s bot=%s %s", self.id, self.tenant.name, self._summary())
+
+
+def _broadcast_dir(tenant: "Tenant") -> str:
+    return os.path.join(BROADCAST_DIR, tenant.name)
+
+
+async def _start_broadcast(tenant: "Tenant", spec: dict) -> tuple:
+    """Start ``spec`` on ``tenant`` (event loop); an id with a checkpoint resumes from it.
+    Returns (HTTP status, body)."""
+    if tenant.broadcast is not None and tenant.broadcast.running:
+        return 409, {"error": "a broadcast is running", "broadcast": tenant.broadcast.status()}
+    directory = _broadcast_dir(tenant)
+    await asyncio.to_thread(os.makedirs, directory, exist_ok=True)
+    broadcast = await asyncio.to_thread(Broadcast.load, tenant, directory, spec["id"])
+    if broadcast is None:
+        broadcast = Broadcast(tenant, directory, spec)
+    elif broadcast.state == "done":
+        return 409, {"error": "broadcast already finished", "broadcast": broadcast.status()}
+    tenant.broadcast = broadcast
+    broadcast.start()
+    logger.info("BROADCAST %s bot=%s started (cursor=%s)", broadcast.id, tenant.name, broadcast.cursor)
+    return 202, broadcast.status()
+
+
+async def _resume_broadcasts() -> None:
+    """At startup: carry on the broadcasts a stop/crash left running (not in clustered mode,
+    where any replica could; there they resume with a new POST of the same id)."""
+    if cluster is not None:
         return
+    for tenant in tenants:
+        directory = _broadcast_dir(tenant)
+        for path in await asyncio.to_thread(glob.glob, os.path.join(directory, "*.json")):
+            broadcast_id = os.path.basename(path)[:-5]
+            broadcast = await asyncio.to_thread(Broadcast.load, tenant, directory, broadcast_id)
+            if broadcast is not None and broadcast.state == "running":
+                await _start_broadcast(tenant, broadcast.spec)
+                break
+
+
+metrics.gauge(
+    "bot_broadcast_users",
+    "Users of the bot's current broadcast, by bot, id and outcome (scanned, sent, skipped, blocked, failed).",
+    lambda: {
+        (("bot", t.name), ("id", t.broadcast.id), ("outcome", k)): v
+        for t in tenants
+        if t.broadcast is not None
+        for k, v in t.broadcast.counts.items()
+    },
+)
+metrics.gauge(
+    "bot_broadcast_rate",
+    "Sends per second of the bot's running broadcast since it (re)started, by bot and id.",
+    lambda: {(("bot", t.name), ("id", t.broadcast.id)): t.broadcast.status()["rate"] for t in tenants if t.broadcast is not None},
+)
+
+
+# ----------------------
+# Webhook (ASGI)
+# ----------------------
+async def _asgi_respond(send, status: int, body: bytes = b"", content_type: bytes = b"text/plain") -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _asgi_read_body(receive, limit: int) -> Optional[bytes]:
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
 
-    # Send remarketing image + text + button
+def _build_asgi_app(webhook: bool = True):
+    """Single ASGI app: Telegram updates on each bot's ``<prefix>WEBHOOK_PATH``, everything
+    else goes to Flask.
+
+    Updates are parsed and pushed straight into the bot's ``application.update_queue`` on
+    the shared event loop; the Flask routes (/webapp, /pagamento-aprovado, /health) run
+    through a2wsgi's adapter in a pool of HTTP_THREADS threads so they never block the loop.
+    """
+    from a2wsgi import WSGIMiddleware
+
+    flask_asgi = WSGIMiddleware(app, workers=HTTP_THREADS)
+    webhooks = {f"{t.prefix}{WEBHOOK_PATH}": t for t in tenants} if webhook else {}
+
+    async def telegram_webhook(tenant: Tenant, scope, receive, send) -> None:
+        if scope["method"] != "POST":
+            await _asgi_respond(send, 405)
+            return
+        secret = dict(scope["headers"]).get(b"x-telegram-bot-api-secret-token", b"")
+        if not hmac.compare_digest(secret, tenant.webhook_secret.encode()):
+            await _asgi_respond(send, 403)
+            return
+        if _draining.is_set():
+            await _asgi_respond(send, 503)  # desligando: o Telegram reenvia (para a próxima instância)
+            return
+        body = await _asgi_read_body(receive, WEBHOOK_MAX_BODY_BYTES)
+        if body is None:
+            await _asgi_respond(send, 413)
+            return
+        application = tenant.application
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except Exception:
+            logger.warning("Invalid update payload received on webhook (bot=%s)", tenant.name)
+            await _asgi_respond(send, 400)
+            return
+        await application.update_queue.put(update)
+        await _asgi_respond(send, 200)
+
+    async def asgi_app(scope, receive, send) -> None:
+        tenant = webhooks.get(scope["path"]) if scope["type"] == "http" else None
+        if tenant is not None:
+            await telegram_webhook(tenant, scope, receive, send)
+            return
+        await flask_asgi(scope, receive, send)
+
+    return asgi_app
+
+
+def _uvicorn_server(webhook: bool):
+    """uvicorn on the current event loop; ``serve()`` returns once ``should_exit`` is set
+    (by _drain, after the bots have stopped) and the open requests are answered."""
+    import uvicorn
+
+    class Server(uvicorn.Server):
+        @contextlib.contextmanager
+        def capture_signals(self):
+            # SIGINT/SIGTERM são tratados por _run: o HTTP só para na sua vez do desligamento
+            yield
+
+    return Server(
+        uvicorn.Config(
+            _build_asgi_app(webhook=webhook),
+            host="0.0.0.0",
+            port=PORT,
+            lifespan="off",
+            log_level="warning",
+            timeout_keep_alive=HTTP_KEEPALIVE_SECONDS,
+            limit_concurrency=HTTP_CONNECTION_LIMIT,
+            backlog=HTTP_BACKLOG,
+            timeout_graceful_shutdown=HTTP_SHUTDOWN_TIMEOUT,
+        )
+    )
+
+
+async def _wait_for_stop_signal() -> None:
+    # Só o primeiro sinal: um segundo SIGINT/SIGTERM encerra na hora, sem esperar o dreno
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
     try:
-        await context.bot.send_photo(chat_id=chat_id, photo=REMARKETING_IMAGE_FILE_ID)
-    except Exception:
-        pass
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+
+
+async def _set_webhook(tenant: Tenant) -> None:
+    webhook_url = f"{WEBHOOK_BASE_URL or WEBAPP_BASE_URL}{tenant.prefix}{WEBHOOK_PATH}"
+    if not _is_https(webhook_url):
+        raise SystemExit(f"Webhook URL must be HTTPS, got {webhook_url}. Set WEBHOOK_BASE_URL.")
+    await tenant.application.bot.set_webhook(
+        url=webhook_url,
+        secret_token=tenant.webhook_secret,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES,
+    )
+
+
+async def _http_listening(server, serving: asyncio.Task) -> None:
+    while not server.started:
+        if serving.done():
+            raise SystemExit(f"HTTP server did not start on PORT={PORT}")
+        await asyncio.sleep(0.01)
+
+
+async def _initialize_bots() -> None:
+    # get_me de todos os bots em paralelo, depois a verificação das imagens (usa cada bot)
+    applications = [t.application for t in tenants]
+    results = await startup.timed(
+        "get_me", asyncio.gather(*(a.initialize() for a in applications), return_exceptions=True)
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    images = [
+        (t.application.bot, i)
+        for t in tenants
+        for i in {t.catalog.start_image, t.catalog.remarketing_image, *(step.image for step in t.sequence)}
+    ]
+    checked = await startup.timed("assets", assets.verify(images, ASSET_CHECK_CONCURRENCY))
+    logger.info("Images checked: %s", " ".join(f"{k}={v}" for k, v in checked.items()))
+
+
+async def _restore_remarketing() -> None:
+    if cluster is not None:
+        # Sem partições até o primeiro refresh dos leases: as pendências entram conforme eles
+        remarketing_scheduler.owned = set()
+        return
+    loaded = await asyncio.to_thread(remarketing_scheduler.load_snapshot, SNAPSHOT_FILE, [t.name for t in tenants])
+    if loaded is not None:
+        logger.info("Restored %s pending remarketing(s) from snapshot %s", loaded, SNAPSHOT_FILE)
+        return
+    restored = await asyncio.to_thread(remarketing_scheduler.restore)
+    if restored:
+        logger.info("Restored %s pending remarketing(s) from state store", restored)
+
 
-    reply_kb, inline_kb = _remarketing_reply_markup()
-    if reply_kb is not None:
-        await context.bot.send_message(chat_id=chat_id, text=REMARKETING_TEXT, reply_markup=reply_kb, disable_web_page_preview=True)
+async def _start_bot(tenant: Tenant, webhook: bool) -> None:
+    if webhook:
+        await _set_webhook(tenant)
     else:
-        await context.bot.send_message(chat_id=chat_id, text=REMARKETING_TEXT, reply_markup=inline_kb, disable_web_page_preview=True)
-    return
+        await tenant.application.updater.start_polling()
+    await tenant.application.start()
 
-    logger.info("Bot is starting (polling mode)…")
-    application.run_polling()
+
+async def _warm_up(webhook: bool, server, serving: asyncio.Task) -> None:
+    """Startup phases. HTTP bind, ngrok, the bots' get_me + image check and the state restore
+    don't depend on each other and run at once; markups and webhooks wait for ngrok's URL."""
+    phases = [
+        startup.timed("ngrok", asyncio.to_thread(_maybe_enable_ngrok)),
+        startup.timed("bots", _initialize_bots()),
+        startup.timed("restore", _restore_remarketing()),
+    ]
+    if server is not None:
+        phases.append(startup.timed("http", _http_listening(server, serving)))
+    results = await asyncio.gather(*phases, return_exceptions=True)
+    for result in results[1:]:
+        if isinstance(result, BaseException):
+            raise result
+    if USE_NGROK and not isinstance(results[0], str):
+        # Opcional como antes: os bots atendem normalmente, só sem botões WebApp
+        startup.warnings["ngrok"] = "no tunnel (see the log)"
+    logger.info("Mini app running at %s (PORT=%s)", WEBAPP_BASE_URL, PORT)
+    for tenant in tenants:
+        tenant.markups()
+    await _post_init(tenants[0].application)
+    await startup.timed("start", asyncio.gather(*(_start_bot(t, webhook) for t in tenants)))
+    startup.record("ready", startup.started)
+    startup.ready = True
+    logger.info(
+        "Bot is starting (%s mode): %s", "webhook" if webhook else "polling", ", ".join(t.name for t in tenants)
+    )
+    logger.info("Startup: %s", startup.report())
+    await _resume_broadcasts()
+
+
+def _checkpoint() -> None:
+    """Flush every bot's write-behind buffer and, on a single instance whose scheduler was
+    fully restored, snapshot the pending remarketings for the next start. Blocking."""
+    for tenant in tenants:
+        tenant.store.flush()
+    if cluster is None and remarketing_scheduler.restored:
+        count = remarketing_scheduler.save_snapshot(SNAPSHOT_FILE, [t.name for t in tenants])
+        logger.info("Snapshot: %s pending remarketing(s) written to %s", count, SNAPSHOT_FILE)
+
+
+async def _drain(server, serving: Optional[asyncio.Task]) -> None:
+    """Shutdown in order, within SHUTDOWN_DRAIN_SECONDS: stop taking updates, let the
+    handlers and their queued sends finish, drain the HTTP server, then checkpoint."""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + SHUTDOWN_DRAIN_SECONDS
+    applications = [t.application for t in tenants]
+    steps = {}
+    startup.stopping = True  # /health: 503
+    _draining.set()  # webhooks 503 (o Telegram reenvia depois), sem novas ondas de remarketing
+
+    mark = loop.time()
+    await asyncio.gather(
+        *(a.updater.stop() for a in applications if a.updater is not None and a.updater.running),
+        return_exceptions=True,
+    )
+    steps["updates"] = loop.time() - mark
+
+    # Updates já recebidos, handlers em andamento e os envios deles na fila do limiter
+    mark = loop.time()
+    stopping = {asyncio.ensure_future(a.stop()): t for t, a in zip(tenants, applications) if a.running}
+    if stopping:
+        _, late = await asyncio.wait(stopping, timeout=max(0.0, deadline - loop.time()))
+        if late:
+            logger.warning(
+                "Drain deadline (%ss) reached: %s update(s) not processed, %s send(s) still queued; "
+                "stop cancelled for bot(s) %s",
+                SHUTDOWN_DRAIN_SECONDS,
+                sum(a.update_queue.qsize() for a in applications),
+                sum(sum(t.limiter.queue_depth.values()) for t in tenants),
+                ", ".join(stopping[task].name for task in late),
+            )
+            for task in late:
+                task.cancel()
+            await asyncio.wait(late)
+        for task, tenant in stopping.items():
+            if not task.cancelled() and task.exception() is not None:
+                logger.error("Stopping bot=%s failed", tenant.name, exc_info=task.exception())
+    steps["handlers"] = loop.time() - mark
+
+    mark = loop.time()
+    if server is not None:
+        server.config.timeout_graceful_shutdown = max(1.0, min(HTTP_SHUTDOWN_TIMEOUT, deadline - loop.time()))
+        server.should_exit = True
+        await serving
+    elif _waitress_server is not None:
+        await asyncio.to_thread(_drain_waitress, max(1.0, deadline - loop.time()))
+    steps["http"] = loop.time() - mark
+
+    mark = loop.time()
+    await asyncio.to_thread(_checkpoint)
+    steps["checkpoint"] = loop.time() - mark
+    steps["total"] = loop.time() - started
+    logger.info("Shutdown: %s", " ".join(f"{name}={seconds * 1000:.0f}ms" for name, seconds in steps.items()))
+
+
+async def _run(webhook: bool) -> None:
+    """Run every bot's Application on this event loop until SIGINT/SIGTERM, with the mini
+    app (and the webhooks) served by uvicorn on the same loop when HTTP_SERVER=asgi.
+
+    The HTTP server listens from the start (/livez, /health answering 503) while the bots
+    warm up; a stop signal, even during warm-up, starts the drain (see ``_drain``)."""
+    global _bot_loop
+    _bot_loop = asyncio.get_running_loop()
+    applications = [t.application for t in tenants]
+    server = _uvicorn_server(webhook) if webhook or HTTP_SERVER == "asgi" else None
+    serving = asyncio.create_task(server.serve()) if server is not None else None
+    stop = asyncio.create_task(_wait_for_stop_signal())
+    warm_up = asyncio.create_task(_warm_up(webhook, server, serving))
+    try:
+        await asyncio.wait({stop, warm_up}, return_when=asyncio.FIRST_COMPLETED)
+        if warm_up.done():
+            warm_up.result()
+            await stop
+        else:
+            warm_up.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await warm_up
+    finally:
+        stop.cancel()
+        await _drain(server, serving)
+        # O pool de conexões compartilhado é fechado pelo primeiro shutdown; os demais ignoram
+        results = await asyncio.gather(*(a.shutdown() for a in applications), return_exceptions=True)
+        for tenant, result in zip(tenants, results):
+            if isinstance(result, Exception):
+                # Ex.: stop() cancelado no prazo do drain deixa a Application "running"
+                logger.error("Shutdown of bot=%s failed", tenant.name, exc_info=result)
+
+
+def main() -> None:
+    startup.record("module", _IMPORTS_DONE)  # estado, catálogos e páginas montados no import
+    events.start()
+    # Mini app: asgi runs on the bots' event loop (_run), the others in a thread
+    if not USE_WEBHOOK and HTTP_SERVER == "waitress":
+        threading.Thread(target=run_waitress, name="http-thread", daemon=True).start()
+    elif not USE_WEBHOOK and HTTP_SERVER == "dev":
+        threading.Thread(target=run_flask, name="flask-thread", daemon=True).start()
+
+    _build_applications()
+    try:
+        asyncio.run(_run(webhook=USE_WEBHOOK))
+    finally:
+        events.close()
+        if cluster is not None:
+            for tenant in tenants:
+                tenant.store.flush()
+            cluster.leave()
+        for tenant in tenants:
+            tenant.store.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,20 @@
+"""script.py configures itself from the environment at import time: set it up before any
+test module imports it."""
+
+import os
+import sys
+import tempfile
+
+os.environ.update(
+    {
+        "BOT_TOKEN": "123456:TEST",
+        "STATE_DIR": tempfile.mkdtemp(prefix="bot-tests-"),
+        "PAYMENT_WEBHOOK_SECRET": "provider-secret",
+        "USE_WEBHOOK": "false",
+        "USE_NGROK": "false",
+        "STATE_FLUSH_INTERVAL": "3600",  # nada chega ao backend por acaso: só o que for síncrono
+    }
+)
+for name in ("BOT_CATALOG_DIR", "STATE_BACKEND", "CLUSTER"):
+    os.environ.pop(name, None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,43 @@
+"""Broadcast recipient log: written off the event loop, before each send, in batches."""
+
+import asyncio
+import os
+import sys
+
+import script
+
+
+def test_sent_log_batches_and_persists_before_returning(tmp_path, monkeypatch):
+    path = tmp_path / "b.sent"
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    writes = []
+    real_write = os.write
+
+    def counting_write(fd, data):
+        writes.append(len(data))
+        return real_write(fd, data)
+
+    monkeypatch.setattr(script.os, "write", counting_write)
+    on_disk = []
+
+    async def send(log, user_id):
+        await log.append(user_id)
+        on_disk.append(user_id in _read(path))
+
+    async def run():
+        log = script._SentLog(fd)
+        await asyncio.gather(*(send(log, user_id) for user_id in range(1, 101)))
+        await send(log, 2**52)
+
+    try:
+        asyncio.run(run())
+    finally:
+        os.close(fd)
+    assert all(on_disk)
+    assert _read(path) == set(range(1, 101)) | {2**52}
+    assert writes == [800, 8]
+
+
+def _read(path) -> set:
+    data = path.read_bytes()
+    return {int.from_bytes(data[i : i + 8], sys.byteorder, signed=True) for i in range(0, len(data), 8)}
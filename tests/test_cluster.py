@@ -0,0 +1,136 @@
+"""Clustered mode: partition leases between replicas sharing one backend, and the
+conditional claim that keeps a double owner from sending twice."""
+
+import threading
+import time
+
+import pytest
+
+import script
+
+PARTITIONS = 8
+TTL = 0.3
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def make_backend(request, tmp_path):
+    """One backend per replica, all on the same shared state (as separate processes)."""
+    opened = []
+    if request.param == "redis":
+        fakeredis = pytest.importorskip("fakeredis")  # stand-in; ver tests/test_redis_backend.py
+        pytest.importorskip("lupa")
+        server = fakeredis.FakeServer()
+
+    def make():
+        if request.param == "redis":
+            backend = script.RedisStateBackend(fakeredis.FakeRedis(server=server), PARTITIONS, "t")
+        else:
+            backend = script.SQLiteStateBackend(str(tmp_path), PARTITIONS)
+        opened.append(backend)
+        return backend
+
+    yield make
+    for backend in opened:
+        backend.close()
+
+
+def _replica(make_backend, name: str) -> script.PartitionLeases:
+    return script.PartitionLeases(make_backend(), name, PARTITIONS, TTL)
+
+
+def test_single_replica_takes_every_partition(make_backend):
+    a = _replica(make_backend, "a")
+    gained, lost = a.refresh()
+    assert gained == set(range(PARTITIONS)) and lost == set()
+    assert a.members == 1
+    assert a.refresh() == (set(), set())  # renovação: nada muda
+
+
+def test_joining_replica_gets_its_share_handed_back(make_backend):
+    a, b = _replica(make_backend, "a"), _replica(make_backend, "b")
+    a.refresh()
+    # b entra: a ainda segura tudo, então b espera a devolução
+    assert b.refresh() == (set(), set())
+    assert b.members == 2
+    _, shed = a.refresh()
+    assert len(a.owned) == PARTITIONS // 2 and shed == set(range(PARTITIONS)) - a.owned
+    gained, _ = b.refresh()
+    assert gained == shed
+    assert a.owned.isdisjoint(b.owned) and a.owned | b.owned == set(range(PARTITIONS))
+
+
+def test_dead_replica_leases_expire_and_fail_over(make_backend):
+    a, b = _replica(make_backend, "a"), _replica(make_backend, "b")
+    a.refresh(), b.refresh(), a.refresh(), b.refresh()
+    assert len(a.owned) == len(b.owned) == PARTITIONS // 2
+    orphaned = set(b.owned)
+    # b morre (SIGKILL): sem heartbeat nem renovação; antes do TTL nada muda
+    assert a.refresh() == (set(), set())
+    time.sleep(TTL + 0.1)
+    gained, lost = a.refresh()
+    assert gained == orphaned and lost == set()
+    assert a.members == 1 and a.owned == set(range(PARTITIONS))
+
+
+def test_leaving_replica_hands_over_at_once(make_backend):
+    a, b = _replica(make_backend, "a"), _replica(make_backend, "b")
+    a.refresh(), b.refresh(), a.refresh(), b.refresh()
+    released = set(b.owned)
+    b.leave()
+    gained, _ = a.refresh()  # sem esperar o TTL
+    assert gained == released and a.owned == set(range(PARTITIONS))
+
+
+def test_lease_held_by_another_owner_is_not_taken(make_backend):
+    backend = make_backend()
+    assert backend.acquire_lease(3, "a", TTL)
+    assert not backend.acquire_lease(3, "b", TTL)
+    assert backend.acquire_lease(3, "a", TTL)  # renovação pelo dono
+    backend.release_lease(3, "b")  # só o dono libera
+    assert not backend.acquire_lease(3, "b", TTL)
+    backend.release_lease(3, "a")
+    assert backend.acquire_lease(3, "b", TTL)
+
+
+def test_double_owner_during_handover_sends_once(make_backend):
+    """a's lease on the user's partition expired while it stalled; b took it over. Both
+    still pop the same due entry and race to claim it: exactly one wins."""
+    stores = [script.UserStateStore(make_backend(), flush_interval=3600) for _ in range(2)]
+    user_id, due_at = 123456789, int(time.time()) - 1
+    stores[0].put(user_id, script.UserState(user_id, remarketing_at=due_at, step=0))
+    stores[0].flush()
+    item = (user_id, due_at, 0, None)
+    results = [None, None]
+    barrier = threading.Barrier(2)
+
+    def claim(i):
+        barrier.wait()
+        results[i] = stores[i].claim_remarketings([item])
+
+    try:
+        threads = [threading.Thread(target=claim, args=(i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(results) == [[], [user_id]]
+        # Uma terceira tentativa (ex.: a réplica antiga acordando depois) também perde
+        assert stores[0].claim_remarketings([item]) == []
+        st = stores[1].backend.get(user_id)
+        assert st.step == 1 and st.remarketing_at is None and st.flags & script.USER_REMARKETED
+    finally:
+        for store in stores:
+            store.close()
+
+
+def test_paid_user_is_not_claimed_by_a_stale_owner(make_backend):
+    stale, owner = (script.UserStateStore(make_backend(), flush_interval=3600) for _ in range(2))
+    user_id, due_at = 77, int(time.time()) - 1
+    try:
+        stale.put(user_id, script.UserState(user_id, remarketing_at=due_at))
+        stale.flush()
+        owner.complete(user_id)
+        assert stale.claim_remarketings([(user_id, due_at, 0, None)]) == []
+    finally:
+        stale.close()
+        owner.close()
@@ -0,0 +1,54 @@
+"""Event log segment retention (EVENT_LOG_MAX_SEGMENTS / EVENT_LOG_MAX_AGE_DAYS)."""
+
+import glob
+import os
+import time
+
+import script
+
+
+def _old_segments(directory, count, age):
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"events-{1_000_000_000_000 + i:013d}.jsonl")
+        with open(path, "w") as fh:
+            fh.write('{"event":"start"}\n')
+        os.utime(path, (time.time() - age, time.time() - age))
+        paths.append(path)
+    return paths
+
+
+def _segments(directory):
+    return sorted(glob.glob(os.path.join(directory, "events-*.jsonl")))
+
+
+def test_rollover_keeps_max_segments(tmp_path):
+    old = _old_segments(str(tmp_path), 5, age=3600)
+    log = script.EventLog(str(tmp_path), 100, 1 << 20, 1.0, max_segments=3)
+    log.emit("start", user_id=1)
+    log.flush()
+    kept = _segments(str(tmp_path))
+    assert len(kept) == 3
+    assert kept[:2] == old[-2:]  # os mais novos ficam, mais o segmento atual
+    assert log.pruned == 3
+    log.close()
+
+
+def test_rollover_drops_segments_past_max_age(tmp_path):
+    expired = _old_segments(str(tmp_path), 2, age=10 * 86400)
+    log = script.EventLog(str(tmp_path), 100, 1 << 20, 1.0, max_age=7 * 86400)
+    log.emit("start", user_id=1)
+    log.flush()
+    kept = _segments(str(tmp_path))
+    assert len(kept) == 1 and kept[0] not in expired
+    log.close()
+
+
+def test_recent_segments_are_never_pruned(tmp_path):
+    # Outra réplica escrevendo no mesmo diretório: segmento recente não é apagado
+    recent = _old_segments(str(tmp_path), 3, age=0)
+    log = script.EventLog(str(tmp_path), 100, 1 << 20, 1.0, max_segments=2)
+    log.emit("start", user_id=1)
+    log.flush()
+    assert set(recent) <= set(_segments(str(tmp_path)))
+    log.close()
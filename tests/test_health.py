@@ -0,0 +1,13 @@
+"""Readiness (/health): optional phases that fail are reported without failing it."""
+
+import script
+
+
+def test_ngrok_failure_keeps_ready(monkeypatch):
+    monkeypatch.setattr(script.startup, "ready", True)
+    monkeypatch.setattr(script.startup, "warnings", {"ngrok": "no tunnel (see the log)"})
+    resp = script.app.test_client().get("/health")
+    assert resp.status_code == 200
+    body = resp.get_json()
+    assert body["status"] == "ok"
+    assert body["warnings"] == {"ngrok": "no tunnel (see the log)"}
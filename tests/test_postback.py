@@ -0,0 +1,154 @@
+"""Payment postback (/pagamento/postback) against a local stub provider.
+
+The bot's event loop runs in a thread and the Telegram application is a stub that records
+the final messages instead of calling the Bot API.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import json
+import threading
+import time
+
+import pytest
+
+import script
+
+
+class _StubBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+class _StubApplication:
+    running = True
+
+    def __init__(self):
+        self.bot = _StubBot()
+
+
+class StubProvider:
+    """Signs postbacks the way the payment provider does (HMAC-SHA256 of the raw body)."""
+
+    def __init__(self, client, secret: str):
+        self.client = client
+        self.secret = secret.encode()
+
+    def sign(self, body: bytes) -> str:
+        return "sha256=" + hmac.new(self.secret, body, hashlib.sha256).hexdigest()
+
+    def post(self, payload, signature=None):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        return self.client.post(
+            "/pagamento/postback",
+            data=body,
+            content_type="application/json",
+            headers={script.PAYMENT_SIGNATURE_HEADER: signature or self.sign(body)},
+        )
+
+    def approved(self, order_id: str, user_id: int, **extra) -> dict:
+        return {"order_id": order_id, "status": "paid", "tracking": {"utm_content": f"tg{user_id}"}, **extra}
+
+
+@pytest.fixture(scope="module")
+def bot_loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+@pytest.fixture
+def tenant(bot_loop, monkeypatch):
+    tenant = script.tenants[0]
+    monkeypatch.setattr(script, "_bot_loop", bot_loop)
+    monkeypatch.setattr(tenant, "application", _StubApplication())
+    return tenant
+
+
+@pytest.fixture
+def provider(tenant):
+    return StubProvider(script.app.test_client(), tenant.payment_secret)
+
+
+def _wait_sent(tenant, count: int, timeout: float = 5.0) -> list:
+    deadline = time.monotonic() + timeout
+    while len(tenant.application.bot.sent) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return tenant.application.bot.sent
+
+
+def test_valid_postback_persists_payment(tenant, provider):
+    resp = provider.post(provider.approved("order-valid", 1001))
+    assert resp.status_code == 200
+    assert resp.get_json() == {"status": "ok"}
+    # Gravado no backend antes da resposta, sem esperar o flush do buffer
+    st = tenant.store.backend.get(1001)
+    assert st is not None and st.flags & script.USER_COMPLETED and st.remarketing_at is None
+    assert _wait_sent(tenant, 1) == [(1001, tenant.catalog.final_text)]
+
+
+def test_duplicate_order_id(tenant, provider):
+    assert provider.post(provider.approved("order-dup", 1002)).status_code == 200
+    # Mesmo pedido com outro corpo (ex.: transaction_id em vez de order_id)
+    resp = provider.post({"transaction_id": "order-dup", "status": "approved", "tg_user_id": "1002"})
+    assert resp.status_code == 200
+    assert resp.get_json() == {"status": "duplicate"}
+    assert len(_wait_sent(tenant, 1)) == 1
+
+
+def test_replayed_postback(tenant, provider):
+    body = json.dumps(provider.approved("order-replay", 1003)).encode()
+    signature = provider.sign(body)
+    assert provider.post(body, signature).get_json() == {"status": "ok"}
+    assert provider.post(body, signature).get_json() == {"status": "duplicate"}
+    time.sleep(0.1)
+    assert len(_wait_sent(tenant, 1)) == 1
+
+
+def test_retry_after_failed_claim_completes_once(tenant, provider):
+    def unavailable(order_id, user_id):
+        raise RuntimeError("state unavailable")
+
+    payload = provider.approved("order-retry", 1004)
+    tenant.store.claim_order = unavailable
+    try:
+        assert provider.post(payload).status_code == 503
+    finally:
+        del tenant.store.claim_order
+    # O pagamento já está gravado; o reenvio do provedor reivindica o pedido e envia a mensagem
+    assert tenant.store.backend.get(1004).flags & script.USER_COMPLETED
+    assert tenant.application.bot.sent == []
+    assert provider.post(payload).get_json() == {"status": "ok"}
+    assert _wait_sent(tenant, 1) == [(1004, tenant.catalog.final_text)]
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        b"[1, 2, 3]",
+        b'"paid"',
+        {"order_id": "o-bad-1", "status": "paid", "metadata": "tg1005"},
+        {"order_id": "o-bad-2", "status": "paid", "tracking": ["tg1005"]},
+        {"order_id": {"id": 1}, "status": "paid", "tg_user_id": 1005},
+        {"order_id": "o-bad-3", "status": ["paid"], "tg_user_id": 1005},
+    ],
+)
+def test_bad_payload(tenant, provider, payload):
+    resp = provider.post(payload)
+    assert resp.status_code == 400
+    assert resp.get_json()["error"] in ("malformed payload", "missing order_id")
+    assert tenant.store.backend.get(1005) is None
+    assert tenant.application.bot.sent == []
+
+
+def test_bad_signature(tenant, provider):
+    resp = provider.post(provider.approved("order-forged", 1006), signature="sha256=" + "0" * 64)
+    assert resp.status_code == 401
+    assert tenant.store.backend.get(1006) is None
@@ -0,0 +1,139 @@
+"""PriorityRateLimiter driven directly through ``process_request`` with fake Bot API calls."""
+
+import asyncio
+import datetime as dt
+
+import pytest
+from telegram.error import RetryAfter
+
+import script
+
+# PTB 22 avisa que RetryAfter.retry_after vai virar timedelta; o limiter aceita os dois
+pytestmark = pytest.mark.filterwarnings("ignore::telegram.warnings.PTBDeprecationWarning")
+
+def _limiter(global_rate=1000.0, **kwargs):
+    return script.PriorityRateLimiter(global_rate=global_rate, **kwargs)
+
+
+async def _send(limiter, chat_id, priority=None, callback=None, log=None, tag=None):
+    loop = asyncio.get_running_loop()
+
+    async def ok():
+        if log is not None:
+            log.append((tag, loop.time()))
+        return tag
+
+    return await limiter.process_request(callback or ok, (), {}, "sendMessage", {"chat_id": chat_id}, priority)
+
+
+def test_lanes_are_served_in_priority_order_under_contention():
+    async def run():
+        limiter = _limiter()
+        limiter._global = script.TokenBucket(50.0, 1.0)  # um envio a cada 20 ms: todos disputam
+        await limiter.initialize()
+        log = []
+        lanes = [
+            ("broadcast", script.PRIORITY_BROADCAST),
+            ("remarketing", script.PRIORITY_REMARKETING),
+            ("interactive", script.PRIORITY_INTERACTIVE),
+            ("transactional", script.PRIORITY_TRANSACTIONAL),
+        ]
+        calls = [
+            _send(limiter, 100 + i, priority, log=log, tag=f"{lane}-{n}")
+            for n in range(2)
+            for i, (lane, priority) in enumerate(lanes)
+        ]
+        await asyncio.gather(*calls)
+        await limiter.shutdown()
+        return [tag for tag, _ in log]
+
+    assert asyncio.run(run()) == [
+        "transactional-0", "transactional-1", "interactive-0", "interactive-1",
+        "remarketing-0", "remarketing-1", "broadcast-0", "broadcast-1",
+    ]
+
+
+def test_default_lane_is_interactive():
+    async def run():
+        limiter = _limiter()
+        limiter._global = script.TokenBucket(50.0, 1.0)
+        await limiter.initialize()
+        log = []
+        await asyncio.gather(
+            _send(limiter, 1, script.PRIORITY_REMARKETING, log=log, tag="remarketing"),
+            _send(limiter, 2, None, log=log, tag="default"),
+            _send(limiter, 3, script.PRIORITY_TRANSACTIONAL, log=log, tag="transactional"),
+        )
+        await limiter.shutdown()
+        return [tag for tag, _ in log]
+
+    assert asyncio.run(run()) == ["transactional", "default", "remarketing"]
+
+
+def test_per_chat_bucket_paces_one_chat_only():
+    async def run():
+        limiter = _limiter(per_chat_rate=10.0, per_chat_burst=2.0)
+        await limiter.initialize()
+        log = []
+        start = asyncio.get_running_loop().time()
+        await asyncio.gather(
+            *(_send(limiter, 7, log=log, tag=("same", n)) for n in range(4)),
+            *(_send(limiter, 8 + n, log=log, tag=("other", n)) for n in range(4)),
+        )
+        await limiter.shutdown()
+        return {tag: at - start for tag, at in log}
+
+    at = asyncio.run(run())
+    # Rajada de 2, depois 10/s no mesmo chat; os outros chats não esperam
+    assert at[("same", 0)] < 0.05 and at[("same", 1)] < 0.05
+    assert 0.08 <= at[("same", 2)] < 0.2
+    assert 0.18 <= at[("same", 3)] < 0.3
+    assert all(at[("other", n)] < 0.05 for n in range(4))
+
+
+def test_retry_after_pauses_the_pipeline_and_retries():
+    async def run():
+        limiter = _limiter()
+        await limiter.initialize()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        attempts = []
+
+        async def flaky():
+            attempts.append(loop.time() - start)
+            if len(attempts) == 1:
+                raise RetryAfter(dt.timedelta(milliseconds=200))
+            return "sent"
+
+        first = asyncio.create_task(_send(limiter, 1, callback=flaky))
+        await asyncio.sleep(0.05)  # o 429 já pausou tudo
+        log = []
+        other = await _send(limiter, 2, log=log, tag="other")
+        result = await first
+        await limiter.shutdown()
+        return result, attempts, other, log[0][1] - start, limiter.retry_after_count
+
+    result, attempts, other, other_at, retries = asyncio.run(run())
+    assert result == "sent" and other == "other" and retries == 1
+    assert len(attempts) == 2 and attempts[1] >= 0.2
+    assert other_at >= 0.2  # outro chat, mas o 429 vale para o bot inteiro
+
+
+def test_retry_after_gives_up_after_max_retries():
+    async def run():
+        limiter = _limiter(max_retries=2)
+        await limiter.initialize()
+        calls = []
+
+        async def always_429():
+            calls.append(1)
+            raise RetryAfter(dt.timedelta(milliseconds=10))
+
+        try:
+            with pytest.raises(RetryAfter):
+                await _send(limiter, 1, callback=always_429)
+        finally:
+            await limiter.shutdown()
+        return len(calls), limiter.retry_after_count
+
+    assert asyncio.run(run()) == (3, 3)
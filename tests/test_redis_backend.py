@@ -0,0 +1,158 @@
+"""RedisStateBackend against an in-process Redis stand-in (fakeredis, with Lua via lupa):
+the same commands and Lua scripts the bot sends to a real server."""
+
+import time
+
+import pytest
+
+import script
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")  # EVAL (scripts _PUT, _CLAIM, _ACQUIRE, _RELEASE)
+
+SHARDS = 4
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def make_backend(server):
+    """One backend (own client) per replica, all on the same stand-in server."""
+
+    def make(ttl: int = 0):
+        return script.RedisStateBackend(fakeredis.FakeRedis(server=server), SHARDS, "t", ttl)
+
+    return make
+
+
+@pytest.fixture
+def backend(make_backend):
+    return make_backend()
+
+
+def _pending(backend) -> dict:
+    return dict(backend.iter_pending())
+
+
+def test_put_get_round_trip(backend):
+    states = {
+        1: script.UserState(1),
+        2: script.UserState(-100200300, script.USER_UNREACHABLE, 1_800_000_000, 2),
+        (1 << 52) - 1: script.UserState((1 << 52) - 1, 0, 1_700_000_000, 0),
+    }
+    backend.put_many(states.items())
+    assert {user_id: backend.get(user_id) for user_id in states} == states
+    assert backend.get(999) is None
+    assert _pending(backend) == {2: 1_800_000_000, (1 << 52) - 1: 1_700_000_000}
+    assert dict(backend.iter_pending(until=1_750_000_000)) == {(1 << 52) - 1: 1_700_000_000}
+
+
+def test_put_keeps_sticky_flags_and_drops_paid_from_pending(backend):
+    backend.put_many([(5, script.UserState(5, 0, 1000))])
+    backend.put_many([(5, script.UserState(5, script.USER_COMPLETED | script.USER_REMARKETED, None))])
+    assert _pending(backend) == {}
+    # Linha velha de outra réplica (sem os flags, com pendência): não desfaz o pagamento
+    backend.put_many([(5, script.UserState(5, 0, 2000, 0))])
+    st = backend.get(5)
+    assert st.flags == script.USER_COMPLETED | script.USER_REMARKETED and st.remarketing_at is None
+    assert _pending(backend) == {}
+    assert backend.count_completed() == 1
+
+
+def test_ttl_only_on_unpaid_users_with_nothing_pending(make_backend, server):
+    backend = make_backend(ttl=3600)
+    client = fakeredis.FakeRedis(server=server)
+    backend.put_many(
+        [
+            (1, script.UserState(1)),
+            (2, script.UserState(2, 0, 1000)),
+            (3, script.UserState(3, script.USER_COMPLETED)),
+        ]
+    )
+    assert 0 < client.ttl(backend._key(1)) <= 3600
+    assert client.ttl(backend._key(2)) == -1
+    assert client.ttl(backend._key(3)) == -1
+
+
+def test_claim_remarketings(backend):
+    backend.put_many(
+        [
+            (1, script.UserState(1, 0, 1000, 0)),
+            (2, script.UserState(2, 0, 1000, 0)),
+            (3, script.UserState(3, script.USER_COMPLETED)),
+            (4, script.UserState(4, 0, 1000, 1)),
+        ]
+    )
+    items = [
+        (1, 1000, 0, 5000),  # próximo passo em 5000
+        (2, 1000, 0, None),  # último passo
+        (3, 1000, 0, None),  # pago
+        (4, 1000, 0, None),  # já está no passo 1
+        (5, 1000, 0, None),  # não existe
+    ]
+    assert backend.claim_remarketings(items) == [1, 2]
+    assert backend.get(1) == script.UserState(1, script.USER_REMARKETED, 5000, 1)
+    assert backend.get(2) == script.UserState(2, script.USER_REMARKETED, None, 1)
+    assert _pending(backend) == {1: 5000, 4: 1000}
+    assert backend.claim_remarketings(items) == []  # reivindicar de novo: ninguém
+    assert backend.claim_remarketings([(4, 999, 1, None)]) == []  # horário diferente
+
+
+def test_claim_races_between_replicas(make_backend):
+    a, b = make_backend(), make_backend()
+    a.put_many([(9, script.UserState(9, 0, 1000, 0))])
+    assert a.claim_remarketings([(9, 1000, 0, None)]) == [9]
+    assert b.claim_remarketings([(9, 1000, 0, None)]) == []
+
+
+def test_payments_idempotency_index(make_backend):
+    a, b = make_backend(), make_backend()
+    assert a.claim_order("order-1", 10)
+    assert not a.claim_order("order-1", 10)
+    assert not b.claim_order("order-1", 11)  # outra réplica, mesmo pedido
+    assert b.claim_order("order-2", None)
+
+
+def test_audience_page_visits_each_user_once(backend):
+    users = {user_id: script.UserState(user_id) for user_id in range(1, 201)}
+    users[7] = script.UserState(7, script.USER_COMPLETED)
+    users[8] = script.UserState(8, script.USER_UNREACHABLE)
+    backend.put_many(users.items())
+    seen, cursor = [], None
+    while True:
+        rows, cursor = backend.audience_page(cursor, 25, script.USER_COMPLETED | script.USER_UNREACHABLE)
+        seen.extend(user_id for user_id, _ in rows)
+        if cursor is None:
+            break
+    assert sorted(seen) == [u for u in range(1, 201) if u not in (7, 8)]
+
+
+def test_partition_leases(make_backend):
+    a = script.PartitionLeases(make_backend(), "a", SHARDS, 0.3)
+    b = script.PartitionLeases(make_backend(), "b", SHARDS, 0.3)
+    assert a.refresh()[0] == set(range(SHARDS))
+    assert b.refresh() == (set(), set()) and b.members == 2
+    _, shed = a.refresh()
+    assert b.refresh()[0] == shed and len(shed) == SHARDS // 2
+    time.sleep(0.4)  # b morre: só a renova
+    gained, _ = a.refresh()
+    assert gained == shed and a.owned == set(range(SHARDS)) and a.members == 1
+    a.leave()
+    c = script.PartitionLeases(make_backend(), "c", SHARDS, 0.3)
+    assert c.refresh()[0] == set(range(SHARDS))  # sem esperar o TTL de a
+
+
+def test_store_on_redis_complete_then_claim(make_backend):
+    store = script.UserStateStore(make_backend(), flush_interval=3600)
+    try:
+        store.mark_started(21, 21, 1000)
+        store.mark_started(22, 22, 1000)
+        store.flush()
+        store.complete(21)
+        assert store.claim_remarketings([(21, 1000, 0, None), (22, 1000, 0, None)]) == [22]
+        assert store.backend.count_completed() == 1
+    finally:
+        store.close()
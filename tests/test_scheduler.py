@@ -0,0 +1,172 @@
+"""RemarketingScheduler: packed heap keys (``due << 60 | bot << 52 | user_id``), lazy cancel
+and stale entries, with stand-in stores; and its snapshot for fast restarts."""
+
+import array
+import asyncio
+import json
+import os
+import sys
+import zlib
+
+import pytest
+
+import script
+
+MAX_USER_ID = (1 << script._USER_ID_BITS) - 1
+MAX_BOT = (1 << script._TENANT_BITS) - 1
+
+
+class _Store:
+    def __init__(self):
+        self.started = {}
+
+    def mark_started(self, user_id, chat_id, remarketing_at):
+        self.started[user_id] = remarketing_at
+
+
+@pytest.fixture
+def scheduler():
+    return script.RemarketingScheduler([_Store() for _ in range(MAX_BOT + 1)], partitions=16)
+
+
+def test_packed_keys_round_trip_at_the_boundaries(scheduler):
+    due_at = 2_000_000_000
+    for bot, user_id in ((0, 1), (MAX_BOT, MAX_USER_ID), (0, MAX_USER_ID), (MAX_BOT, 1), (7, 123456789)):
+        scheduler.schedule(bot, user_id, user_id, due_at)
+    assert scheduler.pending[0] == 2 and scheduler.pending[MAX_BOT] == 2 and scheduler.pending[7] == 1
+    due = scheduler.pop_due(due_at, 100)
+    assert sorted(due) == sorted(
+        [(0, 1, due_at), (MAX_BOT, MAX_USER_ID, due_at), (0, MAX_USER_ID, due_at), (MAX_BOT, 1, due_at), (7, 123456789, due_at)]
+    )
+    assert len(scheduler) == 0 and sum(scheduler.pending) == 0
+    assert scheduler._stores[MAX_BOT].started == {MAX_USER_ID: due_at, 1: due_at}
+
+
+def test_pops_in_due_order_and_respects_now_and_limit(scheduler):
+    for user_id, due_at in ((1, 300), (2, 100), (3, 200), (4, 100)):
+        scheduler.schedule(MAX_BOT, user_id, user_id, due_at)
+    assert scheduler.pop_due(99, 10) == []
+    assert scheduler.pop_due(150, 1) in ([(MAX_BOT, 2, 100)], [(MAX_BOT, 4, 100)])
+    assert [u for _, u, _ in scheduler.pop_due(250, 10)] in ([4, 3], [2, 3])
+    assert scheduler.pop_due(10**12, 10) == [(MAX_BOT, 1, 300)]
+
+
+def test_lazy_cancel_and_reschedule_skip_stale_entries(scheduler):
+    scheduler.schedule(3, MAX_USER_ID, 1, 100)
+    scheduler.schedule(3, 42, 42, 100)
+    scheduler.schedule(3, 42, 42, 500)  # novo /start: a entrada de 100 fica velha no heap
+    assert scheduler.cancel(3, MAX_USER_ID)
+    assert not scheduler.cancel(3, MAX_USER_ID)
+    assert len(scheduler._heap) == 3 and len(scheduler) == 1 and scheduler.pending[3] == 1
+    assert scheduler.pop_due(200, 10) == []
+    assert scheduler._heap == [(500 << script._KEY_BITS) | (3 << script._USER_ID_BITS) | 42]
+    assert scheduler.pop_due(500, 10) == [(3, 42, 500)]
+    assert scheduler.pending[3] == 0
+
+
+def test_stale_entries_are_compacted(scheduler):
+    for due_at in range(10_000):
+        scheduler.schedule(0, MAX_USER_ID, 1, due_at)
+    assert len(scheduler) == 1
+    assert len(scheduler._heap) <= 2 * len(scheduler) + 4096 + 1
+    assert scheduler.pop_due(10**12, 10) == [(0, MAX_USER_ID, 9_999)]
+
+
+# ----------------------
+# Snapshot (fast restart)
+# ----------------------
+class _PendingStore(_Store):
+    """Stand-in store with pending rows for ``restore()`` (the fallback store scan)."""
+
+    def __init__(self, pending=()):
+        super().__init__()
+        self.pending = dict(pending)
+
+    def iter_pending(self, partitions=None, until=None):
+        return iter(self.pending.items())
+
+
+def _filled(stores=2):
+    scheduler = script.RemarketingScheduler([_Store() for _ in range(stores)], partitions=16)
+    for user_id, due_at in ((1, 300), (MAX_USER_ID, 100), (42, 200)):
+        scheduler.schedule(stores - 1, user_id, user_id, due_at)
+    scheduler.schedule(0, 7, 7, 250)
+    return scheduler
+
+
+def test_snapshot_round_trip_and_delete_on_load(tmp_path):
+    path = str(tmp_path / "remarketing.snapshot")
+    bots = ["default", "other"]
+    assert _filled().save_snapshot(path, bots) == 4
+    with open(path, "rb") as fh:
+        header = json.loads(fh.readline())
+        payload = fh.read()
+    assert header["version"] == 1 and header["bots"] == bots and header["count"] == 4
+    assert header["byteorder"] == sys.byteorder and header["crc32"] == zlib.crc32(payload)
+    keys, dues = array.array("q"), array.array("q")
+    keys.frombytes(payload[:32])
+    dues.frombytes(payload[32:])
+    assert list(dues) == [100, 200, 250, 300]  # em ordem de vencimento
+    assert keys[0] == (1 << script._USER_ID_BITS) | MAX_USER_ID
+
+    loaded = script.RemarketingScheduler([_Store(), _Store()], partitions=16)
+    assert loaded.load_snapshot(path, bots) == 4
+    assert not os.path.exists(path)  # só vale até a próxima mudança nos stores
+    assert loaded.restored and loaded.pending == [1, 3]
+    assert loaded.pop_due(10**12, 10) == [(1, MAX_USER_ID, 100), (1, 42, 200), (0, 7, 250), (1, 1, 300)]
+
+
+def _corrupt(path, how):
+    data = open(path, "rb").read()
+    header_end = data.index(b"\n") + 1
+    if how == "payload_bit":
+        data = data[:-3] + bytes([data[-3] ^ 1]) + data[-2:]
+    elif how == "truncated":
+        data = data[:-5]
+    elif how == "truncated_header":
+        data = data[: header_end // 2]
+    elif how == "garbage":
+        data = b"\x00\xff not json\n" + data[header_end:]
+    elif how == "byteorder":
+        header = json.loads(data[:header_end])
+        header["byteorder"] = "big" if sys.byteorder == "little" else "little"
+        data = json.dumps(header).encode() + b"\n" + data[header_end:]
+    open(path, "wb").write(data)
+
+
+@pytest.mark.parametrize("how", ["payload_bit", "truncated", "truncated_header", "garbage", "byteorder"])
+def test_damaged_snapshot_is_ignored_and_deleted(tmp_path, how):
+    path = str(tmp_path / "remarketing.snapshot")
+    _filled().save_snapshot(path, ["default", "other"])
+    _corrupt(path, how)
+    loaded = script.RemarketingScheduler([_Store(), _Store()], partitions=16)
+    assert loaded.load_snapshot(path, ["default", "other"]) is None
+    assert not os.path.exists(path)
+    assert len(loaded) == 0 and not loaded.restored
+
+
+def test_snapshot_of_other_bots_is_ignored(tmp_path):
+    path = str(tmp_path / "remarketing.snapshot")
+    _filled().save_snapshot(path, ["default", "other"])
+    loaded = script.RemarketingScheduler([_Store(), _Store()], partitions=16)
+    assert loaded.load_snapshot(path, ["default", "renamed"]) is None
+    assert len(loaded) == 0
+
+
+@pytest.mark.parametrize("how", [None, "truncated"])
+def test_restore_falls_back_to_the_store_scan(tmp_path, monkeypatch, how):
+    path = str(tmp_path / "remarketing.snapshot")
+    bots = [t.name for t in script.tenants]
+    in_store = {11: 500, MAX_USER_ID: 600}
+    if how is not None:
+        stale = script.RemarketingScheduler([_Store()], partitions=16)
+        stale.schedule(0, 99, 99, 100)  # o snapshot estragado não pode voltar
+        stale.save_snapshot(path, bots)
+        _corrupt(path, how)
+    scheduler = script.RemarketingScheduler([_PendingStore(in_store)], partitions=16)
+    monkeypatch.setattr(script, "remarketing_scheduler", scheduler)
+    monkeypatch.setattr(script, "SNAPSHOT_FILE", path)
+    asyncio.run(script._restore_remarketing())
+    assert scheduler.restored and len(scheduler) == 2
+    assert scheduler.pop_due(10**12, 10) == [(0, 11, 500), (0, MAX_USER_ID, 600)]
+    assert not os.path.exists(path)
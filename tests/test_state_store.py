@@ -0,0 +1,83 @@
+"""UserStateStore write-behind buffer against a real SQLite backend, and its paid-id set."""
+
+import random
+
+import pytest
+
+import script
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = script.UserStateStore(script.SQLiteStateBackend(str(tmp_path), 2), flush_interval=3600)
+    yield store
+    store.close()
+
+
+def test_put_racing_a_claim_does_not_undo_it(store):
+    store.put(7, script.UserState(7, remarketing_at=100, step=0))
+    store.flush()
+    stale = store.get(7)
+    claim = store.backend.claim_remarketings
+
+    def claim_after_put(items):
+        # Outra thread grava (ex.: readmit) a partir do estado lido antes da reivindicação
+        store.put(7, stale._replace(flags=stale.flags | script.USER_UNREACHABLE))
+        return claim(items)
+
+    store.backend.claim_remarketings = claim_after_put
+    assert store.claim_remarketings([(7, 100, 0, 200)]) == [7]
+    store.flush()
+    st = store.backend.get(7)
+    assert (st.step, st.remarketing_at) == (1, 200)
+    assert st.flags & script.USER_REMARKETED and st.flags & script.USER_UNREACHABLE
+    assert store.get(7) == st
+
+
+def test_restart_racing_a_claim_keeps_the_new_sequence(store):
+    store.put(8, script.UserState(8, remarketing_at=100, step=2))
+    store.flush()
+    claim = store.backend.claim_remarketings
+
+    def claim_after_start(items):
+        store.mark_started(8, 8, remarketing_at=500)
+        return claim(items)
+
+    store.backend.claim_remarketings = claim_after_start
+    assert store.claim_remarketings([(8, 100, 2, 300)]) == [8]
+    store.flush()
+    st = store.backend.get(8)
+    assert (st.step, st.remarketing_at) == (0, 500)
+
+
+def test_compact_int_set_matches_a_set_across_buckets():
+    shift = script.CompactIntSet._SHIFT
+    edges = [0, 1, (1 << shift) - 1, 1 << shift, (1 << shift) + 1, 3 << shift, (1 << 52) - 1, (1 << 52) - 2]
+    rng = random.Random(3)
+    values = edges + [rng.randrange(1 << 52) for _ in range(2000)] + [rng.randrange(4 << shift) for _ in range(2000)]
+    ids, expected = script.CompactIntSet(), set()
+    for value in values:
+        ids.add(value)
+        expected.add(value)
+    ids.add(edges[2])  # já presente: não duplica
+    assert len(ids) == len(expected)
+    assert all(value in ids for value in expected)
+    assert not any(value in ids for value in (2, (2 << shift) + 7, (1 << 52) - 3) if value not in expected)
+    for value in values[::2]:
+        assert ids.discard(value) == (value in expected)
+        expected.discard(value)
+    assert not ids.discard(values[0])
+    assert len(ids) == len(expected)
+    assert all(value in ids for value in expected)
+    assert all(value not in ids for value in values[::2] if value not in expected)
+
+
+def test_compact_int_set_drops_empty_buckets():
+    ids = script.CompactIntSet()
+    ids.add(1 << 40)
+    ids.add((1 << 40) + 1)
+    assert ids.nbytes == 8 + script.CompactIntSet._BUCKET_BYTES
+    ids.discard(1 << 40)
+    ids.discard((1 << 40) + 1)
+    assert len(ids) == 0 and ids.nbytes == 0
+    assert (1 << 40) not in ids
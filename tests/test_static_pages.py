@@ -0,0 +1,31 @@
+"""Precomputed mini app pages: one strong ETag per encoding, revalidated per encoding."""
+
+import pytest
+
+import script
+
+
+@pytest.fixture
+def client():
+    return script.app.test_client()
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "identity"] + (["br"] if script.brotli is not None else []))
+def test_etag_per_encoding(client, encoding):
+    resp = client.get("/pagamento-aprovado", headers={"Accept-Encoding": encoding})
+    assert resp.status_code == 200
+    assert resp.headers["Vary"] == "Accept-Encoding"
+    etag = resp.headers["ETag"]
+    suffix = {"gzip": '-gz"', "br": '-br"'}.get(encoding)
+    assert etag.endswith(suffix) if suffix else "-" not in etag
+    again = client.get("/pagamento-aprovado", headers={"Accept-Encoding": encoding, "If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["ETag"] == etag
+
+
+def test_compressed_etag_does_not_revalidate_identity(client):
+    gz = client.get("/pagamento-aprovado", headers={"Accept-Encoding": "gzip"})
+    plain = client.get("/pagamento-aprovado", headers={"Accept-Encoding": "identity", "If-None-Match": gz.headers["ETag"]})
+    assert plain.status_code == 200
+    assert plain.headers["ETag"] != gz.headers["ETag"]
+    assert "Content-Encoding" not in plain.headers
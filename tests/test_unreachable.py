@@ -0,0 +1,44 @@
+"""Unreachable chats: the flag is stored off the event loop, and a failed write is not lost silently."""
+
+import asyncio
+import logging
+
+import script
+
+
+def _counter(name: str, bot: str) -> float:
+    series = f'{name}{{bot="{bot}"}} '
+    for line in script.metrics.render().splitlines():
+        if line.startswith(series):
+            return float(line[len(series) :])
+    return 0.0
+
+
+def test_failed_store_write_is_logged_and_counted(monkeypatch, caplog):
+    tenant = script.tenants[0]
+
+    def unavailable(user_id, fresh=False):
+        raise RuntimeError("state unavailable")
+
+    monkeypatch.setattr(tenant.store, "mark_unreachable", unavailable)
+    before = _counter("bot_unreachable_store_errors_total", tenant.name)
+
+    async def run():
+        tenant._on_unreachable(2001, "blocked")
+        await asyncio.sleep(0.2)
+
+    with caplog.at_level(logging.ERROR):
+        asyncio.run(run())
+    assert _counter("bot_unreachable_store_errors_total", tenant.name) == before + 1
+    assert any("user_id=2001" in r.getMessage() and r.exc_info for r in caplog.records)
+
+
+def test_flag_is_stored():
+    tenant = script.tenants[0]
+
+    async def run():
+        tenant._on_unreachable(2002, "blocked")
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    assert tenant.store.get(2002).flags & script.USER_UNREACHABLE
@@ -0,0 +1,82 @@
+"""UserOrderedUpdateProcessor: one user's updates run in arrival order, users in parallel."""
+
+import asyncio
+import datetime as dt
+import random
+
+from telegram import Chat, Message, Update, User
+
+import script
+
+
+def _update(update_id: int, user_id: int) -> Update:
+    return Update(
+        update_id,
+        message=Message(
+            update_id,
+            dt.datetime.now(dt.timezone.utc),
+            Chat(user_id, Chat.PRIVATE),
+            from_user=User(user_id, "u", False),
+            text="/start",
+        ),
+    )
+
+
+def test_each_users_updates_finish_in_arrival_order():
+    rng = random.Random(11)
+    users = [1001, 1002, 1003, 1004, 1005, 1006, 1007, 10**12 + 9]
+    arrivals = [(n, rng.choice(users)) for n in range(1, 301)]
+    delays = {n: rng.uniform(0, 0.01) for n, _ in arrivals}
+
+    async def run():
+        processor = script.UserOrderedUpdateProcessor(workers=4)
+        await processor.initialize()
+        finished, running = [], {}
+        overlap = 0
+
+        async def handler(update_id, user_id):
+            nonlocal overlap
+            running[user_id] = running.get(user_id, 0) + 1
+            assert running[user_id] == 1, f"user {user_id} ran two updates at once"
+            overlap = max(overlap, sum(running.values()))
+            await asyncio.sleep(delays[update_id])  # handler com duração aleatória
+            running[user_id] -= 1
+            finished.append((user_id, update_id))
+
+        # Como a Application: uma task por update, criadas na ordem de chegada
+        tasks = [
+            asyncio.create_task(processor.process_update(_update(n, user_id), handler(n, user_id)))
+            for n, user_id in arrivals
+        ]
+        await asyncio.gather(*tasks)
+        await processor.shutdown()
+        return finished, overlap
+
+    finished, overlap = asyncio.run(run())
+    assert len(finished) == len(arrivals)
+    for user_id in users:
+        expected = [n for n, u in arrivals if u == user_id]
+        assert [n for u, n in finished if u == user_id] == expected
+    assert overlap > 1  # usuários diferentes em paralelo
+
+
+def test_handler_error_does_not_block_the_users_queue():
+    async def run():
+        processor = script.UserOrderedUpdateProcessor(workers=2)
+        await processor.initialize()
+        done = []
+
+        async def fails():
+            raise RuntimeError("handler bug")
+
+        async def works():
+            done.append(2)
+
+        await asyncio.gather(
+            processor.process_update(_update(1, 5), fails()),
+            processor.process_update(_update(2, 5), works()),
+        )
+        await processor.shutdown()
+        return done
+
+    assert asyncio.run(run()) == [2]
@@ -0,0 +1,52 @@
+"""Funnel attribution of mini app opens: the button that opened it says where it came from."""
+
+import pytest
+
+import script
+
+
+def _opens(source: str) -> float:
+    series = f'bot_funnel_total{{bot="{script.tenants[0].name}",step="webapp_open",pkg="combo",source="{source}"}} '
+    for line in script.metrics.render().splitlines():
+        if line.startswith(series):
+            return float(line[len(series) :])
+    return 0.0
+
+
+def test_markups_carry_source():
+    base = "https://bot.example"
+    tenant = script.tenants[0]
+    start, _ = script._build_markups_for_start(tenant.catalog, base)
+    assert all(row[0].web_app.url.endswith("&src=direct") for row in start.keyboard)
+    step, _ = script._remarketing_reply_markup(tenant.sequence[0], base)
+    assert step.keyboard[0][0].web_app.url.endswith("&src=remarketing")
+    broadcast, _ = script._offer_reply_markup(base, "Oferta", "https://pay.example/x", "combo", "broadcast")
+    assert broadcast.keyboard[0][0].web_app.url.endswith("&src=broadcast")
+
+
+@pytest.mark.parametrize(
+    "query, source",
+    [("&src=remarketing", "remarketing"), ("&src=broadcast", "broadcast"), ("", "direct"), ("&src=bogus", "direct")],
+)
+def test_webapp_open_uses_src(query, source):
+    before = _opens(source)
+    resp = script.app.test_client().get("/webapp?target=https%3A%2F%2Fpay.example%2Fx&pkg=combo" + query)
+    assert resp.status_code == 200
+    assert _opens(source) == before + 1
+
+
+@pytest.mark.parametrize("base", ["https://bot.example", "http://localhost:8080"])
+def test_checkout_link_carries_user_id(base):
+    tenant = script.tenants[0]
+    reply_kb, inline_kb = script._build_markups_for_start(tenant.catalog, base)
+    markup = script._for_user(script._serialize_markup(reply_kb or inline_kb), 4242)
+    assert "utm_content%3Dtg4242" in markup if reply_kb else "utm_content=tg4242" in markup
+    assert script._USER_ID_MARK not in markup
+
+
+def test_webapp_link_and_redirect_share_the_target():
+    target = script._tracked_url("https://pay.example/x?a=1&utm_content=old").replace(script._USER_ID_MARK, "77")
+    url = script._webapp_url("", "https://pay.example/x?a=1", "combo", "direct").replace(script._USER_ID_MARK, "77")
+    resp = script.app.test_client().get(url)
+    assert target == "https://pay.example/x?a=1&utm_content=tg77"
+    assert f'href="{target.replace("&", "&amp;")}"' in resp.get_data(as_text=True)